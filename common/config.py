@@ -6,12 +6,17 @@ import simplejson as json
 from django.http import HttpResponse
 
 from common.utils.permission import superuser_required
+from common.utils.versioned_cache import VersionedCache
 from sql.models import Config
+from sql.utils.tasks import add_replica_lag_schedule
 from django.db import transaction
 from django.core.cache import cache
 
 logger = logging.getLogger('default')
 
+# 配置的进程内快照，每秒最多检查一次版本号，配置修改后各进程在1秒内生效
+sys_config_cache = VersionedCache('sys_config', check_interval=1)
+
 
 class SysConfig(object):
 
@@ -38,6 +43,15 @@ class SysConfig(object):
         self.get_all_config()
 
     def get_all_config(self):
+        # 优先使用进程内快照，版本号变化时重新加载，快照只读，不可直接修改
+        try:
+            self.sys_config = sys_config_cache.get('sys_config', self._load_config)
+        except Exception as m:
+            logger.error(f"获取系统配置信息失败:{m}{traceback.format_exc()}")
+            self.sys_config = {}
+
+    def _load_config(self):
+        """从缓存或数据库加载全部配置"""
         # 优先获取缓存数据
         try:
             sys_config = cache.get('sys_config')
@@ -45,30 +59,23 @@ class SysConfig(object):
             sys_config = None
             logger.error(f"读取缓存失败:{m}{traceback.format_exc()}")
 
-        # 缓存获取失败从数据库获取并且尝试更新缓存
         if sys_config:
-            self.sys_config = sys_config
-        else:
-            try:
-                # 获取系统配置信息
-                all_config = Config.objects.all().values('item', 'value')
-                sys_config = {}
-                for items in all_config:
-                    if items['value'] in ('true', 'True'):
-                        items['value'] = True
-                    elif items['value'] in ('false', 'False'):
-                        items['value'] = False
-                    sys_config[items['item']] = items['value']
-                self.sys_config = sys_config
-            except Exception as m:
-                logger.error(f"获取系统配置信息失败:{m}{traceback.format_exc()}")
-                self.sys_config = {}
-            else:
-                try:
-                    # 更新缓存
-                    cache.set('sys_config', self.sys_config, timeout=None)
-                except Exception as m:
-                    logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+            return sys_config
+        # 缓存获取失败从数据库获取并且尝试更新缓存，数据库异常时抛出，不缓存空配置
+        all_config = Config.objects.all().values('item', 'value')
+        sys_config = {}
+        for items in all_config:
+            if items['value'] in ('true', 'True'):
+                items['value'] = True
+            elif items['value'] in ('false', 'False'):
+                items['value'] = False
+            sys_config[items['item']] = items['value']
+        try:
+            # 更新缓存
+            cache.set('sys_config', sys_config, timeout=None)
+        except Exception as m:
+            logger.error(f"更新缓存失败:{m}{traceback.format_exc()}")
+        return sys_config
 
     def get(self, key, default_value=None):
         value = self.sys_config.get(key, default_value)
@@ -91,6 +98,7 @@ class SysConfig(object):
         except Exception as m:
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
         finally:
+            sys_config_cache.invalidate()
             self.get_all_config()
             self._broadcast()
 
@@ -108,6 +116,7 @@ class SysConfig(object):
             result['status'] = 1
             result['msg'] = str(e)
         finally:
+            sys_config_cache.invalidate()
             self.get_all_config()
             self._broadcast()
         return result
@@ -121,6 +130,7 @@ class SysConfig(object):
             logger.error(f"删除缓存失败:{m}{traceback.format_exc()}")
         with transaction.atomic():
             Config.objects.all().delete()
+        sys_config_cache.invalidate()
 
 
 # 修改系统配置
@@ -129,5 +139,11 @@ def change_config(request):
     configs = request.POST.get('configs')
     archer_config = SysConfig()
     result = archer_config.replace(configs)
+    # 根据配置添加/删除主从延迟采集任务
+    if result['status'] == 0:
+        try:
+            add_replica_lag_schedule(int(archer_config.get('replica_lag_interval', 0)))
+        except Exception as e:
+            logger.error(f'添加主从延迟采集任务失败:{e}{traceback.format_exc()}')
     # 返回结果
     return HttpResponse(json.dumps(result), content_type='application/json')
@@ -2,11 +2,16 @@ import json
 import smtplib
 from unittest.mock import patch, ANY
 import datetime
+from decimal import Decimal
+
+import simplejson
 from django.contrib.auth import get_user_model
 from django.test import Client, TestCase
 
-from common.config import SysConfig
+from common.config import SysConfig, sys_config_cache
+from common.utils.extend_json_encoder import RowEncoder, encode_rows
 from common.utils.sendmsg import MsgSender
+from common.utils.versioned_cache import VersionedCache
 from sql.engines import EngineBase
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent, QueryLog, ResourceGroup
 from common.utils.chart_dao import ChartDao
@@ -64,6 +69,86 @@ class ConfigOpsTests(TestCase):
         archer_config.set('other_config', 'testvalue3')
         self.assertEqual(archer_config.sys_config['other_config'], 'testvalue3')
 
+    @patch('common.config.cache')
+    def test_local_snapshot(self, _cache):
+        """版本号未变化时直接使用进程内快照，不读取缓存的配置"""
+        _cache.get.return_value = {'snapshot_config': 'cached'}
+        sys_config_cache.invalidate()
+        self.assertEqual(SysConfig().get('snapshot_config'), 'cached')
+        self.assertEqual(SysConfig().get('snapshot_config'), 'cached')
+        _cache.get.assert_called_once_with('sys_config')
+        sys_config_cache.invalidate()
+
+
+class VersionedCacheTest(TestCase):
+    def setUp(self):
+        self.cache = VersionedCache('test_namespace')
+
+    def tearDown(self):
+        self.cache.invalidate()
+
+    def test_get(self):
+        """版本号不变时不重复加载"""
+        loads = []
+        loader = lambda: loads.append(1) or len(loads)
+        self.assertEqual(self.cache.get('key', loader), 1)
+        self.assertEqual(self.cache.get('key', loader), 1)
+        self.assertEqual(len(loads), 1)
+
+    def test_invalidate(self):
+        """其他进程递增版本号后重新加载"""
+        other = VersionedCache('test_namespace')
+        self.assertEqual(self.cache.get('key', lambda: 'old'), 'old')
+        other.invalidate()
+        self.assertEqual(self.cache.get('key', lambda: 'new'), 'new')
+
+    def test_check_interval(self):
+        """检查间隔内不读取版本号"""
+        cache = VersionedCache('test_namespace', check_interval=60)
+        self.assertEqual(cache.get('key', lambda: 'old'), 'old')
+        VersionedCache('test_namespace').invalidate()
+        self.assertEqual(cache.get('key', lambda: 'new'), 'old')
+
+    def test_shared_timeout(self):
+        """其他进程已加载的同版本数据直接从共享缓存读取"""
+        VersionedCache('test_namespace', shared_timeout=60).get('key', lambda: 'shared')
+        cache = VersionedCache('test_namespace', shared_timeout=60)
+        self.assertEqual(cache.get('key', lambda: 'loaded'), 'shared')
+        cache.invalidate()
+        self.assertEqual(cache.get('key', lambda: 'loaded'), 'loaded')
+
+
+class RowEncoderTest(TestCase):
+    def test_encode_rows(self):
+        """按列转换为JSON原生类型，二进制无法解码时输出十六进制"""
+        rows = [(None, 1, datetime.datetime(2020, 1, 2, 3, 4, 5), Decimal('1.5'), b'\xff\x01'),
+                (datetime.date(2020, 1, 1), 2, None, None, 'some_str'.encode())]
+        self.assertEqual(encode_rows(rows), [
+            [None, 1, '2020-01-02 03:04:05', Decimal('1.5'), '0xff01'],
+            ['2020-01-01', 2, None, None, 'some_str']])
+
+    def test_datetime_format(self):
+        """datetime与ExtendJSONEncoder格式一致，不输出微秒和时区"""
+        tz = datetime.timezone(datetime.timedelta(hours=8))
+        rows = [(datetime.datetime(2020, 1, 1, 1, 2, 3, 456),), (datetime.datetime(2020, 1, 1, 1, 2, 3, tzinfo=tz),)]
+        self.assertEqual(encode_rows(rows), [['2020-01-01 01:02:03'], ['2020-01-01 01:02:03']])
+
+    def test_decimal_precision(self):
+        """DECIMAL(20,2)等精确数值按原值输出"""
+        rows = [(Decimal('12345678901234567.89'), Decimal('0.1000'))]
+        self.assertEqual(simplejson.dumps(encode_rows(rows)), '[[12345678901234567.89, 0.1000]]')
+
+    def test_native_rows(self):
+        """无需转换的结果原样返回"""
+        rows = [(1, 'a', 1.5, None)]
+        self.assertIs(encode_rows(rows), rows)
+
+    def test_encode_chunks(self):
+        """转换函数跨批次复用，前一批全为空的列在后续批次确定类型"""
+        encoder = RowEncoder()
+        self.assertEqual(encoder.encode([(1, None)]), [(1, None)])
+        self.assertEqual(encoder.encode([(2, datetime.timedelta(seconds=61))]), [[2, '0:01:01']])
+
 
 class SendMessageTest(TestCase):
     """发送消息测试"""
@@ -49,3 +49,97 @@ class ExtendJSONEncoderFTime(json.JSONEncoder):
                 return convert(obj)
         except TypeError:
             return super(ExtendJSONEncoderFTime, self).default(obj)
+
+
+def _decode_binary(o):
+    """二进制按utf-8解码，无法解码时输出十六进制"""
+    o = bytes(o)
+    try:
+        return o.decode('utf-8')
+    except UnicodeDecodeError:
+        return '0x' + o.hex()
+
+
+def _convert_any(o):
+    # Decimal由simplejson原样输出，保证精度
+    if isinstance(o, Decimal):
+        return o
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return _decode_binary(o)
+    try:
+        return convert(o)
+    except TypeError:
+        return str(o)
+
+
+# 按值类型选择的转换函数，None表示无需转换，datetime需在date之前匹配
+# Decimal无需转换，simplejson默认use_decimal=True，按原值输出不丢失精度
+_type_converters = [
+    ((str, int, float, Decimal), None),
+    (datetime, convert),
+    (date, convert),
+    (timedelta, str),
+    ((bytes, bytearray, memoryview), _decode_binary),
+]
+
+
+def _column_converter(value_type):
+    for types, func in _type_converters:
+        if issubclass(value_type, types):
+            break
+    else:
+        func = _convert_any
+    if func is None:
+        return None
+
+    # 同一列由驱动返回相同类型，类型不同时(如mongo)使用通用转换
+    def converter(o):
+        return func(o) if type(o) is value_type else _convert_any(o)
+
+    return converter
+
+
+class RowEncoder:
+    """
+    查询结果行转换为JSON原生类型，按列选择转换函数，不再对每个单元格调用JSONEncoder.default
+    每列的转换函数由该列第一个非空值的类型确定，可跨批次复用
+    """
+
+    def __init__(self):
+        self._converters = {}
+        self._pending = None
+
+    def _resolve(self, rows):
+        for index in list(self._pending):
+            for row in rows:
+                value = row[index]
+                if value is not None:
+                    self._converters[index] = _column_converter(type(value))
+                    self._pending.discard(index)
+                    break
+
+    def encode(self, rows):
+        """返回转换后的行，无需转换时原样返回"""
+        if not rows:
+            return rows
+        if self._pending is None:
+            self._pending = set(range(len(rows[0])))
+        if self._pending:
+            self._resolve(rows)
+        converters = [(index, func) for index, func in self._converters.items() if func is not None]
+        if not converters:
+            return rows
+        encoded = []
+        for row in rows:
+            row = list(row)
+            for index, func in converters:
+                value = row[index]
+                if value is not None:
+                    row[index] = func(value)
+            encoded.append(row)
+        return encoded
+
+
+def encode_rows(rows):
+    """单批查询结果转换为JSON原生类型"""
+    return RowEncoder().encode(rows)
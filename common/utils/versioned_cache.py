@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+"""
+带版本号的进程内缓存
+* 数据缓存在进程内存中，版本号存放在django缓存(Redis)中，多进程共享
+* 数据变更时调用invalidate递增版本号，所有进程的本地缓存在下次读取时重新加载
+* 可选共享缓存层，本地未命中时先读取django缓存中同版本号的数据，减少重复加载
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+
+logger = logging.getLogger('default')
+
+_missing = object()
+
+
+class VersionedCache:
+
+    def __init__(self, namespace, check_interval=0, shared_timeout=None):
+        """
+        :param namespace: 缓存命名空间，同一命名空间共享一个版本号
+        :param check_interval: 版本号检查间隔，单位秒，0表示每次读取都检查版本号
+        :param shared_timeout: 共享缓存层的过期时间，单位秒，None表示不使用共享缓存层
+        """
+        self.namespace = namespace
+        self.check_interval = check_interval
+        self.shared_timeout = shared_timeout
+        self._local = {}
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0
+
+    @property
+    def version_key(self):
+        return f'cache_version:{self.namespace}'
+
+    def version(self):
+        """获取当前版本号，读取失败返回None"""
+        now = time.time()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return self._version
+        try:
+            version = cache.get(self.version_key)
+            if version is None:
+                # 使用时间戳初始化，避免缓存被清空后版本号与进程内的旧版本号重复
+                cache.add(self.version_key, int(now * 1000), timeout=None)
+                version = cache.get(self.version_key)
+        except Exception as e:
+            logger.error(f'读取缓存版本号失败:{e}')
+            version = None
+        self._version, self._checked_at = version, now
+        return version
+
+    def get(self, key, loader):
+        """
+        读取缓存，不存在或版本号变化时调用loader重新加载
+        :param key: 缓存key
+        :param loader: 加载函数，无参数
+        """
+        version = self.version()
+        # 版本号不可用时不使用缓存，保证数据正确
+        if version is None:
+            return loader()
+        with self._lock:
+            entry = self._local.get(key)
+        if entry and entry[0] == version:
+            return entry[1]
+        value = self._load(version, key, loader)
+        with self._lock:
+            self._local[key] = (version, value)
+        return value
+
+    def _load(self, version, key, loader):
+        """从共享缓存层或loader加载数据"""
+        if self.shared_timeout is None:
+            return loader()
+        shared_key = f'{self.namespace}:{version}:{key}'
+        try:
+            value = cache.get(shared_key, _missing)
+        except Exception as e:
+            logger.error(f'读取共享缓存失败:{e}')
+            value = _missing
+        if value is _missing:
+            value = loader()
+            try:
+                cache.set(shared_key, value, timeout=self.shared_timeout)
+            except Exception as e:
+                logger.error(f'写入共享缓存失败:{e}')
+        return value
+
+    def invalidate(self):
+        """递增版本号，使所有进程的本地缓存失效"""
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, int(time.time() * 1000), timeout=None)
+        except Exception as e:
+            logger.error(f'更新缓存版本号失败:{e}')
+        with self._lock:
+            self._local.clear()
+        self._version, self._checked_at = None, 0
@@ -0,0 +1,10 @@
+# -*- coding: UTF-8 -*-
+from django.apps import AppConfig
+
+
+class SqlConfig(AppConfig):
+    name = 'sql'
+
+    def ready(self):
+        # 注册信号处理
+        from sql import signals  # noqa: F401
@@ -72,7 +72,6 @@ class Completer:
 
 
 def get_comp_engine(instance=None, db_name=None):
-    """获取SQL补全engine"""
-    if instance.db_type == 'mysql':
-        from .mysql import MysqlComEngine
-        return MysqlComEngine(instance=instance, db_name=db_name)
+    """获取SQL补全engine，同一进程内按实例+数据库共用"""
+    from .service import completer_service
+    return completer_service.get(instance, db_name)
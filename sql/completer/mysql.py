@@ -1,5 +1,5 @@
 # -*- coding: UTF-8 -*-
-""" 
+"""
 @author: hhyo
 @license: Apache Licence
 @file: mysql.py
@@ -8,35 +8,88 @@
 import threading
 
 import mycli.sqlcompleter as completer
+from mycli.packages.special.main import COMMANDS
 from prompt_toolkit.document import Document
-from mycli.completion_refresher import CompletionRefresher
-from mycli.sqlexecute import SQLExecute
+
+from sql.engines import get_engine
 from . import Completer
 
 __author__ = 'hhyo'
 
 
 class MysqlComEngine(Completer):
+    """补全元数据通过实例engine的连接池获取，由completer_service统一缓存和刷新"""
+    functions_sql = """SELECT ROUTINE_NAME FROM INFORMATION_SCHEMA.ROUTINES
+    WHERE ROUTINE_TYPE='FUNCTION' AND ROUTINE_SCHEMA = '{}';"""
+    users_sql = """SELECT CONCAT("'", user, "'@'",host,"'") FROM mysql.user;"""
+    show_candidates_sql = """SELECT name from mysql.help_topic WHERE name like 'SHOW %';"""
+
     def __init__(self, instance=None, db_name=None):
         self.instance = instance
         self.db_name = db_name
-        self.completion_refresher = CompletionRefresher()
         self.completer = completer.SQLCompleter(smart_completion=True)
         self._completer_lock = threading.Lock()
-        self.sql_execute = self._get_sql_execute()
-        self.refresh_completions()
+        self.snapshot = None
+        # 以下属性由completer_service维护
+        self.refresh_thread = None
+        self.checked_at = 0
+
+    @property
+    def name(self):
+        return 'MySQL Completer engine'
 
-    def _get_sql_execute(self):
+    @property
+    def info(self):
+        return 'MySQL Completer engine'
+
+    def fetch_snapshot(self, previous=None):
         """
-        初始化数据库执行连接
+        查询补全元数据，返回可序列化的dict
+        :param previous: 上一次的元数据，不为空时为增量刷新，仅重新获取表和字段
         :return:
         """
-        return SQLExecute(self.db_name, self.instance.user, self.instance.password, self.instance.host,
-                          int(self.instance.port),
-                          socket='', charset=self.instance.charset or 'utf8mb4',
-                          local_infile='', ssl='', ssh_user='', ssh_host='', ssh_port='',
-                          ssh_password='', ssh_key_filename=''
-                          )
+        engine = get_engine(instance=self.instance)
+        columns = engine.get_all_columns(self.db_name)
+        if columns.error:
+            raise RuntimeError(columns.error)
+        snapshot = {'columns': [[row[1], row[2]] for row in columns.rows]}
+        if previous:
+            return dict(previous, **snapshot)
+        databases = engine.get_all_databases()
+        if databases.error:
+            raise RuntimeError(databases.error)
+        snapshot['databases'] = databases.rows
+        for key, sql in (('functions', self.functions_sql.format(self.db_name)),
+                         ('users', self.users_sql),
+                         ('show_items', self.show_candidates_sql)):
+            # 无权限时不提示对应内容
+            result = engine.query(db_name=self.db_name, sql=sql)
+            snapshot[key] = [row[0] for row in result.rows] if not result.error else []
+        return snapshot
+
+    def _build_completer(self, snapshot):
+        new_completer = completer.SQLCompleter(smart_completion=True)
+        new_completer.extend_database_names(snapshot['databases'])
+        new_completer.extend_schemata(self.db_name)
+        new_completer.set_dbname(self.db_name)
+        # 表名取自字段列表，保证两者一致
+        tables = list(dict.fromkeys(column[0] for column in snapshot['columns']))
+        new_completer.extend_relations([(table,) for table in tables], kind='tables')
+        new_completer.extend_columns([tuple(column) for column in snapshot['columns']], kind='tables')
+        new_completer.extend_users([(user,) for user in snapshot['users']])
+        new_completer.extend_functions([(function,) for function in snapshot['functions']])
+        new_completer.extend_special_commands(COMMANDS.keys())
+        new_completer.extend_show_items([(item,) for item in snapshot['show_items']])
+        return new_completer
+
+    def load(self, snapshot):
+        """使用元数据构建新的completer对象并替换"""
+        new_completer = self._build_completer(snapshot)
+        self._on_completions_refreshed(new_completer)
+        self.snapshot = snapshot
+
+    def is_refreshing(self):
+        return bool(self.refresh_thread and self.refresh_thread.is_alive())
 
     def refresh_completions(self, reset=False):
         """
@@ -44,10 +97,11 @@ class MysqlComEngine(Completer):
         :param reset:
         :return:
         """
+        from .service import completer_service
         if reset:
             with self._completer_lock:
                 self.completer.reset_completions()
-        self.completion_refresher.refresh(self.sql_execute, self._on_completions_refreshed)
+        completer_service.refresh(self, full=True)
         return [(None, None, None, 'Auto-completion refresh started in the background.')]
 
     def _on_completions_refreshed(self, new_completer):
@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+"""
+SQL补全服务，每个进程按 实例+数据库 缓存已加载元数据的补全engine，超过completer_cache_size时淘汰最久未使用的
+* 补全元数据同时写入Redis，新启动的进程直接从Redis加载，不需要查询实例
+* 元数据版本号与实例元数据缓存一致，DDL工单执行后增量刷新表和字段，超过completer_refresh_interval全量刷新
+* 刷新在后台线程执行，刷新期间继续使用旧的元数据，补全耗时与表数量无关
+"""
+import logging
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from common.config import SysConfig
+from sql.utils.metadata_cache import get_generation
+
+logger = logging.getLogger('default')
+
+# Redis中元数据的保留时间，是否需要刷新由版本号和刷新间隔决定
+SNAPSHOT_TIMEOUT = 7 * 24 * 60 * 60
+# 同一个补全engine检查版本号的最小间隔，单位秒
+CHECK_INTERVAL = 5
+
+
+def _engine_class(instance):
+    if instance.db_type == 'mysql':
+        from .mysql import MysqlComEngine
+        return MysqlComEngine
+    return None
+
+
+def _snapshot_key(instance, db_name):
+    update_time = instance.update_time.timestamp() if instance.update_time else 0
+    return f'completer_snapshot:{instance.id}:{update_time}:{db_name}'
+
+
+class CompleterService:
+
+    def __init__(self):
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, instance, db_name):
+        """获取实例+数据库的补全engine，不支持的数据库类型返回None"""
+        engine_class = _engine_class(instance)
+        if engine_class is None:
+            return None
+        key = (instance.id, db_name)
+        with self._lock:
+            comp_engine = self._engines.get(key)
+            # 实例信息变更后重建
+            if comp_engine and comp_engine.instance.update_time != instance.update_time:
+                comp_engine = None
+            if comp_engine:
+                self._engines.move_to_end(key)
+        if comp_engine is None:
+            comp_engine = engine_class(instance=instance, db_name=db_name)
+            snapshot = self._load_snapshot(instance, db_name)
+            if snapshot:
+                comp_engine.load(snapshot)
+            else:
+                self._refresh(comp_engine, full=True)
+            self._add(key, comp_engine)
+        self.refresh_if_stale(comp_engine)
+        return comp_engine
+
+    def _add(self, key, comp_engine):
+        max_size = int(SysConfig().get('completer_cache_size', 32))
+        with self._lock:
+            self._engines[key] = comp_engine
+            self._engines.move_to_end(key)
+            while len(self._engines) > max(max_size, 1):
+                self._engines.popitem(last=False)
+
+    def refresh_if_stale(self, comp_engine):
+        """元数据版本号变化时增量刷新，超过刷新间隔时全量刷新"""
+        now = time.time()
+        if now - comp_engine.checked_at < CHECK_INTERVAL:
+            return
+        comp_engine.checked_at = now
+        snapshot = comp_engine.snapshot
+        interval = int(SysConfig().get('completer_refresh_interval', 3600))
+        if interval > 0 and now - snapshot['full_at'] >= interval:
+            self.refresh(comp_engine, full=True)
+        else:
+            generation = get_generation(comp_engine.instance)
+            if generation is not None and generation != snapshot['generation']:
+                self.refresh(comp_engine, full=False)
+
+    def refresh(self, comp_engine, full=True):
+        """后台刷新补全engine的元数据，正在刷新时忽略"""
+        with self._lock:
+            if comp_engine.is_refreshing():
+                return
+            comp_engine.refresh_thread = threading.Thread(target=self._refresh_in_thread, args=(comp_engine, full),
+                                                          name='completion-refresh', daemon=True)
+            comp_engine.refresh_thread.start()
+
+    def _refresh_in_thread(self, comp_engine, full):
+        try:
+            self._refresh(comp_engine, full)
+        except Exception as e:
+            logger.error(f'SQL补全元数据刷新失败，实例：{comp_engine.instance.instance_name}，'
+                         f'库：{comp_engine.db_name}，错误信息：{e}{traceback.format_exc()}')
+        finally:
+            close_old_connections()
+
+    def _refresh(self, comp_engine, full):
+        # 先读取版本号再查询，查询期间发生的DDL会在下次检查时再次刷新
+        generation = get_generation(comp_engine.instance) or 0
+        previous = None if full else comp_engine.snapshot
+        snapshot = comp_engine.fetch_snapshot(previous)
+        now = time.time()
+        snapshot.update(generation=generation, refreshed_at=now, full_at=now if full else previous['full_at'])
+        comp_engine.load(snapshot)
+        self._save_snapshot(comp_engine.instance, comp_engine.db_name, snapshot)
+
+    @staticmethod
+    def _load_snapshot(instance, db_name):
+        try:
+            return cache.get(_snapshot_key(instance, db_name))
+        except Exception as e:
+            logger.error(f'读取SQL补全元数据失败:{e}')
+            return None
+
+    @staticmethod
+    def _save_snapshot(instance, db_name, snapshot):
+        try:
+            cache.set(_snapshot_key(instance, db_name), snapshot, timeout=SNAPSHOT_TIMEOUT)
+        except Exception as e:
+            logger.error(f'写入SQL补全元数据失败:{e}')
+
+    def clear(self):
+        with self._lock:
+            self._engines.clear()
+
+
+completer_service = CompleterService()
@@ -5,10 +5,18 @@
 @file: tests.py
 @time: 2019/03/11
 """
+from unittest.mock import patch
+
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from prompt_toolkit.completion import Completion
+
+from common.config import SysConfig
 from sql.completer import get_comp_engine
+from sql.completer.mysql import MysqlComEngine
+from sql.completer.service import completer_service, _snapshot_key
+from sql.utils.metadata_cache import invalidate_metadata
 
 from sql.models import Instance
 
@@ -30,8 +38,8 @@ class TestCompleter(TestCase):
                               password=settings.DATABASES['default']['PASSWORD'])
         cls.master.save()
         cls.comp_engine = get_comp_engine(instance=cls.master, db_name=settings.DATABASES['default']['TEST']['NAME'])
-        # 等待completion_refresher刷新完成
-        while cls.comp_engine.completion_refresher.is_refreshing():
+        # 等待后台刷新完成
+        while cls.comp_engine.is_refreshing():
             import time
             time.sleep(1)
 
@@ -41,7 +49,7 @@ class TestCompleter(TestCase):
         :return:
         """
         cls.master.delete()
-        cls.comp_engine.refresh_completions(reset=True)
+        completer_service.clear()
 
     def test_table_names_after_from(self):
         text = 'SELECT * FROM '
@@ -60,3 +68,59 @@ class TestCompleter(TestCase):
         self.comp_engine.convert2ace_js(result)
         self.assertListEqual(result, [Completion(text='MAX', start_position=-2),
                                       Completion(text='MASTER', start_position=-2)])
+
+
+class TestCompleterService(TestCase):
+    snapshot = {'databases': ['some_db'], 'columns': [['t1', 'id'], ['t1', 'name'], ['t2', 'id']],
+                'functions': ['f1'], 'users': [], 'show_items': ['SHOW TABLES']}
+
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='some_ins', type='master', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+
+    def tearDown(self):
+        completer_service.clear()
+        cache.delete_many([_snapshot_key(self.ins, 'some_db'), f'metadata_gen:{self.ins.id}'])
+        self.ins.delete()
+
+    @patch.object(MysqlComEngine, 'fetch_snapshot')
+    def test_get_shared(self, _fetch_snapshot):
+        _fetch_snapshot.return_value = dict(self.snapshot)
+        comp_engine = get_comp_engine(instance=self.ins, db_name='some_db')
+        self.assertIs(get_comp_engine(instance=self.ins, db_name='some_db'), comp_engine)
+        _fetch_snapshot.assert_called_once_with(None)
+        result = comp_engine.get_completions(text='SELECT * FROM t', cursor_position=len('SELECT * FROM t'))
+        self.assertIn('t1', [completion.text for completion in result])
+
+    @patch.object(MysqlComEngine, 'fetch_snapshot')
+    def test_load_snapshot_from_redis(self, _fetch_snapshot):
+        _fetch_snapshot.return_value = dict(self.snapshot)
+        get_comp_engine(instance=self.ins, db_name='some_db')
+        # 新进程直接使用Redis中的元数据
+        completer_service.clear()
+        comp_engine = get_comp_engine(instance=self.ins, db_name='some_db')
+        _fetch_snapshot.assert_called_once()
+        self.assertEqual(comp_engine.snapshot['columns'], self.snapshot['columns'])
+
+    @patch.object(MysqlComEngine, 'fetch_snapshot')
+    def test_incremental_refresh(self, _fetch_snapshot):
+        _fetch_snapshot.side_effect = lambda previous: dict(self.snapshot)
+        comp_engine = get_comp_engine(instance=self.ins, db_name='some_db')
+        invalidate_metadata(self.ins)
+        comp_engine.checked_at = 0
+        completer_service.refresh_if_stale(comp_engine)
+        comp_engine.refresh_thread.join()
+        # 增量刷新传入上一次的元数据
+        self.assertEqual(_fetch_snapshot.call_count, 2)
+        self.assertIsNotNone(_fetch_snapshot.call_args[0][0])
+        self.assertEqual(comp_engine.snapshot['generation'], 1)
+
+    @patch.object(MysqlComEngine, 'fetch_snapshot')
+    def test_lru(self, _fetch_snapshot):
+        _fetch_snapshot.side_effect = lambda previous: dict(self.snapshot)
+        SysConfig().set('completer_cache_size', '1')
+        first = get_comp_engine(instance=self.ins, db_name='some_db')
+        get_comp_engine(instance=self.ins, db_name='other_db')
+        self.assertIsNot(get_comp_engine(instance=self.ins, db_name='some_db'), first)
+        SysConfig().purge()
+        cache.delete(_snapshot_key(self.ins, 'other_db'))
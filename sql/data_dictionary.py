@@ -1,21 +1,41 @@
 # -*- coding: UTF-8 -*-
+"""
+数据字典
+导出时每个库的TABLES、COLUMNS、STATISTICS各查询一次，在内存中按表分组后逐表写入文件
+整个实例的导出由django_q异步执行，多个库通过有界线程池并发导出，进度存放在django缓存中
+"""
 import datetime
+import logging
 import os
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import MySQLdb
 import simplejson as json
+from django.core.cache import cache
+from django.db import connection
 from django.utils.http import urlquote
+from django_q.tasks import async_task
 from jinja2 import Template
 
 from archery import settings
+from common.config import SysConfig
 from sql.engines import get_engine
 from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse, JsonResponse, FileResponse
 
 from common.utils.extend_json_encoder import ExtendJSONEncoder
+from sql.utils.metadata_cache import MetadataCache
 from sql.utils.resource_group import user_instances
 from .models import Instance
 
+logger = logging.getLogger('default')
+
+EXPORT_DIR = os.path.join(settings.BASE_DIR, 'downloads/dictionary')
+# 导出进度保留时间
+PROGRESS_TIMEOUT = 24 * 60 * 60
+
 
 @permission_required('sql.menu_data_dictionary', raise_exception=True)
 def table_list(request):
@@ -53,78 +73,15 @@ def table_list(request):
 
 @permission_required('sql.menu_data_dictionary', raise_exception=True)
 def table_info(request):
-    """数据字典获取表信息"""
+    """数据字典获取表信息，结果由元数据缓存提供"""
     instance_name = request.GET.get('instance_name', '')
     db_name = request.GET.get('db_name', '')
     tb_name = request.GET.get('tb_name', '')
     if instance_name and db_name and tb_name:
-        data = {}
         try:
             instance = Instance.objects.get(instance_name=instance_name, db_type='mysql')
-            query_engine = get_engine(instance=instance)
-
-            sql = f"""SELECT
-                TABLE_NAME as table_name,
-                ENGINE as engine,
-                ROW_FORMAT as row_format,
-                TABLE_ROWS as table_rows,
-                AVG_ROW_LENGTH as avg_row_length,
-                round(DATA_LENGTH/1024, 2) as data_length,
-                MAX_DATA_LENGTH as max_data_length,
-                round(INDEX_LENGTH/1024, 2) as index_length,
-                round((DATA_LENGTH + INDEX_LENGTH)/1024, 2) as data_total,
-                DATA_FREE as data_free,
-                AUTO_INCREMENT as auto_increment,
-                TABLE_COLLATION as table_collation,
-                CREATE_TIME as create_time,
-                CHECK_TIME as check_time,
-                UPDATE_TIME as update_time,
-                TABLE_COMMENT as table_comment
-            FROM
-                information_schema.TABLES
-            WHERE
-                TABLE_SCHEMA='{db_name}'
-                    AND TABLE_NAME='{tb_name}'"""
-            _meta_data = query_engine.query(db_name, sql)
-            data['meta_data'] = {'column_list': _meta_data.column_list, 'rows': _meta_data.rows[0]}
-
-            sql = f"""SELECT 
-                COLUMN_NAME as '列名',
-                COLUMN_TYPE as '列类型',
-                CHARACTER_SET_NAME as '列字符集',
-                IS_NULLABLE as '是否为空',
-                COLUMN_KEY as '索引列',
-                COLUMN_DEFAULT as '默认值',
-                EXTRA as '拓展信息',
-                COLUMN_COMMENT as '列说明'
-            FROM
-                information_schema.COLUMNS
-            WHERE
-                TABLE_SCHEMA = '{db_name}'
-                    AND TABLE_NAME = '{tb_name}'
-            ORDER BY ORDINAL_POSITION;"""
-            _desc_data = query_engine.query(db_name, sql)
-            data['desc'] = {'column_list': _desc_data.column_list, 'rows': _desc_data.rows}
-
-            sql = f"""SELECT
-                COLUMN_NAME as '列名',
-                INDEX_NAME as '索引名',
-                NON_UNIQUE as '唯一性',
-                SEQ_IN_INDEX as '列序列',
-                CARDINALITY as '基数',
-                NULLABLE as '是否为空',
-                INDEX_TYPE as '索引类型',
-                COMMENT as '备注'
-            FROM
-                information_schema.STATISTICS
-            WHERE
-                TABLE_SCHEMA = '{db_name}'
-            AND TABLE_NAME = '{tb_name}';"""
-            _index_data = query_engine.query(db_name, sql)
-            data['index'] = {'column_list': _index_data.column_list, 'rows': _index_data.rows}
-
-            _create_sql = query_engine.query(db_name, "show create table `%s`;" % tb_name)
-            data['create_sql'] = _create_sql.rows
+            metadata = MetadataCache(instance, get_engine(instance=instance))
+            data = metadata.get_table_info(db_name, tb_name)
             res = {'status': 0, 'data': data}
         except Instance.DoesNotExist:
             res = {'status': 1, 'msg': 'Instance.DoesNotExist'}
@@ -136,93 +93,289 @@ def table_info(request):
                         content_type='application/json')
 
 
+HTML_HEADER = Template("""<html>
+<meta charset="utf-8">
+<title>数据库表结构说明文档</title>
+<style>
+    body,td,th {font-family:"宋体"; font-size:12px;}
+    table,h1,p{width:960px;margin:0px auto;}
+    table{border-collapse:collapse;border:1px solid #CCC;background:#efefef;}
+    table caption{text-align:left; background-color:#fff; line-height:2em; font-size:14px; font-weight:bold; }
+    table th{text-align:left; font-weight:bold;height:26px; line-height:26px; font-size:12px; border:1px solid #CCC;padding-left:5px;}
+    table td{height:20px; font-size:12px; border:1px solid #CCC;background-color:#fff;padding-left:5px;}
+    .c1{ width: 150px;}
+    .c2{ width: 150px;}
+    .c3{ width: 80px;}
+    .c4{ width: 100px;}
+    .c5{ width: 100px;}
+    .c6{ width: 300px;}
+</style>
+<body>
+<h1 style="text-align:center;">{{ db_name }} 数据字典 (共 {{ table_count }} 个表)</h1>
+<p style="text-align:center;margin:20px auto;">生成时间：{{ export_time }}</p>
+""")
+
+HTML_TABLE = Template("""<table border="1" cellspacing="0" cellpadding="0" align="center">
+<caption>表名：{{ tb['TABLE_NAME'] }}</caption>
+<caption>注释：{{ tb['TABLE_COMMENT'] }}</caption>
+<tbody>
+<tr><th>字段名</th><th>数据类型</th><th>默认值</th><th>允许非空</th><th>自动递增</th><th>是否主键</th><th>备注</th></tr>
+{% for col in columns %}<tr>
+<td class="c1">{{ col['COLUMN_NAME'] }}</td>
+<td class="c2">{{ col['COLUMN_TYPE'] }}</td>
+<td class="c3">{{ col['COLUMN_DEFAULT'] or '' }}</td>
+<td class="c4">{{ col['IS_NULLABLE'] }}</td>
+<td class="c5">{% if col['EXTRA']=='auto_increment' %} 是 {% endif %}</td>
+<td class="c5">{{ col['COLUMN_KEY'] }}</td>
+<td class="c6">{{ col['COLUMN_COMMENT'] }}</td>
+</tr>
+{% endfor %}{% if indexes %}<tr><th>索引名</th><th>字段名</th><th>列序列</th><th>唯一性</th><th>索引类型</th><th>基数</th><th>备注</th></tr>
+{% for idx in indexes %}<tr>
+<td class="c1">{{ idx['INDEX_NAME'] }}</td>
+<td class="c2">{{ idx['COLUMN_NAME'] }}</td>
+<td class="c3">{{ idx['SEQ_IN_INDEX'] }}</td>
+<td class="c4">{% if idx['NON_UNIQUE'] == 0 %} 是 {% endif %}</td>
+<td class="c5">{{ idx['INDEX_TYPE'] }}</td>
+<td class="c5">{{ idx['CARDINALITY'] if idx['CARDINALITY'] is not none else '' }}</td>
+<td class="c6">{{ idx['INDEX_COMMENT'] }}</td>
+</tr>
+{% endfor %}{% endif %}</tbody></table></br>
+""")
+
+
+class HtmlWriter:
+    extension = 'html'
+
+    def __init__(self, filename, db_name, table_count, export_time):
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write(HTML_HEADER.render(db_name=db_name, table_count=table_count, export_time=export_time))
+
+    def write_table(self, tb, columns, indexes):
+        self._file.write(HTML_TABLE.render(tb=tb, columns=columns, indexes=indexes))
+
+    def close(self):
+        self._file.write('</body>\n</html>\n')
+        self._file.close()
+
+
+class MarkdownWriter:
+    extension = 'md'
+
+    def __init__(self, filename, db_name, table_count, export_time):
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write(f'# {db_name} 数据字典 (共 {table_count} 个表)\n\n生成时间：{export_time}\n\n')
+
+    @staticmethod
+    def _row(values):
+        cells = ['' if v is None else str(v).replace('|', '\\|').replace('\r', ' ').replace('\n', ' ')
+                 for v in values]
+        return '| ' + ' | '.join(cells) + ' |\n'
+
+    def write_table(self, tb, columns, indexes):
+        lines = [f"## {tb.get('TABLE_NAME')}\n\n", f"注释：{tb.get('TABLE_COMMENT') or ''}\n\n",
+                 self._row(['字段名', '数据类型', '默认值', '允许非空', '自动递增', '是否主键', '备注']),
+                 self._row(['---'] * 7)]
+        for col in columns:
+            lines.append(self._row([col.get('COLUMN_NAME'), col.get('COLUMN_TYPE'), col.get('COLUMN_DEFAULT'),
+                                    col.get('IS_NULLABLE'), '是' if col.get('EXTRA') == 'auto_increment' else '',
+                                    col.get('COLUMN_KEY'), col.get('COLUMN_COMMENT')]))
+        if indexes:
+            lines += ['\n', self._row(['索引名', '字段名', '列序列', '唯一性', '索引类型', '基数', '备注']),
+                      self._row(['---'] * 7)]
+            for idx in indexes:
+                lines.append(self._row([idx.get('INDEX_NAME'), idx.get('COLUMN_NAME'), idx.get('SEQ_IN_INDEX'),
+                                        '是' if idx.get('NON_UNIQUE') == 0 else '', idx.get('INDEX_TYPE'),
+                                        idx.get('CARDINALITY'), idx.get('INDEX_COMMENT')]))
+        lines.append('\n')
+        self._file.writelines(lines)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonWriter:
+    extension = 'json'
+
+    def __init__(self, filename, db_name, table_count, export_time):
+        self._file = open(filename, 'w', encoding='utf-8')
+        self._file.write(f'{{"db_name": {json.dumps(db_name, ensure_ascii=False)}, '
+                         f'"export_time": "{export_time:%Y-%m-%d %H:%M:%S}", "tables": [\n')
+        self._first = True
+
+    def write_table(self, tb, columns, indexes):
+        if not self._first:
+            self._file.write(',\n')
+        self._first = False
+        self._file.write(json.dumps({'table_info': tb, 'columns': columns, 'indexes': indexes},
+                                    cls=ExtendJSONEncoder, bigint_as_string=True, ensure_ascii=False))
+
+    def close(self):
+        self._file.write('\n]}\n')
+        self._file.close()
+
+
+WRITERS = {'html': HtmlWriter, 'markdown': MarkdownWriter, 'json': JsonWriter}
+
+
+def _query_dicts(engine, db_name, sql):
+    result = engine.query(db_name=db_name, sql=sql, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False)
+    if result.error:
+        raise RuntimeError(result.error)
+    return result.rows
+
+
+def _group_by_table(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['TABLE_NAME'], []).append(row)
+    return groups
+
+
+def fetch_schema(engine, db_name):
+    """
+    一次性获取库内全部表、字段、索引信息
+    :return: (表信息列表, {表名: 字段列表}, {表名: 索引列表})
+    """
+    tables = _query_dicts(engine, db_name, f"""SELECT * FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA='{db_name}' ORDER BY TABLE_NAME;""")
+    columns = _query_dicts(engine, db_name, f"""SELECT * FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA='{db_name}' ORDER BY TABLE_NAME, ORDINAL_POSITION;""")
+    indexes = _query_dicts(engine, db_name, f"""SELECT * FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA='{db_name}' ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;""")
+    return tables, _group_by_table(columns), _group_by_table(indexes)
+
+
+def export_database(instance, db_name, file_format, export_time):
+    """
+    导出单个库的数据字典，逐表写入文件
+    :return: (文件路径, 表数量)
+    """
+    engine = get_engine(instance=instance)
+    try:
+        tables, columns, indexes = fetch_schema(engine, db_name)
+    finally:
+        engine.close()
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    writer_class = WRITERS[file_format]
+    filename = os.path.join(EXPORT_DIR, f'{instance.instance_name}_{db_name}.{writer_class.extension}')
+    writer = writer_class(filename, db_name, len(tables), export_time)
+    try:
+        for tb in tables:
+            writer.write_table(tb, columns.get(tb['TABLE_NAME'], []), indexes.get(tb['TABLE_NAME'], []))
+    finally:
+        writer.close()
+    return filename, len(tables)
+
+
+def _export_database_worker(instance, db_name, file_format, export_time):
+    """线程池中执行，结束后关闭线程的数据库连接"""
+    try:
+        return export_database(instance, db_name, file_format, export_time)
+    finally:
+        connection.close()
+
+
+def _progress_key(export_id):
+    return f'data_dictionary_export:{export_id}'
+
+
+def get_progress(export_id):
+    """获取导出进度，不存在或已过期返回None"""
+    return cache.get(_progress_key(export_id))
+
+
+def _set_progress(export_id, **kwargs):
+    progress = get_progress(export_id) or {}
+    progress.update(kwargs)
+    cache.set(_progress_key(export_id), progress, timeout=PROGRESS_TIMEOUT)
+    return progress
+
+
+def export_dictionary(export_id, instance_id, db_names, file_format):
+    """
+    异步导出实例数据字典，返回导出进度
+    :param db_names: 需要导出的库，为空时导出全部库
+    """
+    try:
+        return _export_dictionary(export_id, instance_id, db_names, file_format)
+    except Exception as e:
+        # 任务异常也需要结束导出进度，避免页面一直轮询
+        logger.error(f'数据字典导出异常，导出id：{export_id}，错误信息：{traceback.format_exc()}')
+        return _set_progress(export_id, status='failed', msg=f'数据字典导出异常，错误信息：{e}',
+                             finish_time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def _export_dictionary(export_id, instance_id, db_names, file_format):
+    instance = Instance.objects.get(pk=instance_id)
+    if not db_names:
+        databases = get_engine(instance=instance).get_all_databases()
+        if databases.error:
+            return _set_progress(export_id, status='failed', msg=f'获取数据库列表失败，错误信息：{databases.error}')
+        db_names = databases.rows
+    export_time = datetime.datetime.now()
+    workers = max(int(SysConfig().get('data_dictionary_export_workers', 4)), 1)
+    _set_progress(export_id, status='running', total=len(db_names), finished=0, tables=0, failed=[])
+    finished, tables, failed = 0, 0, []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_export_database_worker, instance, db_name, file_format, export_time): db_name
+                   for db_name in db_names}
+        for future in as_completed(futures):
+            try:
+                tables += future.result()[1]
+            except Exception as e:
+                logger.error(f'数据字典导出失败，实例：{instance.instance_name}，库：{futures[future]}，'
+                             f'错误信息：{traceback.format_exc()}')
+                failed.append(futures[future])
+            finished += 1
+            _set_progress(export_id, finished=finished, tables=tables, failed=failed)
+    msg = f'导出失败的库：{",".join(failed)}' if failed else ''
+    return _set_progress(export_id, status='finished', msg=msg,
+                         finish_time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
 @permission_required('sql.data_dictionary_export', raise_exception=True)
 def export(request):
     """导出数据字典"""
     instance_name = request.GET.get('instance_name', '')
     db_name = request.GET.get('db_name', '')
+    file_format = request.GET.get('format', 'html')
     try:
         instance = user_instances(request.user, db_type=['mysql']).get(instance_name=instance_name)
-        query_engine = get_engine(instance=instance)
     except Instance.DoesNotExist:
         return JsonResponse({'status': 1, 'msg': '你所在组未关联该实例！', 'data': []})
-
-    html = """<html>
-    <meta charset="utf-8">
-    <title>数据库表结构说明文档</title>
-    <style>
-        body,td,th {font-family:"宋体"; font-size:12px;}  
-        table,h1,p{width:960px;margin:0px auto;}
-        table{border-collapse:collapse;border:1px solid #CCC;background:#efefef;}  
-        table caption{text-align:left; background-color:#fff; line-height:2em; font-size:14px; font-weight:bold; }  
-        table th{text-align:left; font-weight:bold;height:26px; line-height:26px; font-size:12px; border:1px solid #CCC;padding-left:5px;}  
-        table td{height:20px; font-size:12px; border:1px solid #CCC;background-color:#fff;padding-left:5px;}  
-        .c1{ width: 150px;}  
-        .c2{ width: 150px;}  
-        .c3{ width: 80px;}  
-        .c4{ width: 100px;}  
-        .c5{ width: 100px;}  
-        .c6{ width: 300px;}
-    </style>
-    <body>
-    <h1 style="text-align:center;">{{ db_name }} 数据字典 (共 {{ tables|length }} 个表)</h1>
-    <p style="text-align:center;margin:20px auto;">生成时间：{{ export_time }}</p>
-    {% for tb in tables %}
-    <table border="1" cellspacing="0" cellpadding="0" align="center">
-    <caption>表名：{{ tb['TABLE_INFO']['TABLE_NAME'] }}</caption>
-    <caption>注释：{{ tb['TABLE_INFO']['TABLE_COMMENT'] }}</caption>
-    <tbody><tr><th>字段名</th><th>数据类型</th><th>默认值</th><th>允许非空</th><th>自动递增</th><th>是否主键</th><th>备注</th>
-    {% for col in tb['COLUMNS'] %}
-    </tr>     
-    <td class="c1">{{ col['COLUMN_NAME'] }}</td>
-    <td class="c2">{{ col['COLUMN_TYPE'] }}</td>
-    <td class="c3">{{ col['COLUMN_DEFAULT'] or '' }}</td>
-    <td class="c4">{{ col['IS_NULLABLE'] }}</td>
-    <td class="c5">{% if col['EXTRA']=='auto_increment' %} 是 {% endif %}</td>
-    <td class="c5">{{ col['COLUMN_KEY'] }}</td>
-    <td class="c6">{{ col['COLUMN_COMMENT'] }}</td>
-    </tr>
-    {% endfor %}
-    </tbody></table></br>
-    {% endfor %}
-    </body>
-    </html>
-    """
+    if file_format not in WRITERS:
+        return JsonResponse({'status': 1, 'msg': '不支持的导出格式！', 'data': []})
 
     # 普通用户仅可以获取指定数据库的字典信息
     if db_name:
-        dbs = [db_name]
-    # 管理员可以导出整个实例的字典信息
+        try:
+            filename, _ = export_database(instance, db_name, file_format, datetime.datetime.now())
+        except Exception as e:
+            return JsonResponse({'status': 1, 'msg': f'数据字典导出失败，错误信息：{e}', 'data': []})
+        extension = WRITERS[file_format].extension
+        response = FileResponse(open(filename, 'rb'))
+        response['Content-Type'] = 'application/octet-stream'
+        response['Content-Disposition'] = \
+            f'attachment;filename="{urlquote(instance_name)}_{urlquote(db_name)}.{extension}"'
+        return response
+    # 管理员可以导出整个实例的字典信息，后台异步执行
     elif request.user.is_superuser:
-        dbs = query_engine.get_all_databases().rows
+        export_id = uuid.uuid4().hex
+        _set_progress(export_id, username=request.user.username, instance_name=instance_name, format=file_format,
+                      status='waiting', total=0, finished=0, tables=0, failed=[], msg='',
+                      create_time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        async_task(export_dictionary, export_id=export_id, instance_id=instance.id, db_names=None,
+                   file_format=file_format, timeout=-1, task_name=f'data-dictionary-export-{export_id}')
+        return JsonResponse({'status': 0, 'msg': f'实例{instance_name}数据字典导出任务已提交，完成后请到downloads目录下载！',
+                             'data': {'export_id': export_id}})
     else:
         return JsonResponse({'status': 1, 'msg': f'仅管理员可以导出整个实例的字典信息！', 'data': []})
 
-    # 获取数据，存入目录
-    path = os.path.join(settings.BASE_DIR, 'downloads/dictionary')
-    os.makedirs(path, exist_ok=True)
-    for db in dbs:
-        sql_tbs = f"SELECT * FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA='{db}';"
-        tbs = query_engine.query(sql=sql_tbs, cursorclass=MySQLdb.cursors.DictCursor, close_conn=False).rows
-        table_metas = []
-        for tb in tbs:
-            _meta = dict()
-            _meta['TABLE_INFO'] = tb
-            sql_cols = f"""SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_SCHEMA='{tb['TABLE_SCHEMA']}' AND TABLE_NAME='{tb['TABLE_NAME']}';"""
-            _meta['COLUMNS'] = query_engine.query(sql=sql_cols,
-                                                  cursorclass=MySQLdb.cursors.DictCursor, close_conn=False).rows
-            table_metas.append(_meta)
-        data = Template(html).render(db_name=db, tables=table_metas, export_time=datetime.datetime.now())
-        with open(f'{path}/{instance_name}_{db}.html', 'w') as f:
-            f.write(data)
-    # 关闭连接
-    query_engine.close()
-    if db_name:
-        response = FileResponse(open(f'{path}/{instance_name}_{db_name}.html', 'rb'))
-        response['Content-Type'] = 'application/octet-stream'
-        response['Content-Disposition'] = f'attachment;filename="{urlquote(instance_name)}_{urlquote(db_name)}.html"'
-        return response
 
-    else:
-        return JsonResponse({'status': 0, 'msg': f'实例{instance_name}数据字典导出成功，请到downloads目录下载！', 'data': []})
+@permission_required('sql.data_dictionary_export', raise_exception=True)
+def export_status(request):
+    """获取实例数据字典导出进度"""
+    progress = get_progress(request.GET.get('export_id', ''))
+    if not progress or (progress['username'] != request.user.username and not request.user.is_superuser):
+        return JsonResponse({'status': 1, 'msg': '导出任务不存在或已过期', 'data': {}})
+    return JsonResponse({'status': 0, 'msg': 'ok', 'data': progress})
@@ -1,5 +1,7 @@
 """engine base库, 包含一个``EngineBase`` class和一个get_engine函数"""
+from common.config import SysConfig
 from sql.engines.models import ResultSet
+from sql.engines.pool import get_pool
 
 
 class EngineBase:
@@ -7,7 +9,10 @@ class EngineBase:
 
     def __init__(self, instance=None):
         self.conn = None
+        self.pool = None
         self.thread_id = None
+        # 连接状态不可复用(如流式查询结果集未读完)时置为True, 关闭时不再归还连接池
+        self.discard_conn = False
         if instance:
             self.instance = instance
             self.instance_name = instance.instance_name
@@ -19,6 +24,40 @@ class EngineBase:
     def get_connection(self, db_name=None):
         """返回一个conn实例"""
 
+    def get_pooled_connection(self, db_name=None):
+        """从实例+数据库维度的连接池获取conn实例, engine_pool_size配置为0时不使用连接池"""
+        config = SysConfig()
+        pool_size = int(config.get('engine_pool_size', 5))
+        if pool_size <= 0:
+            return self._connect(db_name=db_name)
+        self.pool = get_pool(self.instance, db_name, engine_class=type(self),
+                             max_size=pool_size,
+                             max_idle_time=int(config.get('engine_pool_idle_time', 300)))
+        return self.pool.acquire()
+
+    def _connect(self, db_name=None):
+        """新建一个conn实例, 供连接池调用"""
+        raise NotImplementedError
+
+    def _ping_connection(self, conn):
+        """连接存活检测, 连接不可用时抛出异常"""
+        conn.cursor().execute('select 1')
+
+    def _reset_connection(self, conn):
+        """连接归还连接池前重置会话状态"""
+        conn.rollback()
+
+    def close(self, discard=False):
+        """关闭连接, 连接池获取的连接会归还给连接池, discard=True或discard_conn时直接关闭"""
+        if self.conn:
+            if self.pool:
+                self.pool.release(self.conn, discard=discard or self.discard_conn)
+            else:
+                self.conn.close()
+            self.conn = None
+            self.pool = None
+        self.discard_conn = False
+
     @property
     def name(self):
         """返回engine名称"""
@@ -47,6 +86,13 @@ class EngineBase:
     def kill_connection(self, thread_id):
         """终止数据库连接"""
 
+    def set_query_timeout(self, seconds):
+        """
+        在当前连接上设置原生的语句执行超时，归还连接池时由_reset_connection恢复
+        :return: 设置成功返回True，不支持时返回False，由调用方通过kill_connection终止
+        """
+        return False
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet，rows=list"""
         return ResultSet()
@@ -59,6 +105,10 @@ class EngineBase:
         """获取所有字段, 返回一个ResultSet，rows=list"""
         return ResultSet()
 
+    def get_all_columns(self, db_name):
+        """批量获取库内全部表的字段, 返回一个ResultSet，rows=[(schema名, 表名, 字段名)]，按表和字段顺序排列"""
+        return ResultSet()
+
     def describe_table(self, db_name, tb_name):
         """获取表结构, 返回一个 ResultSet，rows=list"""
         return ResultSet()
@@ -78,6 +128,18 @@ class EngineBase:
         返回一个脱敏后的结果集"""
         return resultset
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, chunk_size=1000, close_conn=True, **kwargs):
+        """流式查询, 返回一个生成器, 每次产出一个包含chunk_size行以内的ResultSet, 第一批一定会产出
+        默认实现为一次性查询后整体产出, 支持服务端游标的引擎可重写以控制内存占用
+        close_conn=False时结束后不关闭连接, 由调用方(QuerySession)取消超时监控后再关闭"""
+        yield self.query(db_name=db_name, sql=sql, limit_num=limit_num, close_conn=close_conn, **kwargs)
+
+    def query_masking_stream(self, db_name=None, sql='', resultsets=None):
+        """传入 sql语句, db名, 分批结果集生成器,
+        返回一个逐批脱敏的生成器"""
+        for resultset in resultsets:
+            yield self.query_masking(db_name, sql, resultset)
+
     def execute_check(self, db_name=None, sql=''):
         """执行语句的检查 返回一个ReviewSet"""
 
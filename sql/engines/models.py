@@ -98,6 +98,8 @@ class ResultSet:
         # rows 为普通列表
         self.rows = rows or []
         self.column_list = column_list if column_list else []
+        # 字段类型名，与column_list一一对应，未获取时为空
+        self.column_type = kwargs.get('column_type') or []
         self.status = status
         self.affected_rows = affected_rows
 
@@ -1,5 +1,8 @@
 # -*- coding: UTF-8 -*-
+import os
 import re
+import threading
+
 import pymongo
 import logging
 import traceback
@@ -13,13 +16,102 @@ __author__ = 'jackie'
 
 logger = logging.getLogger('default')
 
+# 进程内MongoClient缓存，MongoClient自带连接池且线程安全，每个实例共用一个
+# key为实例id，实例信息变更(update_time变化)或fork后重建
+_clients = {}
+_clients_lock = threading.Lock()
+
+# 支持的查询命令，find后可链式调用sort、skip、limit
+QUERY_METHODS = ('find', 'aggregate', 'count', 'countDocuments')
+FIND_CHAIN_METHODS = ('sort', 'skip', 'limit')
+# 会写入数据的聚合阶段
+WRITE_STAGES = ('$out', '$merge')
+
+
+def clear_clients():
+    """关闭并清空所有缓存的MongoClient"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for _, _, client in clients:
+        client.close()
+
+
+def _scan_args(sql, start):
+    """从左括号位置start开始查找匹配的右括号，忽略字符串内的括号，返回右括号位置"""
+    depth = 0
+    quote = None
+    i = start
+    while i < len(sql):
+        c = sql[i]
+        if quote:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in ('"', "'"):
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError('括号不匹配')
+
+
+def parse_command(sql):
+    """
+    解析查询命令，如 collection.find({"id": 1}, {"name": 1}).sort({"id": -1}).skip(10).limit(5)
+    参数为JSON或MongoDB Extended JSON
+    :return: (集合名, [(方法名, 参数列表), ...])
+    """
+    sql = sql.strip().rstrip(';').strip()
+    match = re.match(r'^([^.(]+)\.', sql)
+    if not match:
+        raise ValueError('缺少集合名')
+    collection = match.group(1).strip()
+    calls = []
+    pos = match.end()
+    while True:
+        call = re.compile(r'\s*(\w+)\s*\(').match(sql, pos)
+        if not call:
+            raise ValueError(f'无法解析的命令：{sql[pos:]}')
+        end = _scan_args(sql, call.end() - 1)
+        args = sql[call.end():end].strip()
+        calls.append((call.group(1), json_util.loads(f'[{args}]') if args else []))
+        pos = end + 1
+        rest = sql[pos:].strip()
+        if not rest:
+            break
+        if not rest.startswith('.'):
+            raise ValueError(f'无法解析的命令：{rest}')
+        pos = sql.index('.', pos) + 1
+    return collection, calls
+
 
 class MongoEngine(EngineBase):
+    def _connect(self, db_name=None):
+        kwargs = {'username': self.user, 'password': self.password, 'authSource': 'admin'} \
+            if self.user and self.password else {}
+        return pymongo.MongoClient(self.host, self.port, connect=True, connectTimeoutMS=10000,
+                                   serverSelectionTimeoutMS=10000, **kwargs)
+
     def get_connection(self, db_name=None):
-        conn = pymongo.MongoClient(self.host, self.port, connect=True, connectTimeoutMS=10000)
-        if self.user and self.password:
-            conn.admin.authenticate(self.user, self.password)
-        return conn
+        """返回实例共用的MongoClient，调用方无需关闭"""
+        key = self.instance.id
+        version = (self.instance.update_time, os.getpid())
+        with _clients_lock:
+            entry = _clients.get(key)
+            if entry and entry[:2] == version:
+                return entry[2]
+            client = self._connect()
+            _clients[key] = (*version, client)
+        # 实例信息变更后关闭旧的client，fork出的子进程不能关闭父进程的client
+        if entry and entry[1] == os.getpid():
+            entry[2].close()
+        return client
 
     @property
     def name(self):  # pragma: no cover
@@ -38,15 +130,25 @@ class MongoEngine(EngineBase):
     def query_check(self, db_name=None, sql=''):
         """提交查询前的检查"""
         result = {'msg': '', 'bad_query': True, 'filtered_sql': sql, 'has_star': False}
-        safe_cmd = ['find']
-        sql = sql.split('.')[1]
-        for cmd in safe_cmd:
-            if re.match(fr'^{cmd}\(.*', sql.strip(), re.I):
-                result['bad_query'] = False
-                break
+        try:
+            _, calls = parse_command(sql)
+        except Exception as e:
+            calls = []
+            logger.debug(f'Mongo命令解析失败：{e}')
+        method = calls[0][0] if calls else None
+        if method in QUERY_METHODS:
+            if method == 'find':
+                result['bad_query'] = any(name not in FIND_CHAIN_METHODS for name, _ in calls[1:])
+            elif method == 'aggregate':
+                stages = calls[0][1][0] if calls[0][1] else []
+                result['bad_query'] = len(calls) > 1 or any(
+                    stage in WRITE_STAGES for item in stages if isinstance(item, dict) for stage in item)
+            else:
+                result['bad_query'] = len(calls) > 1
         if result['bad_query']:
-            result['msg'] = """禁止执行该命令！正确格式为：{collection_name}.find() or {collection_name}.find(expression)""", \
-                            """如 : 'test.find({"id":{"$gt":1.0}})'"""
+            result['msg'] = """禁止执行该命令！支持的格式为：{collection_name}.find(filter, projection).sort(sort).skip(n).limit(n)、""" \
+                            """{collection_name}.aggregate(pipeline)、{collection_name}.count(filter)，""" \
+                            """如 : 'test.find({"id":{"$gt":1.0}})'，aggregate不支持$out、$merge"""
         return result
 
     def get_all_tables(self, db_name):
@@ -56,24 +158,48 @@ class MongoEngine(EngineBase):
         result.rows = db.list_collection_names()
         return result
 
+    @staticmethod
+    def _find(collect, calls, limit_num):
+        args = calls[0][1]
+        cursor = collect.find(args[0] if args else {}, args[1] if len(args) > 1 else None)
+        for name, args in calls[1:]:
+            if name == 'sort':
+                cursor = cursor.sort(list(args[0].items()))
+            elif name == 'skip':
+                cursor = cursor.skip(int(args[0]))
+            elif name == 'limit' and int(args[0]) > 0:
+                limit_num = min(int(args[0]), limit_num) if limit_num > 0 else int(args[0])
+        return cursor.limit(limit_num)
+
+    @staticmethod
+    def _aggregate(collect, calls, limit_num):
+        pipeline = list(calls[0][1][0]) if calls[0][1] else []
+        # limit下推到服务端
+        if limit_num > 0:
+            pipeline.append({'$limit': limit_num})
+        return collect.aggregate(pipeline)
+
     def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
         result_set = ResultSet(full_sql=sql)
+        limit_num = int(limit_num)
         try:
             conn = self.get_connection()
             db = conn[db_name]
-            collect = db[sql.split('.')[0]]
-            match = re.compile(r'[(](.*)[)]', re.S)
-            sql = re.findall(match, sql)[0]
-            if sql != '':
-                sql = json.loads(sql)
-                result = collect.find(sql).limit(limit_num)
+            collection, calls = parse_command(sql)
+            collect = db[collection]
+            method = calls[0][0]
+            if method == 'find':
+                docs = self._find(collect, calls, limit_num)
+            elif method == 'aggregate':
+                docs = self._aggregate(collect, calls, limit_num)
             else:
-                result = collect.find(sql).limit(limit_num)
-            rows = json.loads(json_util.dumps(result))
+                args = calls[0][1]
+                docs = [{'count': collect.count_documents(args[0] if args else {})}]
+            # 单次序列化，BSON类型由json_util.default转换
             result_set.column_list = ['Result']
-            if isinstance(rows, list):
-                result_set.rows = tuple([json.dumps(x, ensure_ascii=False)] for x in rows)
-                result_set.affected_rows = len(rows)
+            result_set.rows = tuple([json.dumps(doc, default=json_util.default, ensure_ascii=False)]
+                                    for doc in docs)
+            result_set.affected_rows = len(result_set.rows)
         except Exception as e:
             logger.warning(f"Mongo命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
             result_set.error = str(e)
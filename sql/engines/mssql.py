@@ -7,7 +7,7 @@ import sqlparse
 from . import EngineBase
 import pyodbc
 from .models import ResultSet, ReviewSet, ReviewResult
-from sql.utils.data_masking import brute_mask
+from sql.utils.data_masking import brute_mask, column_type_name
 from common.config import SysConfig
 
 logger = logging.getLogger('default')
@@ -15,14 +15,28 @@ logger = logging.getLogger('default')
 
 class MssqlEngine(EngineBase):
     def get_connection(self, db_name=None):
-        connstr = """DRIVER=ODBC Driver 17 for SQL Server;SERVER={0},{1};UID={2};PWD={3};
-client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self.port, self.user, self.password,
-                                                                 self.instance.charset or 'UTF8')
         if self.conn:
             return self.conn
-        self.conn = pyodbc.connect(connstr)
+        # 查询时通过use [db]切换数据库，连接池不区分数据库
+        self.conn = self.get_pooled_connection()
         return self.conn
 
+    def _connect(self, db_name=None):
+        connstr = """DRIVER=ODBC Driver 17 for SQL Server;SERVER={0},{1};UID={2};PWD={3};
+client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self.port, self.user, self.password,
+                                                                 self.instance.charset or 'UTF8')
+        return pyodbc.connect(connstr)
+
+    def _reset_connection(self, conn):
+        # 回滚未结束的事务并恢复set_query_timeout设置的超时
+        conn.rollback()
+        conn.timeout = 0
+
+    def set_query_timeout(self, seconds):
+        """通过ODBC的查询超时限制语句执行时间，超时后驱动取消语句"""
+        self.get_connection().timeout = int(seconds)
+        return True
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet"""
         sql = "SELECT name FROM master.sys.databases"
@@ -136,6 +150,7 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
             fields = cursor.description
 
             result_set.column_list = [i[0] for i in fields] if fields else []
+            result_set.column_type = [column_type_name(i[1]) for i in fields] if fields else []
             result_set.rows = [tuple(x) for x in rows]
             result_set.affected_rows = len(result_set.rows)
         except Exception as e:
@@ -245,10 +260,5 @@ client charset = UTF-8;connect timeout=10;CHARSET={4};""".format(self.host, self
         else:
             cursor.commit()
         if close_conn:
-            self.close()
+            self.close(discard=True)
         return execute_result
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
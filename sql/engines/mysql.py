@@ -11,34 +11,72 @@ from sql.utils.sql_utils import get_syntax_type, remove_comments
 from . import EngineBase
 from .models import ResultSet, ReviewResult, ReviewSet
 from .inception import InceptionEngine
-from sql.utils.data_masking import data_masking
+from .session import validated_sql_cache
+from sql.utils.data_masking import data_masking, data_masking_stream
 from common.config import SysConfig
 
 logger = logging.getLogger('default')
 
+# 不支持max_execution_time的实例(MariaDB、MySQL 5.7.8以下)，key为 (实例id, 实例更新时间)
+_timeout_unsupported = set()
+
 
 class MysqlEngine(EngineBase):
+    # 本次使用连接期间要求的max_execution_time，单位毫秒，None为未设置
+    query_timeout = None
 
     def get_connection(self, db_name=None):
-        # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
-        conversions = MySQLdb.converters.conversions
-        conversions[FIELD_TYPE.BIT] = lambda data: data == b'\x01'
         if self.conn:
             self.thread_id = self.conn.thread_id()
             return self.conn
-        if db_name:
-            self.conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
-                                        db=db_name, charset=self.instance.charset or 'utf8mb4',
-                                        conv=conversions,
-                                        connect_timeout=10)
-        else:
-            self.conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
-                                        charset=self.instance.charset or 'utf8mb4',
-                                        conv=conversions,
-                                        connect_timeout=10)
+        self.conn = self.get_pooled_connection(db_name=db_name)
         self.thread_id = self.conn.thread_id()
+        self.query_timeout = None
         return self.conn
 
+    def _connect(self, db_name=None):
+        # https://stackoverflow.com/questions/19256155/python-mysqldb-returning-x01-for-bit-values
+        conversions = MySQLdb.converters.conversions
+        conversions[FIELD_TYPE.BIT] = lambda data: data == b'\x01'
+        if db_name:
+            conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
+                                   db=db_name, charset=self.instance.charset or 'utf8mb4',
+                                   conv=conversions,
+                                   connect_timeout=10)
+        else:
+            conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password,
+                                   charset=self.instance.charset or 'utf8mb4',
+                                   conv=conversions,
+                                   connect_timeout=10)
+        # 连接上当前生效的max_execution_time，单位毫秒，None为默认值
+        conn.archery_max_execution_time = None
+        return conn
+
+    def _ping_connection(self, conn):
+        conn.ping()
+
+    def _reset_connection(self, conn):
+        conn.rollback()
+        # 在线查询的超时时间保留在连接上，下次查询无需重新设置，其他值恢复默认
+        applied = getattr(conn, 'archery_max_execution_time', None)
+        if applied is not None and applied != int(SysConfig().get('max_execution_time', 60)) * 1000:
+            self._set_max_execution_time(conn, None)
+
+    @staticmethod
+    def _set_max_execution_time(conn, milliseconds):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'set session max_execution_time={milliseconds if milliseconds else "default"}')
+        finally:
+            cursor.close()
+        conn.archery_max_execution_time = milliseconds or None
+
+    def _sync_query_timeout(self, conn, sql):
+        """未设置超时的select语句执行前，恢复连接上保留的max_execution_time"""
+        if self.query_timeout is None and getattr(conn, 'archery_max_execution_time', None) is not None \
+                and re.match(r'^\s*select', sql, re.I):
+            self._set_max_execution_time(conn, None)
+
     @property
     def name(self):
         return 'MySQL'
@@ -75,6 +113,26 @@ class MysqlEngine(EngineBase):
         """终止数据库连接"""
         self.query(sql=f'kill {thread_id}')
 
+    def set_query_timeout(self, seconds):
+        """
+        通过会话变量max_execution_time限制select语句执行时间，MySQL 5.7.8以上支持，MariaDB和低版本返回False
+        连接上已是相同的值时不再设置，不支持的实例记录后不再尝试
+        """
+        key = (self.instance.id, self.instance.update_time)
+        if key in _timeout_unsupported:
+            return False
+        conn = self.get_connection()
+        milliseconds = int(seconds) * 1000
+        if getattr(conn, 'archery_max_execution_time', None) != milliseconds:
+            try:
+                self._set_max_execution_time(conn, milliseconds)
+            except MySQLdb.Error as e:
+                logger.debug(f'实例不支持max_execution_time：{e}')
+                _timeout_unsupported.add(key)
+                return False
+        self.query_timeout = milliseconds
+        return True
+
     def get_all_databases(self):
         """获取数据库列表, 返回一个ResultSet"""
         sql = "show databases"
@@ -113,6 +171,95 @@ class MysqlEngine(EngineBase):
         result.rows = column_list
         return result
 
+    def get_all_columns(self, db_name):
+        """批量获取库内全部表的字段, 返回一个ResultSet"""
+        sql = f"""SELECT
+            TABLE_SCHEMA,
+            TABLE_NAME,
+            COLUMN_NAME
+        FROM
+            information_schema.COLUMNS
+        WHERE
+            TABLE_SCHEMA = '{db_name}'
+        ORDER BY TABLE_NAME, ORDINAL_POSITION;"""
+        return self.query(db_name=db_name, sql=sql)
+
+    def get_table_info(self, db_name, tb_name):
+        """
+        在同一连接上获取表的元数据、字段、索引和建表语句，供数据字典使用
+        :return: {'meta_data': {'column_list', 'rows'}, 'desc': {...}, 'index': {...}, 'create_sql': rows}
+        """
+        meta_sql = f"""SELECT
+            TABLE_NAME as table_name,
+            ENGINE as engine,
+            ROW_FORMAT as row_format,
+            TABLE_ROWS as table_rows,
+            AVG_ROW_LENGTH as avg_row_length,
+            round(DATA_LENGTH/1024, 2) as data_length,
+            MAX_DATA_LENGTH as max_data_length,
+            round(INDEX_LENGTH/1024, 2) as index_length,
+            round((DATA_LENGTH + INDEX_LENGTH)/1024, 2) as data_total,
+            DATA_FREE as data_free,
+            AUTO_INCREMENT as auto_increment,
+            TABLE_COLLATION as table_collation,
+            CREATE_TIME as create_time,
+            CHECK_TIME as check_time,
+            UPDATE_TIME as update_time,
+            TABLE_COMMENT as table_comment
+        FROM
+            information_schema.TABLES
+        WHERE
+            TABLE_SCHEMA='{db_name}'
+                AND TABLE_NAME='{tb_name}'"""
+        desc_sql = f"""SELECT
+            COLUMN_NAME as '列名',
+            COLUMN_TYPE as '列类型',
+            CHARACTER_SET_NAME as '列字符集',
+            IS_NULLABLE as '是否为空',
+            COLUMN_KEY as '索引列',
+            COLUMN_DEFAULT as '默认值',
+            EXTRA as '拓展信息',
+            COLUMN_COMMENT as '列说明'
+        FROM
+            information_schema.COLUMNS
+        WHERE
+            TABLE_SCHEMA = '{db_name}'
+                AND TABLE_NAME = '{tb_name}'
+        ORDER BY ORDINAL_POSITION;"""
+        index_sql = f"""SELECT
+            COLUMN_NAME as '列名',
+            INDEX_NAME as '索引名',
+            NON_UNIQUE as '唯一性',
+            SEQ_IN_INDEX as '列序列',
+            CARDINALITY as '基数',
+            NULLABLE as '是否为空',
+            INDEX_TYPE as '索引类型',
+            COMMENT as '备注'
+        FROM
+            information_schema.STATISTICS
+        WHERE
+            TABLE_SCHEMA = '{db_name}'
+        AND TABLE_NAME = '{tb_name}';"""
+        create_sql = f"show create table `{tb_name}`;"
+        data = {}
+        try:
+            for key, sql in (('meta_data', meta_sql), ('desc', desc_sql), ('index', index_sql),
+                             ('create_sql', create_sql)):
+                result = self.query(db_name=db_name, sql=sql, close_conn=False)
+                if result.error:
+                    raise RuntimeError(result.error)
+                if key == 'meta_data':
+                    if not result.rows:
+                        raise RuntimeError(f'表{tb_name}不存在')
+                    data[key] = {'column_list': result.column_list, 'rows': result.rows[0]}
+                elif key == 'create_sql':
+                    data[key] = result.rows
+                else:
+                    data[key] = {'column_list': result.column_list, 'rows': result.rows}
+        finally:
+            self.close()
+        return data
+
     def describe_table(self, db_name, tb_name):
         """return ResultSet 类似查询"""
         sql = f"show create table `{tb_name}`;"
@@ -125,6 +272,7 @@ class MysqlEngine(EngineBase):
         cursorclass = kwargs.get('cursorclass') or MySQLdb.cursors.Cursor
         try:
             conn = self.get_connection(db_name=db_name)
+            self._sync_query_timeout(conn, sql)
             cursor = conn.cursor(cursorclass)
             effect_row = cursor.execute(sql)
             if int(limit_num) > 0:
@@ -144,6 +292,45 @@ class MysqlEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, chunk_size=1000, close_conn=True, **kwargs):
+        """使用SSCursor流式读取结果集, 每次产出一个ResultSet"""
+        limit_num = int(limit_num)
+        # 结果集未读完的连接需要丢弃, 避免归还连接池时读取剩余数据
+        exhausted = False
+        try:
+            conn = self.get_connection(db_name=db_name)
+            self._sync_query_timeout(conn, sql)
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql)
+            fields = cursor.description
+            column_list = [i[0] for i in fields] if fields else []
+            fetched = 0
+            first = True
+            while True:
+                size = min(chunk_size, limit_num - fetched) if limit_num > 0 else chunk_size
+                rows = cursor.fetchmany(size=size) if size > 0 else ()
+                fetched += len(rows)
+                if len(rows) < size:
+                    exhausted = True
+                elif limit_num > 0 and fetched >= limit_num:
+                    exhausted = cursor.fetchone() is None
+                if rows or first:
+                    yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, affected_rows=len(rows))
+                    first = False
+                if fetched >= limit_num > 0 or exhausted:
+                    break
+        except Exception as e:
+            logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            # 结果集未读完的连接不能再复用
+            if not exhausted:
+                self.discard_conn = True
+            if close_conn:
+                self.close()
+
     def query_check(self, db_name=None, sql=''):
         # 查询语句的检查、注释去除、切分
         result = {'msg': '', 'bad_query': False, 'filtered_sql': sql, 'has_star': False}
@@ -161,12 +348,15 @@ class MysqlEngine(EngineBase):
         if '*' in sql:
             result['has_star'] = True
             result['msg'] = 'SQL语句中含有 * '
-        # select语句先使用Explain判断语法是否正确
-        if re.match(r"^select", sql, re.I):
-            explain_result = self.query(db_name=db_name, sql=f"explain {sql}")
+        # select语句先使用Explain判断语法是否正确，已校验通过的语句直接跳过
+        if re.match(r"^select", sql, re.I) and not validated_sql_cache.hit(self.instance, db_name, sql):
+            # 已持有连接(查询会话中)时复用且不关闭
+            explain_result = self.query(db_name=db_name, sql=f"explain {sql}", close_conn=self.conn is None)
             if explain_result.error:
                 result['bad_query'] = True
                 result['msg'] = explain_result.error
+            else:
+                validated_sql_cache.add(self.instance, db_name, sql)
         return result
 
     def filter_sql(self, sql='', limit_num=0):
@@ -201,6 +391,14 @@ class MysqlEngine(EngineBase):
             mask_result = resultset
         return mask_result
 
+    def query_masking_stream(self, db_name=None, sql='', resultsets=None):
+        """传入 sql语句, db名, 分批结果集生成器,
+        返回一个逐批脱敏的生成器, 语法树仅解析一次"""
+        # 仅对select语句脱敏
+        if re.match(r"^select", sql, re.I):
+            return data_masking_stream(self.instance, db_name, sql, resultsets)
+        return resultsets
+
     def execute_check(self, db_name=None, sql=''):
         """上线单执行前的检查, 返回Review set"""
         config = SysConfig()
@@ -308,8 +506,9 @@ class MysqlEngine(EngineBase):
         except Exception as e:
             logger.warning(f"MySQL语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
             result.error = str(e)
+        # 原生执行的语句可能修改会话状态，连接不再归还连接池
         if close_conn:
-            self.close()
+            self.close(discard=True)
         return result
 
     def get_rollback(self, workflow):
@@ -342,8 +541,3 @@ class MysqlEngine(EngineBase):
         else:
             inception_engine = InceptionEngine()
             return inception_engine.osc_control(**kwargs)
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
@@ -11,10 +11,13 @@ from sql.utils.sql_utils import get_syntax_type
 from . import EngineBase
 import cx_Oracle
 from .models import ResultSet, ReviewSet, ReviewResult
-from sql.utils.data_masking import brute_mask
+from sql.utils.data_masking import brute_mask, column_type_name
 
 logger = logging.getLogger('default')
 
+# 每次网络往返读取的最大行数
+MAX_ARRAYSIZE = 1000
+
 
 class OracleEngine(EngineBase):
 
@@ -26,15 +29,40 @@ class OracleEngine(EngineBase):
     def get_connection(self, db_name=None):
         if self.conn:
             return self.conn
+        # 查询时通过CURRENT_SCHEMA切换schema，连接池不区分schema
+        self.conn = self.get_pooled_connection()
+        return self.conn
+
+    def _connect(self, db_name=None):
         if self.sid:
             dsn = cx_Oracle.makedsn(self.host, self.port, self.sid)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         elif self.service_name:
             dsn = cx_Oracle.makedsn(self.host, self.port, service_name=self.service_name)
-            self.conn = cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
         else:
             raise ValueError('sid 和 dsn 均未填写, 请联系管理页补充该实例配置.')
-        return self.conn
+        return cx_Oracle.connect(self.user, self.password, dsn=dsn, encoding="UTF-8", nencoding="UTF-8")
+
+    def _ping_connection(self, conn):
+        conn.ping()
+
+    def _reset_connection(self, conn):
+        # 回滚未结束的事务并将CURRENT_SCHEMA恢复为登录用户
+        conn.rollback()
+        conn.cursor().execute(f"ALTER SESSION SET CURRENT_SCHEMA = {self.user}")
+        try:
+            conn.callTimeout = 0
+        except (AttributeError, cx_Oracle.Error):
+            pass
+
+    def set_query_timeout(self, seconds):
+        """通过callTimeout限制每次数据库调用的时间，需要Oracle Client 18以上"""
+        conn = self.get_connection()
+        try:
+            conn.callTimeout = int(seconds) * 1000
+        except (AttributeError, cx_Oracle.Error) as e:
+            logger.debug(f'Oracle Client不支持callTimeout：{e}')
+            return False
+        return True
 
     @property
     def name(self):
@@ -146,39 +174,76 @@ class OracleEngine(EngineBase):
             result['msg'] = keyword_warning
         return result
 
+    def _fetch_first_supported(self):
+        """12c开始支持FETCH FIRST n ROWS ONLY，仅在已持有连接时获取版本号，不额外建立连接"""
+        if not self.conn:
+            return False
+        try:
+            return int(self.server_version[0]) >= 12
+        except Exception as e:
+            logger.debug(f'获取Oracle版本失败：{e}')
+            return False
+
     def filter_sql(self, sql='', limit_num=0):
         sql_lower = sql.lower()
         # 对查询sql增加limit限制
         if re.match(r"^select", sql_lower):
-            if sql_lower.find(' rownum ') == -1:
+            # 语句中已有FETCH/OFFSET子句时不再追加，由fetchmany限制返回行数
+            if self._fetch_first_supported():
+                if re.search(r"\bfetch\s+(first|next)\b|\boffset\s+\S+\s+rows?\b", sql_lower) is None:
+                    return f"{sql.strip().rstrip(';')} FETCH FIRST {limit_num} ROWS ONLY"
+            elif sql_lower.find(' rownum ') == -1:
                 if sql_lower.find('where') == -1:
                     return f"{sql.rstrip(';')} WHERE ROWNUM <= {limit_num}"
                 else:
                     return f"{sql.rstrip(';')} AND ROWNUM <= {limit_num}"
         return sql.strip()
 
+    @staticmethod
+    def _output_type_handler(cursor, name, default_type, size, precision, scale):
+        """CLOB/NCLOB/BLOB直接按字符串/字节读取，避免逐个LOB调用read的网络往返"""
+        if default_type in (cx_Oracle.CLOB, cx_Oracle.NCLOB):
+            return cursor.var(cx_Oracle.LONG_STRING, arraysize=cursor.arraysize)
+        if default_type == cx_Oracle.BLOB:
+            return cursor.var(cx_Oracle.LONG_BINARY, arraysize=cursor.arraysize)
+
+    def _query_cursor(self, conn, db_name, sql, arraysize):
+        cursor = conn.cursor()
+        cursor.arraysize = arraysize
+        # prefetchrows需要cx_Oracle 8以上，多预取一行使limit内的结果一次往返读完
+        if hasattr(cursor, 'prefetchrows'):
+            cursor.prefetchrows = arraysize + 1
+        cursor.outputtypehandler = self._output_type_handler
+        if db_name:
+            cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
+        cursor.execute(sql)
+        return cursor
+
+    @staticmethod
+    def _read_lobs(rows):
+        """BFILE等未被outputtypehandler处理的LOB在此读取"""
+        if rows and any(isinstance(c, cx_Oracle.LOB) for c in rows[0]):
+            return [tuple([(c.read() if isinstance(c, cx_Oracle.LOB) else c) for c in r]) for r in rows]
+        return [tuple(r) for r in rows]
+
     def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
-        """返回 ResultSet """
+        """返回 ResultSet，仅读取limit_num行"""
         result_set = ResultSet(full_sql=sql)
+        limit_num = int(limit_num)
         try:
             conn = self.get_connection()
-            cursor = conn.cursor()
-            if db_name:
-                cursor.execute(f"ALTER SESSION SET CURRENT_SCHEMA = {db_name}")
-            cursor.execute(sql)
+            arraysize = min(limit_num, MAX_ARRAYSIZE) if limit_num > 0 else MAX_ARRAYSIZE
+            cursor = self._query_cursor(conn, db_name, sql, arraysize)
             fields = cursor.description
-            if any(x[1] == cx_Oracle.CLOB for x in fields):
-                rows = [tuple([(c.read() if type(c) == cx_Oracle.LOB else c) for c in r]) for r in cursor]
-                if int(limit_num) > 0:
-                    rows = rows[0:int(limit_num)]
+            if limit_num > 0:
+                rows = cursor.fetchmany(limit_num)
             else:
-                if int(limit_num) > 0:
-                    rows = cursor.fetchmany(int(limit_num))
-                else:
-                    rows = cursor.fetchall()
+                rows = cursor.fetchall()
+            cursor.close()
 
             result_set.column_list = [i[0] for i in fields] if fields else []
-            result_set.rows = [tuple(x) for x in rows]
+            result_set.column_type = [column_type_name(i[1]) for i in fields] if fields else []
+            result_set.rows = self._read_lobs(rows)
             result_set.affected_rows = len(result_set.rows)
         except Exception as e:
             logger.warning(f"Oracle 语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
@@ -188,6 +253,37 @@ class OracleEngine(EngineBase):
                 self.close()
         return result_set
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, chunk_size=1000, close_conn=True, **kwargs):
+        """按chunk_size分批读取结果集, 每次产出一个ResultSet"""
+        limit_num = int(limit_num)
+        try:
+            conn = self.get_connection()
+            cursor = self._query_cursor(conn, db_name, sql, min(chunk_size, MAX_ARRAYSIZE))
+            fields = cursor.description
+            column_list = [i[0] for i in fields] if fields else []
+            column_type = [column_type_name(i[1]) for i in fields] if fields else []
+            fetched = 0
+            first = True
+            while True:
+                size = min(chunk_size, limit_num - fetched) if limit_num > 0 else chunk_size
+                rows = self._read_lobs(cursor.fetchmany(size)) if size > 0 else []
+                fetched += len(rows)
+                if rows or first:
+                    yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, column_type=column_type,
+                                    affected_rows=len(rows))
+                    first = False
+                if len(rows) < size or fetched >= limit_num > 0:
+                    break
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"Oracle 语句执行报错，语句：{sql}，错误信息{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            if close_conn:
+                self.close()
+
     def query_masking(self, schema_name=None, sql='', resultset=None):
         """传入 sql语句, db名, 结果集,
         返回一个脱敏后的结果集"""
@@ -301,10 +397,5 @@ class OracleEngine(EngineBase):
                 line += 1
         finally:
             if close_conn:
-                self.close()
+                self.close(discard=True)
         return execute_result
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
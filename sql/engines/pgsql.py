@@ -6,7 +6,10 @@
 @time: 2019/03/29
 """
 import re
+import uuid
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql as pg_sql
 import logging
 import traceback
 import sqlparse
@@ -22,14 +25,57 @@ __author__ = 'hhyo、yyukai'
 logger = logging.getLogger('default')
 
 
+class PgConnection(psycopg2.extensions.connection):
+    """记录会话当前的search_path和超时设置，切换schema时不需要重置或重建连接"""
+    search_path = None
+    timeout_changed = False
+
+
 class PgSQLEngine(EngineBase):
     def get_connection(self, db_name=None):
         if self.conn:
             return self.conn
-        self.conn = psycopg2.connect(host=self.host, port=self.port, user=self.user,
-                                     password=self.password, dbname=db_name)
+        self.conn = self.get_pooled_connection(db_name=db_name)
         return self.conn
 
+    def _connect(self, db_name=None):
+        return psycopg2.connect(host=self.host, port=self.port, user=self.user,
+                                password=self.password, dbname=db_name, connection_factory=PgConnection)
+
+    def _reset_connection(self, conn):
+        # 回滚未结束的事务，search_path保留在会话中，下次使用时按需切换
+        conn.rollback()
+        if conn.timeout_changed:
+            conn.cursor().execute('RESET statement_timeout;')
+            conn.commit()
+            conn.timeout_changed = False
+
+    @staticmethod
+    def _set_search_path(conn, schema_name=None):
+        """
+        切换会话的search_path，与当前一致时不执行，schema_name为空时恢复默认值
+        SET在事务回滚时会失效，因此设置后立即提交，调用时连接上不能有未提交的修改
+        """
+        if conn.search_path == schema_name:
+            return
+        cursor = conn.cursor()
+        if schema_name:
+            cursor.execute(pg_sql.SQL('SET search_path TO {};').format(pg_sql.Identifier(schema_name)))
+        else:
+            cursor.execute('RESET search_path;')
+        cursor.close()
+        conn.commit()
+        conn.search_path = schema_name
+
+    def set_query_timeout(self, seconds):
+        """通过statement_timeout限制语句执行时间，归还连接池时恢复"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SET statement_timeout = {int(seconds) * 1000};')
+        cursor.close()
+        conn.timeout_changed = True
+        return True
+
     @property
     def name(self):
         return 'PgSQL'
@@ -92,6 +138,18 @@ class PgSQLEngine(EngineBase):
         result.rows = column_list
         return result
 
+    def get_all_columns(self, db_name):
+        """
+        批量获取库内全部schema的表字段
+        :param db_name:
+        :return:
+        """
+        sql = f"""SELECT table_schema, table_name, column_name
+        FROM information_schema.columns
+        where table_schema not in ('information_schema', 'pg_catalog', 'pg_toast_temp_1', 'pg_temp_1', 'pg_toast')
+        order by table_schema, table_name, ordinal_position;"""
+        return self.query(db_name=db_name, sql=sql)
+
     def describe_table(self, db_name, tb_name, schema_name=None):
         """
         获取表结构信息
@@ -142,16 +200,25 @@ class PgSQLEngine(EngineBase):
         result_set = ResultSet(full_sql=sql)
         try:
             conn = self.get_connection(db_name=db_name)
-            cursor = conn.cursor()
-            if schema_name:
-                cursor.execute(f"SET search_path TO {schema_name};")
-            cursor.execute(sql)
-            effect_row = cursor.rowcount
-            if int(limit_num) > 0:
-                rows = cursor.fetchmany(size=int(limit_num))
+            self._set_search_path(conn, schema_name)
+            limit_num = int(limit_num)
+            if limit_num > 0 and re.match(r"^\s*select", sql, re.I):
+                # 服务端命名游标只读取limit_num行，内存占用与结果集大小无关
+                cursor = conn.cursor(name=f'archery_{uuid.uuid4().hex}')
+                cursor.execute(sql)
+                rows = cursor.fetchmany(size=limit_num)
+                effect_row = len(rows)
             else:
-                rows = cursor.fetchall()
+                cursor = conn.cursor()
+                cursor.execute(sql)
+                effect_row = cursor.rowcount
+                if limit_num > 0:
+                    rows = cursor.fetchmany(size=limit_num)
+                else:
+                    rows = cursor.fetchall()
+            # 命名游标在第一次fetch后才有description
             fields = cursor.description
+            cursor.close()
 
             result_set.column_list = [i[0] for i in fields] if fields else []
             result_set.rows = rows
@@ -169,6 +236,43 @@ class PgSQLEngine(EngineBase):
             raise ValueError('db_name未填写,请检查参数')
         return self._query(db_name=db_name, sql=sql, limit_num=limit_num, schema_name=schema_name, close_conn=close_conn)
 
+    def query_stream(self, db_name=None, sql='', limit_num=0, chunk_size=1000, schema_name=None, close_conn=True,
+                     **kwargs):
+        """使用服务端命名游标流式读取结果集, 每次产出一个ResultSet"""
+        if not db_name:
+            raise ValueError('db_name未填写,请检查参数')
+        limit_num = int(limit_num)
+        try:
+            conn = self.get_connection(db_name=db_name)
+            self._set_search_path(conn, schema_name)
+            cursor = conn.cursor(name=f'archery_{uuid.uuid4().hex}')
+            cursor.itersize = chunk_size
+            cursor.execute(sql)
+            fetched = 0
+            first = True
+            while True:
+                size = min(chunk_size, limit_num - fetched) if limit_num > 0 else chunk_size
+                rows = cursor.fetchmany(size=size)
+                fetched += len(rows)
+                if rows or first:
+                    # 命名游标在第一次fetch后才有description
+                    fields = cursor.description
+                    column_list = [i[0] for i in fields] if fields else []
+                    yield ResultSet(full_sql=sql, rows=rows, column_list=column_list, affected_rows=len(rows))
+                    first = False
+                if len(rows) < size or fetched >= limit_num > 0:
+                    break
+            cursor.close()
+        except Exception as e:
+            logger.warning(f"PgSQL命令执行报错，语句：{sql}， 错误信息：{traceback.format_exc()}")
+            result_set = ResultSet(full_sql=sql)
+            result_set.error = str(e)
+            yield result_set
+        finally:
+            # 归还连接池时会回滚事务, 未读取完的命名游标随之释放
+            if close_conn:
+                self.close()
+
     def filter_sql(self, sql='', limit_num=0):
         # 对查询sql增加limit限制，# TODO limit改写待优化
         sql_lower = sql.lower().rstrip(';').strip()
@@ -240,6 +344,8 @@ class PgSQLEngine(EngineBase):
         db_name = workflow.db_name
         try:
             conn = self.get_connection(db_name=db_name)
+            # 连接池中的连接可能保留了查询时切换的search_path
+            self._set_search_path(conn)
             cursor = conn.cursor()
             # 逐条执行切分语句，追加到执行结果中
             for statement in split_sql:
@@ -285,11 +391,5 @@ class PgSQLEngine(EngineBase):
                 line += 1
         finally:
             if close_conn:
-                self.close()
+                self.close(discard=True)
         return execute_result
-
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+"""
+engine 连接池, 按 实例+数据库 维度缓存连接, 减少查询时的建连开销
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('default')
+
+# 进程内连接池注册表, key为 (实例id, 实例更新时间, 数据库名)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    单个实例+数据库的连接池
+    * acquire 时优先复用空闲连接, 复用前做存活检测, 超过空闲时间的连接直接关闭
+    * release 时重置会话状态, 超过max_size的连接直接关闭
+    * max_size只限制空闲连接数, 不限制同时打开的连接数, 并发超过max_size时多出的连接用完即关闭
+    """
+
+    def __init__(self, connect, ping=None, reset=None, max_size=5, max_idle_time=300):
+        """
+        :param connect: 新建连接的函数
+        :param ping: 存活检测函数, 入参为连接, 连接不可用时抛出异常
+        :param reset: 会话重置函数, 入参为连接, 归还连接时调用
+        :param max_size: 最大空闲连接数
+        :param max_idle_time: 空闲连接最长保留时间, 单位秒
+        """
+        self._connect = connect
+        self._ping = ping
+        self._reset = reset
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self):
+        """获取连接"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    self.misses += 1
+                    break
+                conn, released_at = self._idle.pop()
+            # 空闲超时的连接直接关闭
+            if time.time() - released_at > self.max_idle_time:
+                self._close(conn)
+                continue
+            # 存活检测
+            try:
+                if self._ping:
+                    self._ping(conn)
+            except Exception as e:
+                logger.debug(f'连接池连接存活检测失败，关闭连接：{e}')
+                self._close(conn)
+                continue
+            with self._lock:
+                self.hits += 1
+            return conn
+        return self._connect()
+
+    def release(self, conn, discard=False):
+        """归还连接，discard=True时直接关闭"""
+        if not discard:
+            try:
+                if self._reset:
+                    self._reset(conn)
+            except Exception as e:
+                logger.debug(f'连接池连接会话重置失败，关闭连接：{e}')
+                discard = True
+        if not discard:
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    def configure(self, max_size, max_idle_time):
+        """修改连接池配置, 超出新max_size的空闲连接直接关闭"""
+        with self._lock:
+            self.max_size = max_size
+            self.max_idle_time = max_idle_time
+            excess = []
+            while len(self._idle) > max_size:
+                excess.append(self._idle.popleft())
+        for conn, _ in excess:
+            self._close(conn)
+
+    def evict_idle(self):
+        """关闭全部超过空闲时间的连接"""
+        now = time.time()
+        with self._lock:
+            expired = [item for item in self._idle if now - item[1] > self.max_idle_time]
+            self._idle = deque(item for item in self._idle if now - item[1] <= self.max_idle_time)
+        for conn, _ in expired:
+            self._close(conn)
+
+    def clear(self):
+        """关闭全部空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    @property
+    def idle_size(self):
+        return len(self._idle)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'idle': self.idle_size,
+                'max_size': self.max_size, 'max_idle_time': self.max_idle_time}
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f'连接池关闭连接报错：{e}')
+
+
+def _engine_callbacks(engine_class, instance, db_name):
+    """
+    使用连接池专用的engine对象建连、检测和重置连接
+    不引用首次调用方的engine，避免其随连接池常驻进程
+    """
+    engine = engine_class(instance=instance)
+    return {'connect': lambda: engine._connect(db_name=db_name),
+            'ping': engine._ping_connection,
+            'reset': engine._reset_connection}
+
+
+def get_pool(instance, db_name=None, engine_class=None, max_size=5, max_idle_time=300, **kwargs):
+    """
+    获取实例+数据库对应的连接池，不存在则新建
+    实例信息修改后update_time会变化，旧连接池会被清理
+    :param instance: 实例对象
+    :param db_name: 数据库名
+    :param engine_class: engine类，新建连接池时用于建连、检测和重置连接
+    :param max_size: 最大空闲连接数，每次调用都会更新，配置修改后立即生效
+    :param max_idle_time: 空闲连接最长保留时间，每次调用都会更新
+    :param kwargs: 未指定engine_class时的ConnectionPool初始化参数connect、ping、reset
+    :return:
+    """
+    key = (instance.id, instance.update_time, db_name)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # 清理同一实例过期的连接池
+            stale_keys = [k for k in _pools if k[0] == instance.id and k[1] != instance.update_time]
+            for k in stale_keys:
+                _pools.pop(k).clear()
+            if engine_class:
+                kwargs.update(_engine_callbacks(engine_class, instance, db_name))
+            pool = _pools[key] = ConnectionPool(max_size=max_size, max_idle_time=max_idle_time, **kwargs)
+    if (pool.max_size, pool.max_idle_time) != (max_size, max_idle_time):
+        pool.configure(max_size, max_idle_time)
+    # 顺便淘汰空闲超时的连接
+    pool.evict_idle()
+    return pool
+
+
+def clear_pools(instance=None):
+    """关闭连接池中的空闲连接，instance为空时清理全部"""
+    with _pools_lock:
+        keys = [k for k in _pools if instance is None or k[0] == instance.id]
+        pools = [_pools.pop(k) for k in keys]
+    for pool in pools:
+        pool.clear()
+
+
+def pool_stats():
+    """连接池命中统计"""
+    with _pools_lock:
+        items = list(_pools.items())
+    return [dict(instance_id=k[0], db_name=k[2], **pool.stats()) for k, pool in items]
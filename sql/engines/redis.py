@@ -7,6 +7,9 @@
 """
 
 import re
+import shlex
+import threading
+
 import redis
 import logging
 import traceback
@@ -20,12 +23,61 @@ __author__ = 'hhyo'
 
 logger = logging.getLogger('default')
 
+# 进程内连接池缓存，key为(实例id, db)，实例信息变更(update_time变化)后重建
+# redis-py的ConnectionPool会检查pid，fork出的子进程自动丢弃父进程的连接
+_pools = {}
+_pools_lock = threading.Lock()
+
+# scan系列命令每次请求服务端的COUNT，用户未指定时使用
+SCAN_COUNT = 1000
+# 单个pipeline最多包含的命令数，避免一次请求长时间占用服务端
+PIPELINE_BATCH = 1000
+# scan系列命令的返回列名，第一行为下次迭代的游标
+SCAN_COLUMNS = {
+    'scan': ['Result', 'Type', 'TTL'],
+    'hscan': ['Result', 'Value'],
+    'sscan': ['Result'],
+    'zscan': ['Result', 'Score'],
+}
+# 整个key读取的命令，限制行数时改为对应的scan分批读取
+FULL_READ_COMMANDS = {'hgetall': 'hscan', 'smembers': 'sscan'}
+
+
+def clear_connection_pools():
+    """断开并清空所有缓存的连接池"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for _, pool in pools:
+        pool.disconnect()
+
+
+def _parse_scan_args(args):
+    """解析scan系列命令的 cursor [MATCH pattern] [COUNT count] [TYPE type]"""
+    cursor = int(args[0]) if args else 0
+    options = {}
+    for i in range(1, len(args) - 1, 2):
+        options[args[i].lower()] = args[i + 1]
+    return cursor, options.get('match'), int(options.get('count', SCAN_COUNT)), options.get('type')
+
 
 class RedisEngine(EngineBase):
     def get_connection(self, db_name=None):
-        db_name = db_name or 0
-        return redis.Redis(host=self.host, port=self.port, db=db_name, password=self.password,
-                           encoding_errors='ignore', decode_responses=True)
+        """返回使用实例连接池的客户端，调用方无需关闭"""
+        db_name = int(db_name or 0)
+        key = (self.instance.id, db_name)
+        with _pools_lock:
+            entry = _pools.get(key)
+            if entry and entry[0] == self.instance.update_time:
+                pool = entry[1]
+            else:
+                pool = redis.ConnectionPool(host=self.host, port=self.port, db=db_name, password=self.password,
+                                            encoding_errors='ignore', decode_responses=True)
+                _pools[key] = (self.instance.update_time, pool)
+        # 实例信息变更后断开旧连接池
+        if entry and entry[1] is not pool:
+            entry[1].disconnect()
+        return redis.Redis(connection_pool=pool)
 
     @property
     def name(self):
@@ -56,7 +108,7 @@ class RedisEngine(EngineBase):
     def query_check(self, db_name=None, sql='', limit_num=0):
         """提交查询前的检查"""
         result = {'msg': '', 'bad_query': True, 'filtered_sql': sql, 'has_star': False}
-        safe_cmd = ["scan", "exists", "ttl", "pttl", "type", "get", "mget", "strlen",
+        safe_cmd = ["scan", "hscan", "sscan", "zscan", "exists", "ttl", "pttl", "type", "get", "mget", "strlen",
                     "hgetall", "hexists", "hget", "hmget", "hkeys", "hvals",
                     "smembers", "scard", "sdiff", "sunion", "sismember", "llen", "lrange", "lindex"]
         extend_safe_cmd = [SysConfig().get("redis_cmd_white_list", "").strip().split(',')]
@@ -70,22 +122,96 @@ class RedisEngine(EngineBase):
             result['msg'] = "禁止执行该命令！"
         return result
 
+    @staticmethod
+    def _pipeline(conn, commands):
+        """分批使用pipeline执行命令，commands为(方法名, 参数元组)列表，返回结果列表"""
+        results = []
+        for i in range(0, len(commands), PIPELINE_BATCH):
+            with conn.pipeline(transaction=False) as pipe:
+                for method, args in commands[i:i + PIPELINE_BATCH]:
+                    getattr(pipe, method)(*args)
+                results.extend(pipe.execute())
+        return results
+
+    def _scan(self, conn, command, args, limit_num):
+        """
+        按服务端COUNT分页迭代，收集到limit_num个元素后停止
+        最后一页不截断，保证返回的游标可以继续迭代
+        :return: (下次迭代的游标, 元素列表)
+        """
+        if command == 'scan':
+            cursor, match, count, _type = _parse_scan_args(args)
+            key = None
+        else:
+            key = args[0]
+            cursor, match, count, _type = _parse_scan_args(args[1:])
+        items = []
+        while True:
+            if command == 'scan':
+                # TYPE需要Redis 6.0，redis-py的scan不支持，直接发送命令
+                command_args = ['SCAN', cursor] + (['MATCH', match] if match else []) + \
+                               ['COUNT', count] + (['TYPE', _type] if _type else [])
+                cursor, page = conn.execute_command(*command_args)
+                cursor = int(cursor)
+            else:
+                cursor, page = getattr(conn, command)(key, cursor=cursor, match=match, count=count)
+            items.extend(page.items() if isinstance(page, dict) else page)
+            if cursor == 0 or (limit_num > 0 and len(items) >= limit_num):
+                break
+        return cursor, items
+
+    def _scan_rows(self, conn, command, args, limit_num):
+        cursor, items = self._scan(conn, command, args, limit_num)
+        column_list = SCAN_COLUMNS[command]
+        if command == 'scan':
+            # 逐个key的type、ttl使用pipeline批量获取
+            values = self._pipeline(conn, [(method, (key,)) for key in items for method in ('type', 'ttl')])
+            rows = [[key, values[i * 2], values[i * 2 + 1]] for i, key in enumerate(items)]
+        elif command == 'sscan':
+            rows = [[member] for member in items]
+        else:
+            rows = [list(item) for item in items]
+        cursor_row = [str(cursor)] + [None] * (len(column_list) - 1)
+        return column_list, [cursor_row] + rows, len(items)
+
+    def _mget_rows(self, conn, keys, limit_num):
+        """key较多时拆分为多个mget，通过pipeline一次发送"""
+        if limit_num > 0:
+            keys = keys[:limit_num]
+        results = self._pipeline(conn, [('mget', (keys[i:i + PIPELINE_BATCH],))
+                                        for i in range(0, len(keys), PIPELINE_BATCH)])
+        rows = [[value] for values in results for value in values]
+        return ['Result'], rows, len(rows)
+
     def query(self, db_name=None, sql='', limit_num=0, close_conn=True):
         """返回 ResultSet """
         result_set = ResultSet(full_sql=sql)
         try:
             conn = self.get_connection(db_name=db_name)
+            try:
+                args = shlex.split(sql.strip())
+            except ValueError:
+                args = []
+            command = args[0].lower() if args else ''
+            # 限制行数时大key改为scan分批读取，不一次读取整个key
+            if command in FULL_READ_COMMANDS and len(args) == 2 and limit_num > 0:
+                command = FULL_READ_COMMANDS[command]
+                args = [command, args[1], '0']
+            if command in SCAN_COLUMNS:
+                result_set.column_list, rows, result_set.affected_rows = self._scan_rows(
+                    conn, command, args[1:], limit_num)
+                result_set.rows = tuple(rows)
+                return result_set
+            if command == 'mget' and len(args) > 1:
+                result_set.column_list, rows, result_set.affected_rows = self._mget_rows(
+                    conn, args[1:], limit_num)
+                result_set.rows = tuple(rows)
+                return result_set
             rows = conn.execute_command(sql)
             result_set.column_list = ['Result']
             if isinstance(rows, list):
-                if re.match(fr'^scan', sql.strip(), re.I):
-                    keys = [[row] for row in rows[1]]
-                    keys.insert(0, rows[0])
-                    result_set.rows = tuple(keys)
-                    result_set.affected_rows = len(rows[1])
-                else:
-                    result_set.rows = tuple([row] for row in rows)
-                    result_set.affected_rows = len(rows)
+                result_set.rows = tuple([row] for row in rows)
+                result_set.affected_rows = len(rows)
             else:
                 result_set.rows = tuple([[rows]])
                 result_set.affected_rows = 1 if rows else 0
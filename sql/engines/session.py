@@ -0,0 +1,138 @@
+# -*- coding: UTF-8 -*-
+"""
+查询会话, 将一次查询的语句校验、主从延迟获取、limit改写和执行放在同一个连接上完成, 并记录各阶段耗时
+语句执行超时优先使用engine原生超时, 不支持时由进程内watchdog终止连接
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from common.utils.timer import FuncTimer
+from sql.utils.query_watchdog import query_watchdog
+
+
+class ValidatedSQLCache:
+    """
+    已通过语法校验(explain)的语句缓存, 进程内LRU
+    语句失效(如表被删除)时执行阶段依然会报错, 因此缓存不需要主动失效
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(instance, db_name, sql):
+        digest = hashlib.md5(sql.encode('utf-8')).hexdigest()
+        return instance.id, instance.update_time, db_name, digest
+
+    def hit(self, instance, db_name, sql):
+        key = self._key(instance, db_name, sql)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return True
+        return False
+
+    def add(self, instance, db_name, sql):
+        key = self._key(instance, db_name, sql)
+        with self._lock:
+            self._cache[key] = True
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+validated_sql_cache = ValidatedSQLCache()
+
+
+class QuerySession:
+    """
+    单连接查询会话, open后engine持有连接, 期间engine内部的查询均复用该连接, close时归还
+    各阶段耗时记录在timings中, 单位秒
+    """
+
+    def __init__(self, engine, db_name=None, **query_kwargs):
+        """
+        :param engine: 查询engine
+        :param db_name: 数据库名
+        :param query_kwargs: 透传给engine.query的额外参数, 如pgsql的schema_name
+        """
+        self.engine = engine
+        self.db_name = db_name
+        self.query_kwargs = query_kwargs
+        self.timings = OrderedDict()
+        # 连接被watchdog终止后不再归还连接池
+        self.killed = False
+
+    @contextmanager
+    def timer(self, stage):
+        """记录阶段耗时, 同名阶段耗时累加"""
+        t = FuncTimer()
+        try:
+            with t:
+                yield t
+        finally:
+            self.timings[stage] = round(self.timings.get(stage, 0) + t.cost, 6)
+
+    def open(self):
+        with self.timer('connect'):
+            self.engine.get_connection(db_name=self.db_name)
+        return self
+
+    def close(self):
+        if self.killed:
+            self.engine.close(discard=True)
+        else:
+            self.engine.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def thread_id(self):
+        return self.engine.thread_id
+
+    @contextmanager
+    def timeout(self, seconds):
+        """
+        限制语句执行时间, 优先使用engine原生的超时设置, 不支持时登记到watchdog, 超时后终止连接
+        必须在连接归还前退出, 避免终止已被复用的连接
+        """
+        token = None
+        if seconds > 0 and not self.engine.set_query_timeout(seconds) and self.thread_id:
+            token = query_watchdog.watch(self.engine.instance.id, self.thread_id, seconds)
+        try:
+            yield
+        finally:
+            if token is not None and query_watchdog.cancel(token):
+                self.killed = True
+
+    def query_check(self, sql):
+        with self.timer('check'):
+            return self.engine.query_check(db_name=self.db_name, sql=sql)
+
+    def filter_sql(self, sql, limit_num):
+        with self.timer('rewrite'):
+            return self.engine.filter_sql(sql=sql, limit_num=limit_num)
+
+    def seconds_behind_master(self):
+        with self.timer('replica_lag'):
+            return self.engine.seconds_behind_master
+
+    def query(self, sql, limit_num=0):
+        with self.timer('execute'):
+            return self.engine.query(self.db_name, sql, limit_num, close_conn=False, **self.query_kwargs)
+
+    def query_masking(self, sql, resultset):
+        with self.timer('masking'):
+            return self.engine.query_masking(self.db_name, sql, resultset)
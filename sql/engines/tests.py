@@ -1,7 +1,8 @@
 import MySQLdb
+import cx_Oracle
 import json
 from datetime import timedelta, datetime
-from unittest.mock import patch, Mock, ANY
+from unittest.mock import patch, Mock, MagicMock, ANY, call
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase
@@ -12,16 +13,114 @@ from sql.engines.goinception import GoInceptionEngine
 from sql.engines.models import ResultSet, ReviewSet, ReviewResult
 from sql.engines.mssql import MssqlEngine
 from sql.engines.mysql import MysqlEngine
-from sql.engines.redis import RedisEngine
+from sql.engines.redis import RedisEngine, clear_connection_pools
 from sql.engines.pgsql import PgSQLEngine
 from sql.engines.oracle import OracleEngine
-from sql.engines.mongo import MongoEngine
+from sql.engines.mongo import MongoEngine, clear_clients
 from sql.engines.inception import InceptionEngine, _repair_json_str
+from sql.engines.pool import ConnectionPool, get_pool, clear_pools, pool_stats
+from sql.engines.session import QuerySession, validated_sql_cache
 from sql.models import Instance, SqlWorkflow, SqlWorkflowContent
 
 User = get_user_model()
 
 
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        self.connect = Mock(side_effect=lambda: Mock())
+        self.ping = Mock()
+        self.reset = Mock()
+        self.pool = ConnectionPool(connect=self.connect, ping=self.ping, reset=self.reset,
+                                   max_size=1, max_idle_time=300)
+
+    def tearDown(self):
+        clear_pools()
+
+    def test_acquire_release_reuse(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.reset.assert_called_once_with(conn)
+        self.assertEqual(self.pool.acquire(), conn)
+        self.ping.assert_called_once_with(conn)
+        self.connect.assert_called_once()
+        self.assertDictEqual(self.pool.stats(), {'hits': 1, 'misses': 1, 'idle': 0,
+                                                 'max_size': 1, 'max_idle_time': 300})
+
+    def test_release_over_max_size(self):
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        self.pool.release(conn2)
+        self.assertEqual(self.pool.idle_size, 1)
+        conn2.close.assert_called_once()
+
+    def test_release_discard(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn, discard=True)
+        self.assertEqual(self.pool.idle_size, 0)
+        conn.close.assert_called_once()
+        self.reset.assert_not_called()
+
+    def test_release_reset_failed(self):
+        self.reset.side_effect = RuntimeError('server has gone away')
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertEqual(self.pool.idle_size, 0)
+        conn.close.assert_called_once()
+
+    def test_acquire_ping_failed(self):
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.ping.side_effect = RuntimeError('server has gone away')
+        new_conn = self.pool.acquire()
+        self.assertNotEqual(new_conn, conn)
+        conn.close.assert_called_once()
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_acquire_idle_timeout(self):
+        self.pool.max_idle_time = -1
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+        self.assertNotEqual(self.pool.acquire(), conn)
+        conn.close.assert_called_once()
+        self.ping.assert_not_called()
+
+    def test_get_pool(self):
+        ins = Instance(id=1, instance_name='some_ins', update_time=datetime.now())
+        pool = get_pool(ins, 'some_db', connect=self.connect)
+        self.assertIs(get_pool(ins, 'some_db', connect=self.connect), pool)
+        self.assertIsNot(get_pool(ins, 'other_db', connect=self.connect), pool)
+        # 实例信息修改后使用新的连接池
+        ins.update_time = datetime.now() + timedelta(seconds=1)
+        self.assertIsNot(get_pool(ins, 'some_db', connect=self.connect), pool)
+        self.assertEqual(len(pool_stats()), 1)
+
+    def test_get_pool_configure(self):
+        """连接池配置修改后立即生效，超出的空闲连接直接关闭"""
+        ins = Instance(id=1, instance_name='some_ins', update_time=datetime.now())
+        pool = get_pool(ins, 'some_db', connect=self.connect, max_size=2)
+        conns = [pool.acquire(), pool.acquire()]
+        for conn in conns:
+            pool.release(conn)
+        self.assertIs(get_pool(ins, 'some_db', connect=self.connect, max_size=1, max_idle_time=60), pool)
+        self.assertEqual((pool.max_size, pool.max_idle_time, pool.idle_size), (1, 60, 1))
+        conns[0].close.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def test_get_pool_engine_class(self, connect):
+        """连接池不引用调用方的engine对象"""
+        ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                      host='some_host', port=3306, user='ins_user', password='some_str')
+        engine = MysqlEngine(instance=ins)
+        engine.get_connection(db_name='some_db')
+        engine.close()
+        pool = get_pool(ins, 'some_db', engine_class=MysqlEngine)
+        self.assertIsNot(pool._reset.__self__, engine)
+        self.assertEqual(pool.idle_size, 1)
+        connect.assert_called_once()
+        ins.delete()
+
+
 class TestReviewSet(TestCase):
     def test_review_set(self):
         new_review_set = ReviewSet()
@@ -101,6 +200,9 @@ class TestMssql(TestCase):
         cls.wf.delete()
         SqlWorkflowContent.objects.all().delete()
 
+    def tearDown(self):
+        clear_pools()
+
     @patch('sql.engines.mssql.pyodbc.connect')
     def testGetConnection(self, connect):
         new_engine = MssqlEngine(instance=self.ins1)
@@ -118,7 +220,9 @@ class TestMssql(TestCase):
         query_result = new_engine.query(sql='some_str', limit_num=100)
         cur.return_value.execute.assert_called()
         cur.return_value.fetchmany.assert_called_once_with(100)
-        connect.return_value.close.assert_called_once()
+        # 连接归还连接池
+        connect.return_value.rollback.assert_called_once()
+        connect.return_value.close.assert_not_called()
         self.assertIsInstance(query_result, ResultSet)
 
     @patch.object(MssqlEngine, 'query')
@@ -244,6 +348,33 @@ class TestMysql(TestCase):
         self.sys_config.purge()
         SqlWorkflow.objects.all().delete()
         SqlWorkflowContent.objects.all().delete()
+        clear_pools()
+        validated_sql_cache.clear()
+
+    @patch.object(MysqlEngine, 'close')
+    @patch.object(MysqlEngine, 'query')
+    def test_get_table_info(self, _query, _close):
+        _query.side_effect = [ResultSet(rows=[('t1', 'InnoDB')], column_list=['table_name', 'engine']),
+                              ResultSet(rows=[('id', 'int')], column_list=['列名', '列类型']),
+                              ResultSet(rows=[('id', 'PRIMARY')], column_list=['列名', '索引名']),
+                              ResultSet(rows=[('t1', 'create table t1')])]
+        new_engine = MysqlEngine(instance=self.ins1)
+        table_info = new_engine.get_table_info('some_db', 't1')
+        # 同一连接上完成，结束后关闭一次
+        self.assertTrue(all(c[1]['close_conn'] is False for c in _query.call_args_list))
+        _close.assert_called_once()
+        self.assertDictEqual(table_info['meta_data'], {'column_list': ['table_name', 'engine'],
+                                                       'rows': ('t1', 'InnoDB')})
+        self.assertEqual(table_info['desc']['rows'], [('id', 'int')])
+        self.assertEqual(table_info['create_sql'], [('t1', 'create table t1')])
+
+    @patch.object(MysqlEngine, 'close')
+    @patch.object(MysqlEngine, 'query', return_value=ResultSet(rows=[]))
+    def test_get_table_info_not_exist(self, _query, _close):
+        new_engine = MysqlEngine(instance=self.ins1)
+        with self.assertRaisesMessage(RuntimeError, '表t1不存在'):
+            new_engine.get_table_info('some_db', 't1')
+        _close.assert_called_once()
 
     @patch('MySQLdb.connect')
     def test_engine_base_info(self, _conn):
@@ -268,9 +399,62 @@ class TestMysql(TestCase):
         query_result = new_engine.query(sql='some_str', limit_num=100)
         cur.return_value.execute.assert_called()
         cur.return_value.fetchmany.assert_called_once_with(size=100)
-        connect.return_value.close.assert_called_once()
+        # 连接归还连接池
+        connect.return_value.rollback.assert_called_once()
+        connect.return_value.close.assert_not_called()
         self.assertIsInstance(query_result, ResultSet)
 
+    @patch('MySQLdb.connect')
+    def test_query_stream(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.fetchmany.side_effect = [(('v1',), ('v2',)), (('v3',),)]
+        cur.description = (('k1', 'some_other_des'),)
+        new_engine = MysqlEngine(instance=self.ins1)
+        chunks = list(new_engine.query_stream(sql='some_str', limit_num=0, chunk_size=2))
+        connect.return_value.cursor.assert_called_once_with(MySQLdb.cursors.SSCursor)
+        self.assertEqual([c.rows for c in chunks], [(('v1',), ('v2',)), (('v3',),)])
+        self.assertEqual(chunks[0].column_list, ['k1'])
+        # 结果集读取完毕，连接归还连接池
+        connect.return_value.close.assert_not_called()
+
+    @patch('MySQLdb.connect')
+    def test_query_stream_limit(self, connect):
+        cur = connect.return_value.cursor.return_value
+        cur.fetchmany.return_value = (('v1',), ('v2',))
+        cur.fetchone.return_value = ('v3',)
+        cur.description = (('k1', 'some_other_des'),)
+        new_engine = MysqlEngine(instance=self.ins1)
+        chunks = list(new_engine.query_stream(sql='some_str', limit_num=2, chunk_size=10))
+        cur.fetchmany.assert_called_once_with(size=2)
+        self.assertEqual(len(chunks), 1)
+        # 结果集未读取完毕，直接关闭连接
+        connect.return_value.close.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def test_query_stream_error(self, connect):
+        connect.return_value.cursor.return_value.execute.side_effect = RuntimeError('some error')
+        new_engine = MysqlEngine(instance=self.ins1)
+        chunks = list(new_engine.query_stream(sql='some_str', limit_num=100))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].error, 'some error')
+
+    @patch('MySQLdb.connect')
+    def test_query_reuse_pooled_connection(self, connect):
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.query(sql='select 1')
+        new_engine.query(sql='select 1')
+        connect.assert_called_once()
+        connect.return_value.ping.assert_called_once()
+
+    @patch('MySQLdb.connect')
+    def test_query_without_pool(self, connect):
+        self.sys_config.set('engine_pool_size', '0')
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.query(sql='select 1')
+        new_engine.query(sql='select 1')
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(connect.return_value.close.call_count, 2)
+
     @patch.object(MysqlEngine, 'query')
     def testAllDb(self, mock_query):
         db_result = ResultSet()
@@ -311,6 +495,91 @@ class TestMysql(TestCase):
         check_result = new_engine.query_check(db_name='some_db', sql=sql_without_limit)
         self.assertEqual(check_result['filtered_sql'], 'select user from usertable')
 
+    @patch.object(MysqlEngine, 'query', return_value=ResultSet())
+    def test_query_check_explain_cache(self, _query):
+        """校验通过的语句不再重复explain"""
+        new_engine = MysqlEngine(instance=self.ins1)
+        new_engine.query_check(db_name='some_db', sql='select user from usertable')
+        new_engine.query_check(db_name='some_db', sql='select user from usertable')
+        _query.assert_called_once_with(db_name='some_db', sql='explain select user from usertable', close_conn=True)
+        new_engine.query_check(db_name='other_db', sql='select user from usertable')
+        self.assertEqual(_query.call_count, 2)
+
+    @patch('MySQLdb.connect')
+    def test_query_session(self, connect):
+        """查询会话内的校验、主从延迟、查询复用同一个连接"""
+        cur = connect.return_value.cursor.return_value
+        cur.fetchmany.return_value = (('v1',),)
+        cur.fetchall.return_value = ()
+        cur.description = (('k1', 'some_other_des'),)
+        new_engine = MysqlEngine(instance=self.ins1)
+        with QuerySession(new_engine, db_name='some_db') as session:
+            check_result = session.query_check('select k1 from some_table')
+            self.assertFalse(check_result['bad_query'])
+            session.seconds_behind_master()
+            query_result = session.query('select k1 from some_table limit 100;', 100)
+        self.assertEqual(query_result.rows, (('v1',),))
+        connect.assert_called_once()
+        connect.return_value.close.assert_not_called()
+        self.assertIsNone(new_engine.conn)
+        self.assertListEqual(list(session.timings.keys()), ['connect', 'check', 'replica_lag', 'execute'])
+
+    @patch('MySQLdb.connect')
+    def test_query_session_timeout(self, connect):
+        """支持max_execution_time时使用原生超时，归还连接时恢复"""
+        cur = connect.return_value.cursor.return_value
+        new_engine = MysqlEngine(instance=self.ins1)
+        with QuerySession(new_engine, db_name='some_db') as session:
+            with session.timeout(10):
+                cur.execute.assert_called_with('set session max_execution_time=10000')
+        cur.execute.assert_called_with('set session max_execution_time=default')
+
+    @patch('MySQLdb.connect')
+    def test_query_session_timeout_reuse(self, connect):
+        """连接上已是在线查询的超时时间时不再设置，归还时保留，未设置超时的select执行前恢复"""
+        cur = connect.return_value.cursor.return_value
+        cur.fetchall.return_value = ()
+        for _ in range(2):
+            with QuerySession(MysqlEngine(instance=self.ins1), db_name='some_db') as session:
+                with session.timeout(60):
+                    session.query('select 1')
+        set_calls = [c for c in cur.execute.call_args_list if c[0][0].startswith('set session')]
+        self.assertEqual(set_calls, [call('set session max_execution_time=60000')])
+        MysqlEngine(instance=self.ins1).query(db_name='some_db', sql='select 1')
+        cur.execute.assert_any_call('set session max_execution_time=default')
+
+    @patch('sql.engines.session.query_watchdog')
+    @patch('MySQLdb.connect')
+    def test_query_session_timeout_unsupported(self, connect, _watchdog):
+        """不支持max_execution_time的实例只尝试一次"""
+        connect.return_value.thread_id.return_value = 123
+        connect.return_value.cursor.return_value.execute.side_effect = MySQLdb.OperationalError(
+            1193, 'Unknown system variable')
+        _watchdog.cancel.return_value = False
+        for _ in range(2):
+            with QuerySession(MysqlEngine(instance=self.ins1), db_name='some_db') as session:
+                with session.timeout(10):
+                    pass
+        connect.return_value.cursor.return_value.execute.assert_called_once_with(
+            'set session max_execution_time=10000')
+        self.assertEqual(_watchdog.watch.call_count, 2)
+
+    @patch('sql.engines.session.query_watchdog')
+    @patch('MySQLdb.connect')
+    def test_query_session_timeout_watchdog(self, connect, _watchdog):
+        """不支持max_execution_time时由watchdog终止连接，查询结束后取消"""
+        connect.return_value.thread_id.return_value = 123
+        connect.return_value.cursor.return_value.execute.side_effect = MySQLdb.OperationalError(
+            1193, 'Unknown system variable')
+        new_engine = MysqlEngine(instance=self.ins1)
+        with QuerySession(new_engine, db_name='some_db') as session:
+            with session.timeout(10):
+                _watchdog.watch.assert_called_once_with(self.ins1.id, 123, 10)
+            _watchdog.cancel.assert_called_once_with(_watchdog.watch.return_value)
+            self.assertTrue(session.killed)
+        # 被watchdog终止的连接直接关闭，不归还连接池
+        connect.return_value.close.assert_called_once()
+
     def test_query_check_wrong_sql(self):
         new_engine = MysqlEngine(instance=self.ins1)
         wrong_sql = '-- 测试'
@@ -581,6 +850,57 @@ class TestRedis(TestCase):
         self.assertIsInstance(query_result, ResultSet)
         self.assertTupleEqual(query_result.rows, (['text'],))
 
+    def test_get_connection_pooled(self):
+        new_engine = RedisEngine(instance=self.ins)
+        conn1 = new_engine.get_connection(db_name=0)
+        conn2 = new_engine.get_connection(db_name='0')
+        self.assertIs(conn1.connection_pool, conn2.connection_pool)
+        self.assertIsNot(conn1.connection_pool, new_engine.get_connection(db_name=1).connection_pool)
+        clear_connection_pools()
+
+    @patch('redis.Redis.pipeline')
+    @patch('redis.Redis.execute_command')
+    def test_query_scan(self, _execute_command, _pipeline):
+        _execute_command.side_effect = [(5, ['k1', 'k2']), (0, ['k3'])]
+        pipe = _pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = ['string', -1, 'hash', 10, 'set', -1]
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0 match k* count 2', limit_num=100)
+        _execute_command.assert_any_call('SCAN', 0, 'MATCH', 'k*', 'COUNT', 2)
+        _execute_command.assert_called_with('SCAN', 5, 'MATCH', 'k*', 'COUNT', 2)
+        self.assertEqual(query_result.column_list, ['Result', 'Type', 'TTL'])
+        self.assertTupleEqual(query_result.rows, (['0', None, None], ['k1', 'string', -1], ['k2', 'hash', 10],
+                                                  ['k3', 'set', -1]))
+        self.assertEqual(query_result.affected_rows, 3)
+
+    @patch('redis.Redis.pipeline')
+    @patch('redis.Redis.execute_command')
+    def test_query_scan_limit(self, _execute_command, _pipeline):
+        _execute_command.side_effect = [(5, ['k1', 'k2']), (8, ['k3'])]
+        _pipeline.return_value.__enter__.return_value.execute.return_value = ['string', -1, 'string', -1]
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='scan 0', limit_num=2)
+        _execute_command.assert_called_once_with('SCAN', 0, 'COUNT', 1000)
+        self.assertListEqual(query_result.rows[0], ['5', None, None])
+        self.assertEqual(query_result.affected_rows, 2)
+
+    @patch('redis.Redis.hscan', side_effect=[(3, {'f1': 'v1'}), (0, {'f2': 'v2'})])
+    def test_query_hgetall_limit(self, _hscan):
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='hgetall some_key', limit_num=100)
+        _hscan.assert_called_with('some_key', cursor=3, match=None, count=1000)
+        self.assertEqual(query_result.column_list, ['Result', 'Value'])
+        self.assertTupleEqual(query_result.rows, (['0', None], ['f1', 'v1'], ['f2', 'v2']))
+
+    @patch('redis.Redis.pipeline')
+    def test_query_mget(self, _pipeline):
+        pipe = _pipeline.return_value.__enter__.return_value
+        pipe.execute.return_value = [['v1', None]]
+        new_engine = RedisEngine(instance=self.ins)
+        query_result = new_engine.query(db_name=0, sql='mget k1 k2 k3', limit_num=2)
+        pipe.mget.assert_called_once_with(['k1', 'k2'])
+        self.assertTupleEqual(query_result.rows, (['v1'], [None]))
+
     @patch('redis.Redis.config_get', return_value={"databases": 4})
     def test_get_all_databases(self, _config_get):
         new_engine = RedisEngine(instance=self.ins)
@@ -672,6 +992,9 @@ class TestPgSQL(TestCase):
         cls.ins.delete()
         cls.sys_config.purge()
 
+    def tearDown(self):
+        clear_pools()
+
     @patch('psycopg2.connect')
     def test_engine_base_info(self, _conn):
         new_engine = PgSQLEngine(instance=self.ins)
@@ -704,6 +1027,53 @@ class TestPgSQL(TestCase):
         self.assertIsInstance(query_result, ResultSet)
         self.assertListEqual(query_result.rows, [(1,)])
 
+    @patch('psycopg2.connect')
+    def test_query_named_cursor(self, _conn):
+        conn = _conn.return_value
+        conn.search_path = None
+        conn.cursor.return_value.fetchmany.return_value = [(1,)]
+        new_engine = PgSQLEngine(instance=self.ins)
+        new_engine.query(db_name="some_dbname", sql='select 1', limit_num=100, schema_name="some_schema",
+                         close_conn=False)
+        # limit查询使用命名游标
+        self.assertIn('name', conn.cursor.call_args[1])
+        self.assertEqual(conn.search_path, 'some_schema')
+        # search_path未变化时不再切换
+        conn.cursor.reset_mock()
+        new_engine.query(db_name="some_dbname", sql='select 1', limit_num=100, schema_name="some_schema")
+        conn.cursor.assert_called_once()
+
+    def test_set_search_path(self):
+        conn = Mock(search_path='some_schema')
+        PgSQLEngine._set_search_path(conn)
+        conn.cursor.return_value.execute.assert_called_once_with('RESET search_path;')
+        conn.commit.assert_called_once()
+        self.assertIsNone(conn.search_path)
+
+    def test_reset_connection(self):
+        conn = Mock(timeout_changed=False)
+        new_engine = PgSQLEngine(instance=self.ins)
+        new_engine._reset_connection(conn)
+        conn.rollback.assert_called_once()
+        conn.cursor.assert_not_called()
+        conn.timeout_changed = True
+        new_engine._reset_connection(conn)
+        conn.cursor.return_value.execute.assert_called_once_with('RESET statement_timeout;')
+        self.assertFalse(conn.timeout_changed)
+
+    @patch('psycopg2.connect')
+    def test_query_stream(self, _conn):
+        cur = _conn.return_value.cursor.return_value
+        cur.fetchmany.side_effect = [[(1,), (2,)], [(3,)]]
+        cur.description = (('k1',),)
+        new_engine = PgSQLEngine(instance=self.ins)
+        chunks = list(new_engine.query_stream(db_name="some_dbname", sql='select 1', limit_num=100,
+                                              chunk_size=2, schema_name="some_schema"))
+        self.assertEqual([c.rows for c in chunks], [[(1,), (2,)], [(3,)]])
+        self.assertEqual(chunks[0].column_list, ['k1'])
+        # 使用命名游标
+        self.assertIn('name', _conn.return_value.cursor.call_args[1])
+
     @patch('sql.engines.pgsql.PgSQLEngine._query',
            return_value=ResultSet(rows=[('postgres',), ('archery',), ('template1',), ('template0',)]))
     def test_get_all_databases(self, _query):
@@ -1272,6 +1642,7 @@ class TestOracle(TestCase):
         self.sys_config.purge()
         SqlWorkflow.objects.all().delete()
         SqlWorkflowContent.objects.all().delete()
+        clear_pools()
 
     @patch('cx_Oracle.makedsn')
     @patch('cx_Oracle.connect')
@@ -1432,6 +1803,51 @@ class TestOracle(TestCase):
         check_result = new_engine.filter_sql(sql=sql, limit_num=1)
         self.assertEqual(check_result, "select * from xx limit 10 WHERE ROWNUM <= 1")
 
+    def test_filter_sql_fetch_first(self):
+        """12c以上使用FETCH FIRST限制行数，已有FETCH子句时不追加"""
+        new_engine = OracleEngine(instance=self.ins)
+        new_engine.conn = MagicMock(version='12.1.0.2.0')
+        check_result = new_engine.filter_sql(sql="select * from xx where id>1 order by id;", limit_num=100)
+        self.assertEqual(check_result, "select * from xx where id>1 order by id FETCH FIRST 100 ROWS ONLY")
+        sql = "select * from xx order by id fetch first 10 rows only"
+        self.assertEqual(new_engine.filter_sql(sql=sql, limit_num=100), sql)
+        new_engine.conn = MagicMock(version='11.2.0.4.0')
+        check_result = new_engine.filter_sql(sql="select * from xx;", limit_num=100)
+        self.assertEqual(check_result, "select * from xx WHERE ROWNUM <= 100")
+
+    @patch('cx_Oracle.connect')
+    def test_query_lob(self, _conn):
+        """按limit设置arraysize并只读取limit行，LOB由outputtypehandler直接读取"""
+        cursor = _conn.return_value.cursor.return_value
+        cursor.description = [('ID', cx_Oracle.NUMBER), ('CONTENT', cx_Oracle.CLOB)]
+        cursor.fetchmany.return_value = [(1, 'some_text')]
+        new_engine = OracleEngine(instance=self.ins)
+        query_result = new_engine.query(db_name='archery', sql='select id, content from t', limit_num=10)
+        self.assertListEqual(query_result.rows, [(1, 'some_text')])
+        cursor.fetchmany.assert_called_once_with(10)
+        cursor.fetchall.assert_not_called()
+        self.assertEqual(cursor.arraysize, 10)
+        self.assertEqual(cursor.outputtypehandler, new_engine._output_type_handler)
+
+    def test_output_type_handler(self):
+        cursor = MagicMock(arraysize=10)
+        OracleEngine._output_type_handler(cursor, 'CONTENT', cx_Oracle.CLOB, 0, 0, 0)
+        cursor.var.assert_called_once_with(cx_Oracle.LONG_STRING, arraysize=10)
+        cursor.var.reset_mock()
+        self.assertIsNone(OracleEngine._output_type_handler(cursor, 'ID', cx_Oracle.NUMBER, 0, 0, 0))
+        cursor.var.assert_not_called()
+
+    @patch('cx_Oracle.connect')
+    def test_query_stream(self, _conn):
+        """分批读取，达到limit_num后结束"""
+        cursor = _conn.return_value.cursor.return_value
+        cursor.description = [('ID', cx_Oracle.NUMBER)]
+        cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)]]
+        new_engine = OracleEngine(instance=self.ins)
+        chunks = list(new_engine.query_stream(sql='select id from t', limit_num=3, chunk_size=2))
+        self.assertEqual([chunk.rows for chunk in chunks], [[(1,), (2,)], [(3,)]])
+        self.assertEqual([call[0][0] for call in cursor.fetchmany.call_args_list], [2, 1])
+
     def test_query_masking(self):
         query_result = ResultSet()
         new_engine = OracleEngine(instance=self.ins)
@@ -1550,12 +1966,65 @@ class MongoTest(TestCase):
 
     def tearDown(self) -> None:
         self.ins.delete()
+        clear_clients()
 
     @patch('sql.engines.mongo.pymongo')
     def test_get_connection(self, mock_pymongo):
         _ = self.engine.get_connection()
         mock_pymongo.MongoClient.assert_called_once()
 
+    @patch('sql.engines.mongo.pymongo')
+    def test_get_connection_cached(self, mock_pymongo):
+        """同一实例复用MongoClient，实例信息变更后重建"""
+        self.ins.password = 'some_str'
+        self.ins.save()
+        client = MongoEngine(instance=self.ins).get_connection()
+        self.assertIs(MongoEngine(instance=self.ins).get_connection(), client)
+        mock_pymongo.MongoClient.assert_called_once()
+        self.assertEqual(mock_pymongo.MongoClient.call_args[1]['username'], 'ins_user')
+        self.ins.save()
+        MongoEngine(instance=self.ins).get_connection()
+        self.assertEqual(mock_pymongo.MongoClient.call_count, 2)
+        client.close.assert_called_once()
+
+    @patch('sql.engines.mongo.MongoEngine.get_connection')
+    def test_query_find(self, mock_get_connection):
+        """find支持projection、sort、skip，limit取较小值下推到服务端"""
+        collect = mock_get_connection.return_value.__getitem__.return_value.__getitem__.return_value
+        cursor = collect.find.return_value
+        cursor.sort.return_value = cursor
+        cursor.skip.return_value = cursor
+        cursor.limit.return_value = [{'id': 2, 'name': '中文'}]
+        test_sql = 'test.find({"id":{"$gt":1}}, {"name":1}).sort({"id":-1}).skip(10).limit(500)'
+        result = self.engine.query('some_db', test_sql, 100)
+        collect.find.assert_called_once_with({'id': {'$gt': 1}}, {'name': 1})
+        cursor.sort.assert_called_once_with([('id', -1)])
+        cursor.skip.assert_called_once_with(10)
+        cursor.limit.assert_called_once_with(100)
+        self.assertEqual(result.rows, (['{"id": 2, "name": "中文"}'],))
+
+    @patch('sql.engines.mongo.MongoEngine.get_connection')
+    def test_query_aggregate(self, mock_get_connection):
+        collect = mock_get_connection.return_value.__getitem__.return_value.__getitem__.return_value
+        collect.aggregate.return_value = [{'_id': 'a', 'total': 1}]
+        result = self.engine.query('some_db', 'test.aggregate([{"$group": {"_id": "$a", "total": {"$sum": 1}}}])', 100)
+        collect.aggregate.assert_called_once_with([{'$group': {'_id': '$a', 'total': {'$sum': 1}}}, {'$limit': 100}])
+        self.assertEqual(result.affected_rows, 1)
+
+    @patch('sql.engines.mongo.MongoEngine.get_connection')
+    def test_query_count(self, mock_get_connection):
+        collect = mock_get_connection.return_value.__getitem__.return_value.__getitem__.return_value
+        collect.count_documents.return_value = 5
+        result = self.engine.query('some_db', 'test.count({"a": 1})', 100)
+        self.assertEqual(result.rows, (['{"count": 5}'],))
+
+    def test_query_check_write(self):
+        """禁止写入数据的聚合阶段和非查询方法"""
+        self.assertTrue(self.engine.query_check(sql='test.aggregate([{"$out": "other"}])')['bad_query'])
+        self.assertTrue(self.engine.query_check(sql='test.remove({})')['bad_query'])
+        self.assertTrue(self.engine.query_check(sql='test.find().forEach(1)')['bad_query'])
+        self.assertFalse(self.engine.query_check(sql='test.count()')['bad_query'])
+
     @patch('sql.engines.mongo.MongoEngine.get_connection')
     def test_query(self, mock_get_connection):
         # TODO 正常查询还没做
@@ -6,12 +6,13 @@ import simplejson as json
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.http import HttpResponse
-from django.views.decorators.cache import cache_page
 
 from common.config import SysConfig
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from sql.engines import get_engine
 from sql.plugins.schemasync import SchemaSync
+from sql.utils.metadata_cache import MetadataCache
+from sql.utils.replica_lag import get_replica_lag_history
 from .models import Instance, ParamTemplate, ParamHistory
 
 
@@ -56,6 +57,20 @@ def lists(request):
                         content_type='application/json')
 
 
+@permission_required('sql.menu_instance_list', raise_exception=True)
+def replica_lag(request):
+    """获取实例主从延迟采集历史"""
+    instance_id = request.POST.get('instance_id')
+    count = int(request.POST.get('count', 60))
+    try:
+        ins = Instance.objects.get(id=instance_id)
+    except Instance.DoesNotExist:
+        result = {'status': 1, 'msg': '实例不存在', 'data': []}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    result = {'status': 0, 'msg': 'ok', 'data': get_replica_lag_history(ins, count)}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
 @permission_required('sql.param_view', raise_exception=True)
 def param_list(request):
     """
@@ -251,10 +266,9 @@ def schemasync(request):
     return HttpResponse(json.dumps(result), content_type='application/json')
 
 
-@cache_page(60 * 5, key_prefix="insRes")
 def instance_resource(request):
     """
-    获取实例内的资源信息，database、schema、table、column
+    获取实例内的资源信息，database、schema、table、column，结果由元数据缓存提供
     :param request:
     :return:
     """
@@ -276,21 +290,21 @@ def instance_resource(request):
     result = {'status': 0, 'msg': 'ok', 'data': []}
 
     try:
-        query_engine = get_engine(instance=instance)
+        metadata = MetadataCache(instance)
         if resource_type == 'database':
-            resource = query_engine.get_all_databases()
+            resource = metadata.get_all_databases()
         elif resource_type == 'schema' and db_name:
-            resource = query_engine.get_all_schemas(db_name=db_name)
+            resource = metadata.get_all_schemas(db_name=db_name)
         elif resource_type == 'table' and db_name:
             if schema_name:
-                resource = query_engine.get_all_tables(db_name=db_name, schema_name=schema_name)
+                resource = metadata.get_all_tables(db_name=db_name, schema_name=schema_name)
             else:
-                resource = query_engine.get_all_tables(db_name=db_name)
+                resource = metadata.get_all_tables(db_name=db_name)
         elif resource_type == 'column' and db_name and tb_name:
             if schema_name:
-                resource = query_engine.get_all_columns_by_tb(db_name=db_name, schema_name=schema_name, tb_name=tb_name)
+                resource = metadata.get_all_columns_by_tb(db_name=db_name, schema_name=schema_name, tb_name=tb_name)
             else:
-                resource = query_engine.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name)
+                resource = metadata.get_all_columns_by_tb(db_name=db_name, tb_name=tb_name)
         else:
             raise TypeError('不支持的资源类型或者参数不完整！')
     except Exception as msg:
@@ -319,11 +333,11 @@ def describe(request):
     result = {'status': 0, 'msg': 'ok', 'data': []}
 
     try:
-        query_engine = get_engine(instance=instance)
+        metadata = MetadataCache(instance)
         if schema_name:
-            query_result = query_engine.describe_table(db_name, tb_name, schema_name)
+            query_result = metadata.describe_table(db_name, tb_name, schema_name)
         else:
-            query_result = query_engine.describe_table(db_name, tb_name)
+            query_result = metadata.describe_table(db_name, tb_name)
         result['data'] = query_result.__dict__
     except Exception as msg:
         result['status'] = 1
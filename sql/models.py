@@ -433,6 +433,7 @@ class QueryLog(models.Model):
     class Meta:
         managed = True
         db_table = 'query_log'
+        indexes = [models.Index(fields=['username', 'id'], name='idx_username_id')]
         verbose_name = u'查询日志'
         verbose_name_plural = u'查询日志'
 
@@ -636,6 +637,7 @@ class Permission(models.Model):
             ('query_submit', '提交SQL查询'),
             ('query_all_instances', '可查询所有实例'),
             ('query_resource_group_instance', '可查询所在资源组内的所有实例'),
+            ('query_export', '后台导出查询结果'),
             ('process_view', '查看会话'),
             ('process_kill', '终止会话'),
             ('tablespace_view', '查看表空间'),
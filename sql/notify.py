@@ -281,3 +281,40 @@ def notify_for_binlog2sql(task):
         msg_content = f'解析的SQL文件为{task.result[1]}，请到指定目录查看'
         msg_to = [task.result[0].email]
         MsgSender().send_email(msg_title, msg_content, msg_to)
+
+
+def notify_for_query_export(task):
+    """
+    查询结果导出结束的通知，仅通知导出人
+    :param task:
+    :return:
+    """
+    # 判断是否开启消息通知，未开启直接返回
+    sys_config = SysConfig()
+    wx_status = sys_config.get('wx')
+    if not sys_config.get('mail') and not sys_config.get('ding_to_person') and not wx_status:
+        logger.info('未开启消息通知，可在系统设置中开启')
+        return None
+
+    user = Users.objects.get(username=task.kwargs['username'])
+    progress = task.result if task.success else {'status': 'failed', 'rows': 0, 'msg': '导出异常，请联系管理员'}
+    base_url = sys_config.get('archery_base_url', 'http://127.0.0.1:8000').rstrip('/')
+    if progress['status'] == 'finished':
+        msg_title = '[Archery 通知]查询结果导出完成'
+        msg_content = '''数据库：{}\n导出行数：{}\n下载地址：{}/query/export/download/?export_id={}\n'''.format(
+            task.kwargs['db_name'],
+            progress['rows'],
+            base_url,
+            task.kwargs['export_id'])
+    else:
+        msg_title = '[Archery 通知]查询结果导出失败'
+        msg_content = '''数据库：{}\n错误信息：{}\n'''.format(task.kwargs['db_name'], progress['msg'])
+
+    # 发送通知
+    msg_sender = MsgSender()
+    if sys_config.get('mail') and user.email:
+        msg_sender.send_email(msg_title, msg_content, [user.email])
+    if sys_config.get('ding_to_person') and user.ding_user_id:
+        msg_sender.send_ding2user([user.ding_user_id], msg_title + '\n' + msg_content)
+    if wx_status:
+        msg_sender.send_wx2user(msg_title + '\n' + msg_content, [user.wx_user_id or user.username])
@@ -1,26 +1,29 @@
 # -*- coding: UTF-8 -*-
-import datetime
 import logging
 import re
 import time
 import traceback
+from contextlib import ExitStack
 
 import simplejson as json
 from django.contrib.auth.decorators import permission_required
-from django.db import connection, close_old_connections
-from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from common.config import SysConfig
-from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime
-from common.utils.timer import FuncTimer
+from common.utils.extend_json_encoder import ExtendJSONEncoder, ExtendJSONEncoderFTime, RowEncoder, encode_rows
 from sql.query_privileges import query_priv_check
+from sql.utils.query_cache import QueryResultCache
+from sql.utils.query_log import log_query, has_pending_logs, flush_query_logs, search_query_logs, count_query_logs
+from sql.utils.replica_lag import get_replica_lag, sample_interval
 from sql.utils.resource_group import user_instances
-from sql.utils.tasks import add_kill_conn_schedule, del_schedule
 from .models import QueryLog, Instance
 from sql.engines import get_engine
+from sql.engines.session import QuerySession
 
 logger = logging.getLogger('default')
 
+# 流式查询每批读取的行数
+STREAM_CHUNK_SIZE = 1000
+
 
 @permission_required('sql.query_submit', raise_exception=True)
 def query(request):
@@ -50,59 +53,50 @@ def query(request):
         result['msg'] = '页面提交参数可能为空'
         return HttpResponse(json.dumps(result), content_type='application/json')
 
+    session = None
     try:
         config = SysConfig()
-        # 查询前的检查，禁用语句检查，语句切分
+        # 查询会话，语句校验、主从延迟获取、limit改写以及执行复用同一个连接
         query_engine = get_engine(instance=instance)
-        query_check_info = query_engine.query_check(db_name=db_name, sql=sql_content)
-        if query_check_info.get('bad_query'):
-            # 引擎内部判断为 bad_query
-            result['status'] = 1
-            result['msg'] = query_check_info.get('msg')
-            return HttpResponse(json.dumps(result), content_type='application/json')
-        if query_check_info.get('has_star') and config.get('disable_star') is True:
-            # 引擎内部判断为有 * 且禁止 * 选项打开
+        query_kwargs = {'schema_name': schema_name} if instance.db_type == 'pgsql' else {}  # TODO 此处判断待优化，请在 修改传参方式后去除
+        session = QuerySession(query_engine, db_name, **query_kwargs).open()
+        # 查询前的检查、权限校验以及语句改写
+        prepare_info = query_prepare(user, instance, db_name, sql_content, limit_num, session)
+        if prepare_info['status'] != 0:
             result['status'] = 1
-            result['msg'] = query_check_info.get('msg')
+            result['msg'] = prepare_info['msg']
             return HttpResponse(json.dumps(result), content_type='application/json')
-        sql_content = query_check_info['filtered_sql']
+        sql_content = prepare_info['data']['sql_content']
+        limit_num = prepare_info['data']['limit_num']
+        priv_check = prepare_info['data']['priv_check']
 
-        # 查询权限校验，并且获取limit_num
-        priv_check_info = query_priv_check(user, instance, db_name, sql_content, limit_num)
-        if priv_check_info['status'] == 0:
-            limit_num = priv_check_info['data']['limit_num']
-            priv_check = priv_check_info['data']['priv_check']
-        else:
-            result['status'] = 1
-            result['msg'] = priv_check_info['msg']
-            return HttpResponse(json.dumps(result), content_type='application/json')
-        # explain的limit_num设置为0
-        limit_num = 0 if re.match(r"^explain", sql_content.lower()) else limit_num
+        # 命中查询结果缓存直接返回，不再执行语句
+        with session.timer('cache'):
+            result_cache = QueryResultCache(instance, db_name, sql_content, limit_num, schema_name=schema_name)
+            cached_data = result_cache.get()
+        if cached_data:
+            cached_data['seconds_behind_master'] = get_seconds_behind_master(instance, session)
+            session.close()
+            cached_data['timings'] = session.timings
+            result['data'] = cached_data
+            save_query_log(user, instance, db_name, sql_content, limit_num, cached_data['affected_rows'],
+                           session.timings['cache'], priv_check, cached_data['mask_rule_hit'],
+                           cached_data['is_masked'])
+            return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
+                                content_type='application/json')
 
-        # 对查询sql增加limit限制或者改写语句
-        sql_content = query_engine.filter_sql(sql=sql_content, limit_num=limit_num)
-
-        # 先获取查询连接，用于后面查询复用连接以及终止会话
-        query_engine.get_connection(db_name=db_name)
-        thread_id = query_engine.thread_id
         max_execution_time = int(config.get('max_execution_time', 60))
-        # 执行查询语句，并增加一个定时终止语句的schedule，timeout=max_execution_time
-        if thread_id:
-            schedule_name = f'query-{time.time()}'
-            run_date = (datetime.datetime.now() + datetime.timedelta(seconds=max_execution_time))
-            add_kill_conn_schedule(schedule_name, run_date, instance.id, thread_id)
-        with FuncTimer() as t:
-            # 获取主从延迟信息
-            seconds_behind_master = query_engine.seconds_behind_master
-            if instance.db_type == 'pgsql':  # TODO 此处判断待优化，请在 修改传参方式后去除
-                query_result = query_engine.query(db_name, sql_content, limit_num, schema_name=schema_name)
-            else:
-                query_result = query_engine.query(db_name, sql_content, limit_num)
-        query_result.query_time = t.cost
-        # 返回查询结果后删除schedule
-        if thread_id:
-            del_schedule(schedule_name)
+        # 获取主从延迟信息
+        seconds_behind_master = get_seconds_behind_master(instance, session)
+        # 执行查询语句，超过max_execution_time后终止
+        with session.timeout(max_execution_time):
+            query_result = session.query(sql_content, limit_num)
+        query_result.query_time = session.timings['execute']
+        # 尽早释放连接
+        session.close()
 
+        # 脱敏异常按配置放行的结果不缓存
+        cacheable = True
         # 查询异常
         if query_result.error:
             result['status'] = 1
@@ -110,9 +104,8 @@ def query(request):
         # 数据脱敏，仅对查询无错误的结果集进行脱敏，并且按照query_check配置是否返回
         elif config.get('data_masking'):
             try:
-                with FuncTimer() as t:
-                    masking_result = query_engine.query_masking(db_name, sql_content, query_result)
-                masking_result.mask_time = t.cost
+                masking_result = session.query_masking(sql_content, query_result)
+                masking_result.mask_time = session.timings['masking']
                 # 脱敏出错
                 if masking_result.error:
                     # 开启query_check，直接返回异常，禁止执行
@@ -124,6 +117,7 @@ def query(request):
                         logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{masking_result.error}')
                         query_result.error = None
                         result['data'] = query_result.__dict__
+                        cacheable = False
                 # 正常脱敏
                 else:
                     result['data'] = masking_result.__dict__
@@ -137,46 +131,286 @@ def query(request):
                     logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{msg}')
                     query_result.error = None
                     result['data'] = query_result.__dict__
+                    cacheable = False
         # 无需脱敏的语句
         else:
             result['data'] = query_result.__dict__
 
+        # 结果集按列转换为JSON原生类型
+        if result['data'].get('rows'):
+            result['data']['rows'] = encode_rows(result['data']['rows'])
         # 仅将成功的查询语句记录存入数据库
         if not query_result.error:
             result['data']['seconds_behind_master'] = seconds_behind_master
-            if int(limit_num) == 0:
-                limit_num = int(query_result.affected_rows)
-            else:
-                limit_num = min(int(limit_num), int(query_result.affected_rows))
-            query_log = QueryLog(
-                username=user.username,
-                user_display=user.display,
-                db_name=db_name,
-                instance_name=instance.instance_name,
-                sqllog=sql_content,
-                effect_row=limit_num,
-                cost_time=query_result.query_time,
-                priv_check=priv_check,
-                hit_rule=query_result.mask_rule_hit,
-                masking=query_result.is_masked
-            )
-            # 防止查询超时
-            if connection.connection and not connection.is_usable():
-                close_old_connections()
-            query_log.save()
+            # 各阶段耗时
+            result['data']['timings'] = session.timings
+            logger.debug(f'查询各阶段耗时：{dict(session.timings)}，查询语句：{sql_content}')
+            save_query_log(user, instance, db_name, sql_content, limit_num, query_result.affected_rows,
+                           query_result.query_time, priv_check, query_result.mask_rule_hit,
+                           query_result.is_masked)
+            # 缓存查询结果
+            if result['status'] == 0 and result_cache.enabled:
+                result['data']['cache_hit'] = False
+                if cacheable:
+                    result_cache.set(result['data'])
     except Exception as e:
         logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
         result['status'] = 1
         result['msg'] = f'查询异常报错，错误信息：{e}'
         return HttpResponse(json.dumps(result), content_type='application/json')
+    finally:
+        if session:
+            session.close()
     # 返回查询结果
+    return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
+                        content_type='application/json')
+
+
+def query_prepare(user, instance, db_name, sql_content, limit_num, session, admin_limit=None):
+    """
+    查询前的检查，禁用语句检查，语句切分，权限校验以及limit改写，均在查询会话的连接上完成
+    :param admin_limit: 管理员的最大返回行数，默认为admin_query_limit
+    :return: {'status': 0, 'msg': 'ok', 'data': {'sql_content', 'limit_num', 'priv_check'}}
+    """
+    result = {'status': 0, 'msg': 'ok', 'data': {}}
+    config = SysConfig()
+    query_check_info = session.query_check(sql_content)
+    if query_check_info.get('bad_query'):
+        # 引擎内部判断为 bad_query
+        result['status'] = 1
+        result['msg'] = query_check_info.get('msg')
+        return result
+    if query_check_info.get('has_star') and config.get('disable_star') is True:
+        # 引擎内部判断为有 * 且禁止 * 选项打开
+        result['status'] = 1
+        result['msg'] = query_check_info.get('msg')
+        return result
+    sql_content = query_check_info['filtered_sql']
+
+    # 查询权限校验，并且获取limit_num
+    with session.timer('priv_check'):
+        priv_check_info = query_priv_check(user, instance, db_name, sql_content, limit_num, admin_limit)
+    if priv_check_info['status'] != 0:
+        result['status'] = 1
+        result['msg'] = priv_check_info['msg']
+        return result
+    limit_num = priv_check_info['data']['limit_num']
+    priv_check = priv_check_info['data']['priv_check']
+    # explain的limit_num设置为0
+    limit_num = 0 if re.match(r"^explain", sql_content.lower()) else limit_num
+
+    # 对查询sql增加limit限制或者改写语句
+    sql_content = session.filter_sql(sql_content, limit_num)
+    result['data'] = {'sql_content': sql_content, 'limit_num': limit_num, 'priv_check': priv_check}
+    return result
+
+
+def get_seconds_behind_master(instance, session):
+    """获取主从延迟信息，开启后台采集时直接读取缓存，否则在查询会话上实时获取"""
+    if sample_interval() > 0:
+        with session.timer('replica_lag'):
+            return get_replica_lag(instance)
+    return session.seconds_behind_master()
+
+
+def save_query_log(user, instance, db_name, sql_content, limit_num, affected_rows, cost_time,
+                   priv_check, hit_rule, masking):
+    """记录查询日志，仅记录成功的查询语句"""
+    if int(limit_num) == 0:
+        effect_row = int(affected_rows)
+    else:
+        effect_row = min(int(limit_num), int(affected_rows))
+    # 写入缓冲后由后台线程批量入库
+    log_query(
+        username=user.username,
+        user_display=user.display,
+        db_name=db_name,
+        instance_name=instance.instance_name,
+        sqllog=sql_content,
+        effect_row=effect_row,
+        cost_time=cost_time,
+        priv_check=priv_check,
+        hit_rule=hit_rule,
+        masking=masking
+    )
+
+
+@permission_required('sql.query_submit', raise_exception=True)
+def query_stream(request):
+    """
+    流式获取SQL查询结果，使用服务端游标分批读取、分批脱敏并分批输出，内存占用与结果集大小无关
+    format=ndjson 时每行一个JSON对象，依次为 {column_list}、多个 {rows}、{status, msg, ...}
+    format=json 时输出与分批写入的单个JSON对象 {column_list, rows, status, msg, ...}
+    :param request:
+    :return:
+    """
+    instance_name = request.POST.get('instance_name')
+    sql_content = request.POST.get('sql_content')
+    db_name = request.POST.get('db_name')
+    limit_num = int(request.POST.get('limit_num', 0))
+    schema_name = request.POST.get('schema_name', None)
+    output_format = request.POST.get('format', 'ndjson')
+    user = request.user
+
+    result = {'status': 0, 'msg': 'ok', 'data': {}}
     try:
-        return HttpResponse(json.dumps(result, cls=ExtendJSONEncoderFTime, bigint_as_string=True),
-                            content_type='application/json')
-    # 虽然能正常返回，但是依然会乱码
-    except UnicodeDecodeError:
-        return HttpResponse(json.dumps(result, default=str, bigint_as_string=True, encoding='latin1'),
-                            content_type='application/json')
+        instance = user_instances(request.user).get(instance_name=instance_name)
+    except Instance.DoesNotExist:
+        result['status'] = 1
+        result['msg'] = '你所在组未关联该实例'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    # 服务器端参数验证
+    if None in [sql_content, db_name, instance_name, limit_num] or output_format not in ('ndjson', 'json'):
+        result['status'] = 1
+        result['msg'] = '页面提交参数可能为空'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    session = None
+    try:
+        query_engine = get_engine(instance=instance)
+        query_kwargs = {'schema_name': schema_name} if instance.db_type == 'pgsql' else {}
+        session = QuerySession(query_engine, db_name, **query_kwargs).open()
+        prepare_info = query_prepare(user, instance, db_name, sql_content, limit_num, session)
+        if prepare_info['status'] != 0:
+            session.close()
+            result['status'] = 1
+            result['msg'] = prepare_info['msg']
+            return HttpResponse(json.dumps(result), content_type='application/json')
+        # 获取主从延迟信息，需在开始流式读取前执行
+        seconds_behind_master = get_seconds_behind_master(instance, session)
+    except Exception as e:
+        if session:
+            session.close()
+        logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
+        result['status'] = 1
+        result['msg'] = f'查询异常报错，错误信息：{e}'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    # 会话连接由流式查询结束时释放
+    events = _query_stream_events(user, instance, session, prepare_info['data'], seconds_behind_master)
+    if output_format == 'ndjson':
+        return StreamingHttpResponse(_ndjson_stream(events), content_type='application/x-ndjson')
+    return StreamingHttpResponse(_json_stream(events), content_type='application/json')
+
+
+def _query_stream_events(user, instance, session, prepare_data, seconds_behind_master,
+                         chunk_size=STREAM_CHUNK_SIZE, max_execution_time=None):
+    """
+    执行流式查询，按顺序产出 ('header', dict)、('rows', list)、('footer', dict) 事件
+    :param max_execution_time: 执行超时时间，单位秒，默认为max_execution_time配置，0表示不限制
+    """
+    config = SysConfig()
+    if max_execution_time is None:
+        max_execution_time = int(config.get('max_execution_time', 60))
+    query_engine = session.engine
+    db_name = session.db_name
+    sql_content = prepare_data['sql_content']
+    limit_num = prepare_data['limit_num']
+    footer = {'status': 0, 'msg': 'ok'}
+    state = {'error': None, 'affected_rows': 0}
+
+    def raw_chunks():
+        # 查询异常记录到state后结束，保证脱敏阶段只处理正常的结果集
+        # 连接由会话持有，读取结束后不归还，等超时监控取消后由session.close归还
+        stream = query_engine.query_stream(db_name, sql_content, limit_num, chunk_size=chunk_size,
+                                           close_conn=False, **session.query_kwargs)
+        try:
+            for chunk in stream:
+                if chunk.error:
+                    state['error'] = chunk.error
+                    return
+                state['affected_rows'] += len(chunk.rows)
+                yield chunk
+        finally:
+            stream.close()
+
+    timeout = ExitStack()
+    raw = raw_chunks()
+    masking = config.get('data_masking')
+    chunks = query_engine.query_masking_stream(db_name, sql_content, raw) if masking else raw
+    is_masked, mask_rule_hit = False, False
+    encoder = RowEncoder()
+    header_sent = False
+    start = time.time()
+    try:
+        # 执行查询语句，超过max_execution_time后终止
+        timeout.enter_context(session.timeout(max_execution_time))
+        for chunk in chunks:
+            if masking:
+                # 脱敏出错，开启query_check直接返回异常，关闭则放行未脱敏数据
+                if chunk.error:
+                    if config.get('query_check'):
+                        footer = {'status': 1, 'msg': f'数据脱敏异常：{chunk.error}'}
+                        break
+                    logger.warning(f'数据脱敏异常，按照配置放行，查询语句：{sql_content}，错误信息：{chunk.error}')
+                    chunk.error = None
+                is_masked = is_masked or chunk.is_masked
+                mask_rule_hit = mask_rule_hit or chunk.mask_rule_hit
+            if not header_sent:
+                header_sent = True
+                yield 'header', {'column_list': chunk.column_list, 'seconds_behind_master': seconds_behind_master}
+            if chunk.rows:
+                yield 'rows', encoder.encode(chunk.rows)
+        query_time = round(time.time() - start, 4)
+        # 流式读取、脱敏与输出交替进行，整体计入执行阶段
+        session.timings['execute'] = query_time
+        if state['error']:
+            footer = {'status': 1, 'msg': state['error']}
+        elif footer['status'] == 0:
+            footer.update({'affected_rows': state['affected_rows'], 'query_time': query_time,
+                           'is_masked': is_masked, 'mask_rule_hit': mask_rule_hit,
+                           'timings': session.timings})
+            save_query_log(user, instance, db_name, sql_content, limit_num, state['affected_rows'],
+                           query_time, prepare_data['priv_check'], mask_rule_hit, is_masked)
+    except Exception as e:
+        logger.error(f'查询异常报错，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
+        footer = {'status': 1, 'msg': f'查询异常报错，错误信息：{e}'}
+    finally:
+        # 先取消超时监控，再关闭生成器，最后归还连接，被终止或结果集未读完的连接直接关闭
+        timeout.close()
+        if chunks is not raw:
+            chunks.close()
+        raw.close()
+        session.close()
+    yield 'footer', footer
+
+
+def _dumps(obj):
+    return json.dumps(obj, cls=ExtendJSONEncoderFTime, bigint_as_string=True)
+
+
+def _ndjson_stream(events):
+    """事件转换为NDJSON"""
+    try:
+        for kind, data in events:
+            if kind == 'rows':
+                data = {'rows': data}
+            yield _dumps(data) + '\n'
+    finally:
+        # 客户端断开时关闭事件生成器，释放服务端游标和连接
+        events.close()
+
+
+def _json_stream(events):
+    """事件转换为分批写入的单个JSON对象"""
+    header_sent = False
+    first_row = True
+    try:
+        for kind, data in events:
+            if kind == 'header':
+                header_sent = True
+                yield _dumps(data)[:-1] + ', "rows": ['
+            elif kind == 'rows':
+                rows = ', '.join(_dumps(row) for row in data)
+                yield rows if first_row else ', ' + rows
+                first_row = False
+            elif header_sent:
+                yield '], ' + _dumps(data)[1:]
+            else:
+                yield _dumps({'column_list': [], 'rows': [], **data})
+    finally:
+        events.close()
 
 
 @permission_required('sql.menu_sqlquery', raise_exception=True)
@@ -192,10 +426,21 @@ def querylog(request):
     limit = int(request.GET.get('limit'))
     offset = int(request.GET.get('offset'))
     limit = offset + limit
+    # 上一页最后一条记录的id，传入时offset为相对该记录的偏移量
+    last_id = request.GET.get('last_id')
     star = True if request.GET.get('star') == 'true' else False
     query_log_id = request.GET.get('query_log_id')
     search = request.GET.get('search', '')
 
+    # 缓冲中的日志均晚于已写入的日志，仅查看首页且有当前用户可见的日志时先写入，保证刚执行的查询可见
+    # 翻页、收藏等其他情况由后台定时写入，不阻塞读取
+    if not (last_id or offset or star or query_log_id):
+        try:
+            if has_pending_logs(None if user.is_superuser else user.username):
+                flush_query_logs(wait=True)
+        except Exception as e:
+            logger.error(f'查询日志写入数据库失败:{e}{traceback.format_exc()}')
+
     # 组合筛选项
     filter_dict = dict()
     # 是否收藏
@@ -212,11 +457,12 @@ def querylog(request):
     sql_log = QueryLog.objects.filter(**filter_dict)
 
     # 过滤搜索信息
-    sql_log = sql_log.filter(Q(sqllog__icontains=search) |
-                             Q(user_display__icontains=search) |
-                             Q(alias__icontains=search))
+    sql_log = search_query_logs(sql_log, search)
 
-    sql_log_count = sql_log.count()
+    sql_log_count = count_query_logs(sql_log)
+    # 按id游标分页，避免深分页扫描
+    if last_id:
+        sql_log = sql_log.filter(id__lt=int(last_id))
     sql_log_list = sql_log.order_by('-id')[offset:limit].values(
         "id", "instance_name", "db_name", "sqllog",
         "effect_row", "cost_time", "user_display", "favorite", "alias",
@@ -245,7 +491,7 @@ def favorite(request):
 
 
 def kill_query_conn(instance_id, thread_id):
-    """终止查询会话，用于schedule调用"""
+    """终止查询会话，兼容升级前已创建的schedule"""
     instance = Instance.objects.get(pk=instance_id)
     query_engine = get_engine(instance)
     query_engine.kill_connection(thread_id)
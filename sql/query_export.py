@@ -0,0 +1,280 @@
+# -*- coding: UTF-8 -*-
+"""
+查询结果后台导出
+* 提交时在请求内完成语句检查、权限校验和limit改写，导出由django_q异步执行
+* 复用流式查询的服务端游标分批读取与分批脱敏，写入downloads/query_export目录下的gzip压缩CSV或XLSX文件
+* 导出进度存放在django缓存中，导出结束后通知导出人，导出记录写入查询日志
+"""
+import csv
+import gzip
+import logging
+import os
+import time
+import traceback
+import uuid
+
+import simplejson as json
+from django.conf import settings
+from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
+from django.http import HttpResponse, FileResponse
+from django_q.tasks import async_task
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.engines.session import QuerySession
+from sql.models import Instance, Users
+from sql.notify import notify_for_query_export
+from sql.query import query_prepare, _query_stream_events
+from sql.utils.resource_group import user_instances
+
+logger = logging.getLogger('default')
+
+EXPORT_DIR = os.path.join(settings.BASE_DIR, 'downloads/query_export/')
+# 每批读取的行数
+EXPORT_CHUNK_SIZE = 5000
+# 导出进度更新间隔，单位秒
+PROGRESS_INTERVAL = 2
+# 导出进度保留时间，过期后无法下载
+PROGRESS_TIMEOUT = 7 * 24 * 60 * 60
+
+
+class CsvWriter:
+    """gzip压缩的CSV，带BOM便于Excel直接打开"""
+    extension = 'csv.gz'
+
+    def __init__(self, filename):
+        self._file = gzip.open(filename, 'wt', encoding='utf-8-sig', newline='')
+        self._writer = csv.writer(self._file)
+
+    def write_header(self, column_list):
+        self._writer.writerow(column_list)
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class XlsxWriter:
+    """XLSX本身为zip压缩格式，超过单个sheet的最大行数时写入新的sheet"""
+    extension = 'xlsx'
+    # 单个sheet最大1048576行，含表头
+    max_rows = 1048575
+
+    def __init__(self, filename):
+        from openpyxl import Workbook
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        self._illegal_re = ILLEGAL_CHARACTERS_RE
+        self._filename = filename
+        self._workbook = Workbook(write_only=True)
+        self._sheet = None
+        self._sheet_rows = 0
+        self._column_list = []
+
+    def _add_sheet(self):
+        self._sheet = self._workbook.create_sheet()
+        self._sheet.append(self._column_list)
+        self._sheet_rows = 0
+
+    def write_header(self, column_list):
+        self._column_list = column_list
+        self._add_sheet()
+
+    def write_rows(self, rows):
+        for row in rows:
+            if self._sheet_rows >= self.max_rows:
+                self._add_sheet()
+            # 去除XLSX不支持的控制字符
+            self._sheet.append([self._illegal_re.sub('', value) if isinstance(value, str) else value
+                                for value in row])
+            self._sheet_rows += 1
+
+    def close(self):
+        if self._sheet is None:
+            self._add_sheet()
+        self._workbook.save(self._filename)
+
+
+WRITERS = {'csv': CsvWriter, 'xlsx': XlsxWriter}
+
+
+def _progress_key(export_id):
+    return f'query_export:{export_id}'
+
+
+def get_progress(export_id):
+    """获取导出进度，不存在或已过期返回None"""
+    return cache.get(_progress_key(export_id))
+
+
+def _set_progress(export_id, **kwargs):
+    progress = get_progress(export_id) or {}
+    progress.update(kwargs)
+    cache.set(_progress_key(export_id), progress, timeout=PROGRESS_TIMEOUT)
+    return progress
+
+
+def _export_path(progress):
+    return os.path.join(EXPORT_DIR, progress['file'])
+
+
+@permission_required('sql.query_export', raise_exception=True)
+def export(request):
+    """
+    提交查询结果导出任务
+    :param request:
+    :return: {'status': 0, 'msg': 'ok', 'data': {'export_id'}}
+    """
+    instance_name = request.POST.get('instance_name')
+    sql_content = request.POST.get('sql_content')
+    db_name = request.POST.get('db_name')
+    schema_name = request.POST.get('schema_name', None)
+    file_format = request.POST.get('format', 'csv')
+    user = request.user
+
+    result = {'status': 0, 'msg': 'ok', 'data': {}}
+    try:
+        instance = user_instances(request.user).get(instance_name=instance_name)
+    except Instance.DoesNotExist:
+        result['status'] = 1
+        result['msg'] = '你所在组未关联该实例'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    # 服务器端参数验证
+    if None in [sql_content, db_name, instance_name] or file_format not in WRITERS:
+        result['status'] = 1
+        result['msg'] = '页面提交参数可能为空'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    # 管理员的导出行数上限为query_export_limit，其他用户仍按查询权限的limit限制
+    export_limit = int(SysConfig().get('query_export_limit', 1000000))
+    query_kwargs = {'schema_name': schema_name} if instance.db_type == 'pgsql' else {}
+    session = None
+    try:
+        session = QuerySession(get_engine(instance=instance), db_name, **query_kwargs).open()
+        prepare_info = query_prepare(user, instance, db_name, sql_content, export_limit, session,
+                                     admin_limit=export_limit)
+    except Exception as e:
+        logger.error(f'导出检查异常，查询语句：{sql_content}\n，错误信息：{traceback.format_exc()}')
+        result['status'] = 1
+        result['msg'] = f'导出检查异常，错误信息：{e}'
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    finally:
+        if session:
+            session.close()
+    if prepare_info['status'] != 0:
+        result['status'] = 1
+        result['msg'] = prepare_info['msg']
+        return HttpResponse(json.dumps(result), content_type='application/json')
+
+    export_id = uuid.uuid4().hex
+    _set_progress(export_id, username=user.username, instance_name=instance.instance_name, db_name=db_name,
+                  format=file_format, limit_num=prepare_info['data']['limit_num'], status='waiting', rows=0,
+                  msg='', file='', size=0, create_time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    async_task(export_query_result, export_id=export_id, username=user.username, instance_id=instance.id,
+               db_name=db_name, prepare_data=prepare_info['data'], file_format=file_format,
+               query_kwargs=query_kwargs, hook=notify_for_query_export, timeout=-1,
+               task_name=f'query-export-{export_id}')
+    result['data'] = {'export_id': export_id}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+def export_query_result(export_id, username, instance_id, db_name, prepare_data, file_format, query_kwargs):
+    """
+    异步导出查询结果，返回导出进度
+    超时时间为query_export_max_execution_time，默认0不限制
+    """
+    user = Users.objects.get(username=username)
+    instance = Instance.objects.get(pk=instance_id)
+    max_execution_time = int(SysConfig().get('query_export_max_execution_time', 0))
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    writer_class = WRITERS[file_format]
+    file = f'{export_id}.{writer_class.extension}'
+    filename = os.path.join(EXPORT_DIR, file)
+    try:
+        writer = writer_class(filename)
+    except Exception as e:
+        logger.error(f'创建导出文件失败，导出id：{export_id}，错误信息：{traceback.format_exc()}')
+        return _set_progress(export_id, status='failed', msg=f'创建导出文件失败，错误信息：{e}',
+                             finish_time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    _set_progress(export_id, status='running', file=file)
+
+    session, events = None, None
+    footer = {'status': 1, 'msg': '导出未完成'}
+    rows = 0
+    reported_at = time.time()
+    try:
+        session = QuerySession(get_engine(instance=instance), db_name, **query_kwargs).open()
+        events = _query_stream_events(user, instance, session, prepare_data, None,
+                                      chunk_size=EXPORT_CHUNK_SIZE, max_execution_time=max_execution_time)
+        for kind, data in events:
+            if kind == 'header':
+                writer.write_header(data['column_list'])
+            elif kind == 'rows':
+                writer.write_rows(data)
+                rows += len(data)
+                if time.time() - reported_at >= PROGRESS_INTERVAL:
+                    _set_progress(export_id, rows=rows)
+                    reported_at = time.time()
+            else:
+                footer = data
+    except Exception as e:
+        logger.error(f'查询结果导出异常，导出id：{export_id}，错误信息：{traceback.format_exc()}')
+        footer = {'status': 1, 'msg': f'导出异常，错误信息：{e}'}
+    finally:
+        # 生成器未开始迭代时close不会关闭会话，重复关闭无影响
+        if events:
+            events.close()
+        if session:
+            session.close()
+        writer.close()
+    finish_time = time.strftime('%Y-%m-%d %H:%M:%S')
+    if footer['status'] != 0:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return _set_progress(export_id, status='failed', rows=rows, msg=footer['msg'], file='',
+                             finish_time=finish_time)
+    return _set_progress(export_id, status='finished', rows=rows, size=os.path.getsize(filename),
+                         finish_time=finish_time)
+
+
+def _user_progress(request):
+    """获取当前用户的导出进度，管理员可查看全部"""
+    progress = get_progress(request.GET.get('export_id', ''))
+    if progress and (progress['username'] == request.user.username or request.user.is_superuser):
+        return progress
+    return None
+
+
+@permission_required('sql.query_export', raise_exception=True)
+def export_status(request):
+    """
+    获取导出进度
+    :param request:
+    :return:
+    """
+    progress = _user_progress(request)
+    if not progress:
+        result = {'status': 1, 'msg': '导出任务不存在或已过期', 'data': {}}
+    else:
+        result = {'status': 0, 'msg': 'ok', 'data': progress}
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+@permission_required('sql.query_export', raise_exception=True)
+def export_download(request):
+    """
+    下载导出文件
+    :param request:
+    :return:
+    """
+    progress = _user_progress(request)
+    if not progress or progress['status'] != 'finished' or not os.path.exists(_export_path(progress)):
+        result = {'status': 1, 'msg': '导出文件不存在或已过期', 'data': {}}
+        return HttpResponse(json.dumps(result), content_type='application/json')
+    extension = progress['file'].split('.', 1)[1]
+    filename = f"{progress['instance_name']}_{progress['db_name']}_{progress['create_time']}.{extension}"
+    filename = filename.replace(' ', '_').replace(':', '')
+    return FileResponse(open(_export_path(progress), 'rb'), as_attachment=True, filename=filename)
@@ -22,10 +22,12 @@ from django_q.tasks import async_task
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
 from common.utils.extend_json_encoder import ExtendJSONEncoder
+from common.utils.versioned_cache import VersionedCache
 from sql.engines.goinception import GoInceptionEngine
 from sql.models import QueryPrivilegesApply, QueryPrivileges, Instance, ResourceGroup
 from sql.notify import notify_for_audit
-from sql.utils.resource_group import user_groups, user_instances
+from sql.utils.parse_cache import parse_cache
+from sql.utils.resource_group import user_groups, user_instances, user_instance_ids
 from sql.utils.workflow_audit import Audit
 from sql.utils.sql_utils import extract_tables
 
@@ -35,7 +37,7 @@ __author__ = 'hhyo'
 
 
 # TODO 权限校验内的语法解析和判断独立到每个engine内
-def query_priv_check(user, instance, db_name, sql_content, limit_num):
+def query_priv_check(user, instance, db_name, sql_content, limit_num, admin_limit=None):
     """
     查询权限校验
     :param user:
@@ -43,19 +45,20 @@ def query_priv_check(user, instance, db_name, sql_content, limit_num):
     :param db_name:
     :param sql_content:
     :param limit_num:
+    :param admin_limit: 管理员的最大返回行数，默认为admin_query_limit
     :return:
     """
     result = {'status': 0, 'msg': 'ok', 'data': {'priv_check': True, 'limit_num': 0}}
     # 如果有can_query_all_instance, 视为管理员, 仅获取limit值信息
     # superuser 拥有全部权限, 不需做特别修改
     if user.has_perm('sql.query_all_instances'):
-        priv_limit = int(SysConfig().get('admin_query_limit', 5000))
+        priv_limit = admin_limit or int(SysConfig().get('admin_query_limit', 5000))
         result['data']['limit_num'] = min(priv_limit, limit_num) if limit_num else priv_limit
         return result
     # 如果有can_query_resource_group_instance, 视为资源组管理员, 可查询资源组内所有实例数据
     if user.has_perm('sql.query_resource_group_instance'):
-        if user_instances(user, tag_codes=['can_read']).filter(pk=instance.pk).exists():
-            priv_limit = int(SysConfig().get('admin_query_limit', 5000))
+        if instance.pk in user_instance_ids(user, tag_codes=['can_read']):
+            priv_limit = admin_limit or int(SysConfig().get('admin_query_limit', 5000))
             result['data']['limit_num'] = min(priv_limit, limit_num) if limit_num else priv_limit
             return result
 
@@ -403,9 +406,64 @@ def _table_ref(sql_content, instance, db_name):
     :param db_name:
     :return:
     """
-    engine = GoInceptionEngine()
-    query_tree = engine.query_print(instance=instance, db_name=db_name, sql=sql_content).get('query_tree')
-    return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
+
+    def parse():
+        engine = GoInceptionEngine()
+        query_tree = engine.query_print(instance=instance, db_name=db_name, sql=sql_content).get('query_tree')
+        return engine.get_table_ref(json.loads(query_tree), db_name=db_name)
+
+    # 仅常量不同的语句复用缓存的解析结果
+    return parse_cache.get('table_ref', instance, db_name, sql_content, parse)
+
+
+class PrivilegeSnapshot:
+    """
+    用户在实例上的查询权限快照，一次查询加载全部库权限、表权限的有效期和limit
+    有效期在校验时判断，权限过期不需要主动失效
+    """
+
+    def __init__(self, privileges):
+        self.db_privs = {}
+        self.tb_privs = {}
+        for priv in privileges:
+            grant = (priv.valid_date, priv.limit_num)
+            # 库表名与数据库默认排序规则一致，不区分大小写
+            if priv.priv_type == 1:
+                self.db_privs.setdefault(priv.db_name.lower(), []).append(grant)
+            elif priv.priv_type == 2:
+                self.tb_privs.setdefault((priv.db_name.lower(), priv.table_name.lower()), []).append(grant)
+
+    @staticmethod
+    def _limit(grants):
+        today = datetime.date.today()
+        for valid_date, limit_num in grants:
+            if valid_date >= today:
+                return limit_num
+        return False
+
+    def db_limit(self, db_name):
+        """库权限的limit_num，无有效权限返回False"""
+        return self._limit(self.db_privs.get(str(db_name).lower(), []))
+
+    def tb_limit(self, db_name, tb_name):
+        """表权限的limit_num，无有效权限返回False"""
+        return self._limit(self.tb_privs.get((str(db_name).lower(), str(tb_name).lower()), []))
+
+
+# 查询权限快照缓存，权限变更时由sql.signals递增版本号
+privilege_snapshot_cache = VersionedCache('query_privileges')
+
+
+def privilege_snapshot(user, instance):
+    """获取用户在实例上的查询权限快照"""
+
+    def load():
+        privileges = QueryPrivileges.objects.filter(
+            user_name=user.username, instance=instance, valid_date__gte=datetime.date.today(), is_deleted=0
+        ).order_by('privilege_id').only('db_name', 'table_name', 'valid_date', 'limit_num', 'priv_type')
+        return PrivilegeSnapshot(privileges)
+
+    return privilege_snapshot_cache.get((user.username, instance.id), load)
 
 
 def _db_priv(user, instance, db_name):
@@ -417,16 +475,10 @@ def _db_priv(user, instance, db_name):
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     TODO 返回统一为 int 类型, 不存在返回0 (虽然其实在python中 0==False)
     """
-    # 获取用户库权限
-    user_privileges = QueryPrivileges.objects.filter(user_name=user.username, instance=instance, db_name=str(db_name),
-                                                     valid_date__gte=datetime.datetime.now(), is_deleted=0,
-                                                     priv_type=1)
     if user.is_superuser:
         return int(SysConfig().get('admin_query_limit', 5000))
-    else:
-        if user_privileges.exists():
-            return user_privileges.first().limit_num
-    return False
+    # 获取用户库权限
+    return privilege_snapshot(user, instance).db_limit(db_name)
 
 
 def _tb_priv(user, instance, db_name, tb_name):
@@ -438,16 +490,10 @@ def _tb_priv(user, instance, db_name, tb_name):
     :param tb_name: 表名
     :return: 权限存在则返回对应权限的limit_num，否则返回False
     """
-    # 获取用户表权限
-    user_privileges = QueryPrivileges.objects.filter(user_name=user.username, instance=instance, db_name=str(db_name),
-                                                     table_name=str(tb_name), valid_date__gte=datetime.datetime.now(),
-                                                     is_deleted=0, priv_type=2)
     if user.is_superuser:
         return int(SysConfig().get('admin_query_limit', 5000))
-    else:
-        if user_privileges.exists():
-            return user_privileges.first().limit_num
-    return False
+    # 获取用户表权限
+    return privilege_snapshot(user, instance).tb_limit(db_name, tb_name)
 
 
 def _priv_limit(user, instance, db_name, tb_name=None):
@@ -510,3 +556,5 @@ def _query_apply_audit_call_back(apply_id, workflow_status):
                 limit_num=apply_queryset.limit_num, priv_type=apply_queryset.priv_type) for table_name in
                 apply_queryset.table_list.split(',')]
         QueryPrivileges.objects.bulk_create(insert_list)
+        # bulk_create不触发post_save信号，需要主动使权限快照失效
+        privilege_snapshot_cache.invalidate()
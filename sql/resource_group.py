@@ -10,7 +10,7 @@ from django.http import HttpResponse
 from common.utils.extend_json_encoder import ExtendJSONEncoder
 from common.utils.permission import superuser_required
 from sql.models import ResourceGroup, ResourceGroup2Instance, ResourceGroup2User, Users, Instance
-from sql.utils.resource_group import user_instances
+from sql.utils.resource_group import user_instances, user_instances_cache
 from sql.utils.workflow_audit import Audit
 
 logger = logging.getLogger('default')
@@ -173,6 +173,8 @@ def addrelation(request):
                 [ResourceGroup2Instance(
                     instance_id=int(obj.split(',')[0]), resource_group_id=group_id
                 ) for obj in object_list])
+        # bulk_create不触发post_save信号，需要主动使用户实例映射失效
+        user_instances_cache.invalidate()
         result = {'status': 0, 'msg': 'ok'}
     except Exception as e:
         logger.error(traceback.format_exc())
@@ -0,0 +1,41 @@
+# -*- coding: UTF-8 -*-
+"""
+模型信号处理，配置数据变更时使相关缓存失效
+"""
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from sql.models import DataMaskingRules, DataMaskingColumns, QueryPrivileges, Instance, InstanceTag, \
+    InstanceTagRelations, ResourceGroup, ResourceGroup2User, ResourceGroup2Instance
+from sql.query_privileges import privilege_snapshot_cache
+from sql.utils.data_masking import masking_rules_cache, masking_columns_cache
+from sql.utils.resource_group import user_instances_cache
+
+
+@receiver([post_save, post_delete], sender=DataMaskingRules)
+def invalidate_masking_rules(sender, **kwargs):
+    """脱敏规则变更"""
+    masking_rules_cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=DataMaskingColumns)
+def invalidate_masking_columns(sender, **kwargs):
+    """脱敏字段配置变更"""
+    masking_columns_cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=QueryPrivileges)
+def invalidate_privilege_snapshot(sender, **kwargs):
+    """查询权限授予、变更、删除"""
+    privilege_snapshot_cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Instance)
+@receiver([post_save, post_delete], sender=InstanceTag)
+@receiver([post_save, post_delete, m2m_changed], sender=InstanceTagRelations)
+@receiver([post_save, post_delete], sender=ResourceGroup)
+@receiver([post_save, post_delete, m2m_changed], sender=ResourceGroup2User)
+@receiver([post_save, post_delete, m2m_changed], sender=ResourceGroup2Instance)
+def invalidate_user_instances(sender, **kwargs):
+    """资源组成员、实例、实例标签变更"""
+    user_instances_cache.invalidate()
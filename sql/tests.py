@@ -1,4 +1,7 @@
+import gzip
 import json
+import MySQLdb
+import os
 import re
 from datetime import timedelta, datetime, date
 from unittest.mock import MagicMock, patch, ANY
@@ -13,9 +16,17 @@ from common.config import SysConfig
 from common.utils.const import WorkflowDict
 from sql.binlog import binlog2sql_file
 from sql.engines.models import ResultSet, ReviewSet, ReviewResult
-from sql.notify import notify_for_audit, notify_for_execute, notify_for_binlog2sql
+from sql.notify import notify_for_audit, notify_for_execute, notify_for_binlog2sql, notify_for_query_export
 from sql.utils.execute_sql import execute_callback
-from sql.query import kill_query_conn
+from sql.utils.parse_cache import parse_cache
+from sql.utils.query_log import flush_query_logs
+from sql.query import kill_query_conn, _query_stream_events
+from sql.engines.mysql import MysqlEngine
+from sql.engines.pool import ConnectionPool
+from sql.engines.session import QuerySession
+from sql import query_export
+from sql.data_dictionary import export_dictionary
+from sql.query_export import export_query_result, get_progress
 from sql.models import Instance, QueryPrivilegesApply, QueryPrivileges, SqlWorkflow, SqlWorkflowContent, \
     ResourceGroup, ResourceGroup2User, ParamTemplate, WorkflowAudit, QueryLog
 
@@ -184,6 +195,7 @@ class TestQueryPrivilegesCheck(TestCase):
         Instance.objects.all().delete()
         QueryPrivileges.objects.all().delete()
         self.sys_config.replace(json.dumps({}))
+        parse_cache.clear()
 
     def test_db_priv_super(self):
         """
@@ -253,6 +265,26 @@ class TestQueryPrivilegesCheck(TestCase):
                                           tb_name='table_name')
         self.assertTrue(r)
 
+    def test_privilege_snapshot(self):
+        """
+        测试权限快照，一次查询加载，权限回收后失效，过期权限无效
+        :return:
+        """
+        privilege = QueryPrivileges.objects.create(user_name=self.user.username, instance=self.slave,
+                                                   db_name=self.db_name, valid_date=date.today(),
+                                                   limit_num=10, priv_type=1)
+        QueryPrivileges.objects.create(user_name=self.user.username, instance=self.slave, db_name=self.db_name,
+                                       table_name='table_name', valid_date=date.today() - timedelta(days=1),
+                                       limit_num=20, priv_type=2)
+        sql.query_privileges.privilege_snapshot(self.user, self.slave)
+        with self.assertNumQueries(0):
+            self.assertEqual(sql.query_privileges._db_priv(self.user, self.slave, self.db_name.upper()), 10)
+            self.assertFalse(sql.query_privileges._tb_priv(self.user, self.slave, self.db_name, 'table_name'))
+            self.assertEqual(sql.query_privileges._priv_limit(self.user, self.slave, self.db_name, 'table_name'), 10)
+        privilege.is_deleted = 1
+        privilege.save(update_fields=['is_deleted'])
+        self.assertFalse(sql.query_privileges._db_priv(self.user, self.slave, self.db_name))
+
     @patch('sql.query_privileges._db_priv')
     def test_priv_limit_from_db(self, __db_priv):
         """
@@ -695,12 +727,16 @@ class TestQuery(TransactionTestCase):
                                     'sql_content': some_sql,
                                     'db_name': some_db,
                                     'limit_num': some_limit})
-        _get_engine.return_value.query.assert_called_once_with(some_db, some_sql, some_limit)
+        _get_engine.return_value.query.assert_called_once_with(some_db, some_sql, some_limit, close_conn=False)
         r_json = r.json()
         print(r_json)
         self.assertEqual(r_json['data']['rows'], ['value'])
         self.assertEqual(r_json['data']['column_list'], ['some'])
         self.assertEqual(r_json['data']['seconds_behind_master'], 100)
+        # 查询会话复用同一个连接，并返回各阶段耗时
+        _get_engine.return_value.get_connection.assert_called_once_with(db_name=some_db)
+        self.assertListEqual(list(r_json['data']['timings'].keys()),
+                             ['connect', 'check', 'priv_check', 'rewrite', 'replica_lag', 'execute'])
 
     @patch('sql.query.user_instances')
     @patch('sql.query.get_engine')
@@ -724,7 +760,7 @@ class TestQuery(TransactionTestCase):
                                     'sql_content': sql_without_limit,
                                     'db_name': some_db,
                                     'limit_num': some_limit})
-        _get_engine.return_value.query.assert_called_once_with(some_db, sql_with_limit, some_limit)
+        _get_engine.return_value.query.assert_called_once_with(some_db, sql_with_limit, some_limit, close_conn=False)
         r_json = r.json()
         self.assertEqual(r_json['data']['rows'], ['value'])
         self.assertEqual(r_json['data']['column_list'], ['some'])
@@ -738,7 +774,157 @@ class TestQuery(TransactionTestCase):
                                 'sql_content': sql_with_star,
                                 'db_name': some_db,
                                 'limit_num': some_limit})
-        _get_engine.return_value.query.assert_called_once_with(some_db, filtered_sql_with_star, some_limit)
+        _get_engine.return_value.query.assert_called_once_with(some_db, filtered_sql_with_star, some_limit, close_conn=False)
+
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def test_query_result_cache(self, _priv_check, _get_engine, _user_instances):
+        """开启查询结果缓存，相同查询第二次直接返回缓存"""
+        SysConfig().set('query_cache', 'true')
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query.side_effect = lambda *args, **kwargs: ResultSet(
+            full_sql=some_sql, rows=[('value',)], column_list=['some'], affected_rows=1)
+        _get_engine.return_value.thread_id = None
+        _get_engine.return_value.seconds_behind_master = 100
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        data = {'instance_name': self.slave1.instance_name, 'sql_content': some_sql,
+                'db_name': 'some_db', 'limit_num': 100}
+        r1 = c.post('/query/', data=data).json()
+        r2 = c.post('/query/', data=data).json()
+        SysConfig().set('query_cache', 'false')
+        self.assertFalse(r1['data']['cache_hit'])
+        self.assertTrue(r2['data']['cache_hit'])
+        self.assertEqual(r2['data']['rows'], [['value']])
+        _get_engine.return_value.query.assert_called_once()
+        flush_query_logs(wait=True)
+        self.assertEqual(QueryLog.objects.filter(sqllog=some_sql).count(), 2)
+
+    @patch('sql.query.get_replica_lag', return_value=5)
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def test_query_cached_replica_lag(self, _priv_check, _get_engine, _user_instances, _get_replica_lag):
+        """开启后台采集时读取缓存的主从延迟"""
+        SysConfig().set('replica_lag_interval', '1')
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        q_result = ResultSet(full_sql=some_sql, rows=['value'])
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query.return_value = q_result
+        _get_engine.return_value.seconds_behind_master = 100
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post('/query/', data={'instance_name': self.slave1.instance_name,
+                                    'sql_content': some_sql,
+                                    'db_name': 'some_db',
+                                    'limit_num': 100})
+        SysConfig().set('replica_lag_interval', '0')
+        self.assertEqual(r.json()['data']['seconds_behind_master'], 5)
+        _get_replica_lag.assert_called_once_with(self.slave1)
+
+    @patch('sql.query.save_query_log')
+    @patch('sql.engines.session.query_watchdog')
+    @patch('MySQLdb.connect')
+    def test_query_stream_watchdog_release(self, connect, _watchdog, _save_query_log):
+        """流式查询读取完毕后先取消超时监控，再归还连接"""
+        calls = []
+        cur = connect.return_value.cursor.return_value
+
+        def execute(sql):
+            # 模拟不支持max_execution_time的实例
+            if sql.startswith('set session'):
+                raise MySQLdb.OperationalError(1193, 'Unknown system variable')
+
+        cur.execute.side_effect = execute
+        cur.fetchmany.side_effect = [(('v1',),), ()]
+        cur.description = (('k1', 'some_other_des'),)
+        connect.return_value.thread_id.return_value = 123
+        _watchdog.cancel.side_effect = lambda token: calls.append('cancel') or False
+        prepare_data = {'sql_content': 'select k1 from some_table', 'limit_num': 100, 'priv_check': True}
+        with patch.object(ConnectionPool, 'release', side_effect=lambda conn, discard=False: calls.append(
+                ('release', discard))):
+            session = QuerySession(MysqlEngine(instance=self.slave1), 'some_db').open()
+            events = list(_query_stream_events(self.u2, self.slave1, session, prepare_data, None,
+                                               max_execution_time=10))
+        self.assertEqual(events[-1][1]['status'], 0)
+        self.assertEqual(calls, ['cancel', ('release', False)])
+
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def test_query_stream(self, _priv_check, _get_engine, _user_instances):
+        """测试流式查询"""
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        chunks = [ResultSet(full_sql=some_sql, rows=[('v1',), ('v2',)], column_list=['some']),
+                  ResultSet(full_sql=some_sql, rows=[('v3',)], column_list=['some'])]
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.return_value = iter(chunks)
+        _get_engine.return_value.thread_id = None
+        _get_engine.return_value.seconds_behind_master = 100
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post('/query/stream/', data={'instance_name': self.slave1.instance_name,
+                                           'sql_content': some_sql,
+                                           'db_name': 'some_db',
+                                           'limit_num': 100})
+        lines = [json.loads(line) for line in b''.join(r.streaming_content).decode().splitlines()]
+        self.assertEqual(lines[0], {'column_list': ['some'], 'seconds_behind_master': 100})
+        self.assertEqual(lines[1]['rows'], [['v1'], ['v2']])
+        self.assertEqual(lines[2]['rows'], [['v3']])
+        self.assertEqual(lines[3]['status'], 0)
+        self.assertEqual(lines[3]['affected_rows'], 3)
+        flush_query_logs(wait=True)
+        self.assertEqual(QueryLog.objects.filter(sqllog=some_sql, effect_row=3).count(), 1)
+
+        # 分批写入的单个JSON对象
+        _get_engine.return_value.query_stream.return_value = iter(chunks)
+        r = c.post('/query/stream/', data={'instance_name': self.slave1.instance_name,
+                                           'sql_content': some_sql,
+                                           'db_name': 'some_db',
+                                           'limit_num': 100,
+                                           'format': 'json'})
+        r_json = json.loads(b''.join(r.streaming_content))
+        self.assertEqual(r_json['rows'], [['v1'], ['v2'], ['v3']])
+        self.assertEqual(r_json['status'], 0)
+
+    @patch('sql.query.user_instances')
+    @patch('sql.query.get_engine')
+    @patch('sql.query.query_priv_check')
+    def test_query_stream_error(self, _priv_check, _get_engine, _user_instances):
+        """测试流式查询异常"""
+        c = Client()
+        c.force_login(self.u2)
+        some_sql = 'select some from some_table limit 100;'
+        error_result = ResultSet(full_sql=some_sql)
+        error_result.error = 'some error'
+        _get_engine.return_value.query_check.return_value = {
+            'msg': '', 'bad_query': False, 'filtered_sql': some_sql, 'has_star': False}
+        _get_engine.return_value.filter_sql.return_value = some_sql
+        _get_engine.return_value.query_stream.return_value = iter([error_result])
+        _get_engine.return_value.thread_id = None
+        _priv_check.return_value = {'status': 0, 'data': {'limit_num': 100, 'priv_check': True}}
+        _user_instances.return_value.get.return_value = self.slave1
+        r = c.post('/query/stream/', data={'instance_name': self.slave1.instance_name,
+                                           'sql_content': some_sql,
+                                           'db_name': 'some_db',
+                                           'limit_num': 100,
+                                           'format': 'json'})
+        r_json = json.loads(b''.join(r.streaming_content))
+        self.assertEqual(r_json, {'column_list': [], 'rows': [], 'status': 1, 'msg': 'some error'})
 
     @patch('sql.query.query_priv_check')
     def testStarOptionOn(self, _priv_check):
@@ -775,6 +961,39 @@ class TestQuery(TransactionTestCase):
         r = c.get('/query/querylog/', data=data)
         self.assertEqual(r.json()['total'], 1)
 
+    def test_query_log_keyset(self):
+        """测试查询历史按id游标分页"""
+        c = Client()
+        c.force_login(self.superuser1)
+        logs = [QueryLog.objects.create(instance_name=self.slave1.instance_name, db_name='some_db',
+                                        sqllog=f'select {i};', effect_row=1, cost_time=1,
+                                        username=self.superuser1.username) for i in range(3)]
+        r = c.get('/query/querylog/', data={"limit": 2, "offset": 0})
+        r_json = r.json()
+        self.assertEqual(r_json['total'], 4)
+        self.assertEqual([row['id'] for row in r_json['rows']], [logs[2].id, logs[1].id])
+        r = c.get('/query/querylog/', data={"limit": 2, "offset": 0, "last_id": logs[1].id})
+        self.assertEqual([row['id'] for row in r.json()['rows']], [logs[0].id, self.query_log.id])
+        r = c.get('/query/querylog/', data={"limit": 2, "offset": 1, "last_id": logs[1].id})
+        self.assertEqual([row['id'] for row in r.json()['rows']], [self.query_log.id])
+
+    @patch('sql.query.flush_query_logs')
+    @patch('sql.query.has_pending_logs')
+    def test_query_log_flush(self, _has_pending_logs, _flush_query_logs):
+        """仅查看首页且缓冲中有当前用户的日志时写入数据库"""
+        self.u2.user_permissions.add(Permission.objects.get(codename='menu_sqlquery'))
+        c = Client()
+        c.force_login(self.u2)
+        _has_pending_logs.return_value = False
+        c.get('/query/querylog/', data={"limit": 2, "offset": 0})
+        _has_pending_logs.assert_called_once_with(self.u2.username)
+        _flush_query_logs.assert_not_called()
+        _has_pending_logs.return_value = True
+        c.get('/query/querylog/', data={"limit": 2, "offset": 2, "last_id": self.query_log.id})
+        _flush_query_logs.assert_not_called()
+        c.get('/query/querylog/', data={"limit": 2, "offset": 0})
+        _flush_query_logs.assert_called_once_with(wait=True)
+
     def test_star(self):
         """测试查询语句收藏"""
         c = Client()
@@ -799,6 +1018,91 @@ class TestQuery(TransactionTestCase):
         self.assertEqual(query_log.alias, '')
 
 
+class TestQueryExport(TestCase):
+    def setUp(self):
+        self.slave1 = Instance.objects.create(instance_name='test_slave_instance', type='slave', db_type='mysql',
+                                              host='testhost', port=3306, user='mysql_user', password='mysql_password')
+        self.superuser1 = User.objects.create(username='super1', is_superuser=True)
+        self.client = Client()
+        self.client.force_login(self.superuser1)
+        self.prepare_data = {'sql_content': 'select * from some_table limit 1000000;', 'limit_num': 1000000,
+                             'priv_check': True}
+
+    def tearDown(self):
+        QueryLog.objects.all().delete()
+        self.superuser1.delete()
+        self.slave1.delete()
+
+    @patch('sql.query_export.async_task')
+    @patch('sql.query_export.query_prepare')
+    @patch('sql.query_export.get_engine')
+    def test_export(self, _get_engine, _query_prepare, _async_task):
+        """提交导出任务，管理员使用导出行数上限"""
+        _query_prepare.return_value = {'status': 0, 'msg': 'ok', 'data': self.prepare_data}
+        r = self.client.post('/query/export/', data={'instance_name': self.slave1.instance_name,
+                                                     'db_name': 'some_db',
+                                                     'sql_content': 'select * from some_table',
+                                                     'format': 'csv'})
+        export_id = r.json()['data']['export_id']
+        self.assertEqual(_query_prepare.call_args[1]['admin_limit'], 1000000)
+        self.assertEqual(_async_task.call_args[1]['export_id'], export_id)
+        self.assertEqual(get_progress(export_id)['status'], 'waiting')
+        r = self.client.get('/query/export/status/', data={'export_id': export_id})
+        self.assertEqual(r.json()['data']['username'], self.superuser1.username)
+
+    def test_export_invalid_format(self):
+        r = self.client.post('/query/export/', data={'instance_name': self.slave1.instance_name,
+                                                     'db_name': 'some_db',
+                                                     'sql_content': 'select 1',
+                                                     'format': 'txt'})
+        self.assertEqual(r.json()['status'], 1)
+
+    @patch('sql.query_export._query_stream_events')
+    @patch('sql.query_export.get_engine')
+    def test_export_query_result(self, _get_engine, _events):
+        """分批写入gzip压缩的CSV文件，完成后可下载"""
+        events = [('header', {'column_list': ['id', 'name']}),
+                  ('rows', [[1, 'a'], [2, None]]),
+                  ('rows', [[3, '中文']]),
+                  ('footer', {'status': 0, 'msg': 'ok'})]
+        _events.return_value = (event for event in events)
+        progress = export_query_result('some_export_id', self.superuser1.username, self.slave1.id, 'some_db',
+                                       self.prepare_data, 'csv', {})
+        self.assertEqual(progress['status'], 'finished')
+        self.assertEqual(progress['rows'], 3)
+        self.assertEqual(_events.call_args[1]['max_execution_time'], 0)
+        path = os.path.join(query_export.EXPORT_DIR, progress['file'])
+        with gzip.open(path, 'rt', encoding='utf-8-sig') as f:
+            self.assertEqual(f.read().splitlines(), ['id,name', '1,a', '2,', '3,中文'])
+        r = self.client.get('/query/export/download/', data={'export_id': 'some_export_id'})
+        self.assertEqual(gzip.decompress(b''.join(r.streaming_content)).decode('utf-8-sig').splitlines()[0],
+                         'id,name')
+        os.remove(path)
+
+    @patch('sql.query_export._query_stream_events')
+    @patch('sql.query_export.get_engine')
+    def test_export_query_result_error(self, _get_engine, _events):
+        """导出出错时删除文件"""
+        _events.return_value = (event for event in [('footer', {'status': 1, 'msg': 'some error'})])
+        progress = export_query_result('some_export_id', self.superuser1.username, self.slave1.id, 'some_db',
+                                       self.prepare_data, 'csv', {})
+        self.assertEqual(progress['status'], 'failed')
+        self.assertEqual(progress['msg'], 'some error')
+        self.assertFalse(os.path.exists(os.path.join(query_export.EXPORT_DIR, 'some_export_id.csv.gz')))
+
+    @patch('sql.query_export.QuerySession.open')
+    @patch('sql.query_export.get_engine')
+    def test_export_query_result_connect_error(self, _get_engine, _open):
+        """连接失败时标记导出失败并删除文件"""
+        _open.side_effect = RuntimeError('some connect error')
+        progress = export_query_result('some_export_id', self.superuser1.username, self.slave1.id, 'some_db',
+                                       self.prepare_data, 'csv', {})
+        self.assertEqual(progress['status'], 'failed')
+        self.assertIn('some connect error', progress['msg'])
+        self.assertEqual(get_progress('some_export_id')['status'], 'failed')
+        self.assertFalse(os.path.exists(os.path.join(query_export.EXPORT_DIR, 'some_export_id.csv.gz')))
+
+
 class TestWorkflowView(TransactionTestCase):
 
     def setUp(self):
@@ -2183,6 +2487,22 @@ class TestNotify(TestCase):
         self.assertIsNone(r)
         _msg_sender.assert_called_once()
 
+    @patch('sql.notify.MsgSender')
+    def test_notify_for_query_export(self, _msg_sender):
+        """
+        测试查询结果导出消息，仅发送给导出人
+        :return:
+        """
+        self.sys_config.set('mail', 'true')
+        User.objects.filter(pk=self.user.pk).update(email='test_user@example.com')
+        task = MagicMock(success=True, result={'status': 'finished', 'rows': 10},
+                         kwargs={'username': self.user.username, 'db_name': 'some_db',
+                                 'export_id': 'some_export_id'})
+        notify_for_query_export(task)
+        msg_title, msg_content, msg_to = _msg_sender.return_value.send_email.call_args[0]
+        self.assertIn('some_export_id', msg_content)
+        self.assertEqual(msg_to, ['test_user@example.com'])
+
 
 class TestDataDictionary(TestCase):
     """
@@ -2278,7 +2598,11 @@ class TestDataDictionary(TestCase):
         测试获取表信息
         :return:
         """
-        _get_engine.return_value.query.return_value = ResultSet(rows=(('test1', '测试表1'), ('test2', '测试表2')))
+        _get_engine.return_value.get_table_info.return_value = {
+            'meta_data': {'column_list': ['table_name'], 'rows': ('sql_instance',)},
+            'desc': {'column_list': [], 'rows': []},
+            'index': {'column_list': [], 'rows': []},
+            'create_sql': [('sql_instance', 'create table sql_instance')]}
         data = {
             'instance_name': self.ins.instance_name,
             'db_name': self.db_name,
@@ -2287,6 +2611,9 @@ class TestDataDictionary(TestCase):
         r = self.client.get(path='/data_dictionary/table_info/', data=data)
         self.assertEqual(r.status_code, 200)
         self.assertListEqual(list(json.loads(r.content)['data'].keys()), ['meta_data', 'desc', 'index', 'create_sql'])
+        # 再次获取命中元数据缓存
+        self.client.get(path='/data_dictionary/table_info/', data=data)
+        _get_engine.return_value.get_table_info.assert_called_once_with(db_name=self.db_name, tb_name='sql_instance')
 
     def test_table_info_not_param(self):
         """
@@ -2411,7 +2738,66 @@ class TestDataDictionary(TestCase):
         data = {
             'instance_name': self.ins.instance_name
         }
-        r = self.client.get(path='/data_dictionary/export/', data=data)
+        with patch('sql.data_dictionary.async_task') as _async_task:
+            r = self.client.get(path='/data_dictionary/export/', data=data)
         self.assertEqual(r.status_code, 200)
-        self.assertDictEqual(json.loads(r.content),
-                             {'data': [], 'msg': '实例test_instance数据字典导出成功，请到downloads目录下载！', 'status': 0})
+        result = json.loads(r.content)
+        self.assertEqual(result['msg'], '实例test_instance数据字典导出任务已提交，完成后请到downloads目录下载！')
+        export_id = result['data']['export_id']
+        self.assertEqual(_async_task.call_args[1]['export_id'], export_id)
+        # 执行导出任务
+        _get_engine.return_value.get_all_databases.return_value = ResultSet(rows=['test1', 'test2'])
+        progress = export_dictionary(export_id, self.ins.id, None, 'html')
+        self.assertEqual(progress['status'], 'finished')
+        self.assertEqual(progress['finished'], 2)
+        self.assertEqual(progress['tables'], 4)
+        r = self.client.get(path='/data_dictionary/export/status/', data={'export_id': export_id})
+        self.assertEqual(json.loads(r.content)['data']['status'], 'finished')
+
+    @patch('sql.data_dictionary.get_engine')
+    def test_export_dictionary_failed_db(self, _get_engine):
+        """
+        测试部分库导出失败
+        :return:
+        """
+        error_result = ResultSet()
+        error_result.error = 'some error'
+        _get_engine.return_value.query.return_value = error_result
+        progress = export_dictionary('some_export_id', self.ins.id, ['test1'], 'markdown')
+        self.assertEqual(progress['failed'], ['test1'])
+        self.assertEqual(progress['msg'], '导出失败的库：test1')
+
+    @patch('sql.data_dictionary.get_engine')
+    def test_export_dictionary_error(self, _get_engine):
+        """
+        测试导出任务异常时标记失败
+        :return:
+        """
+        _get_engine.return_value.get_all_databases.side_effect = RuntimeError('some error')
+        progress = export_dictionary('some_export_id', self.ins.id, None, 'html')
+        self.assertEqual(progress['status'], 'failed')
+        self.assertIn('some error', progress['msg'])
+        self.assertIn('finish_time', progress)
+
+    @patch('sql.data_dictionary.get_engine')
+    def test_export_db_markdown(self, _get_engine):
+        """
+        测试按Markdown格式导出，字段和索引各查询一次
+        :return:
+        """
+        _get_engine.return_value.query.side_effect = [
+            ResultSet(rows=({'TABLE_NAME': 't1', 'TABLE_COMMENT': 'c1'},)),
+            ResultSet(rows=({'TABLE_NAME': 't1', 'COLUMN_NAME': 'id', 'COLUMN_TYPE': 'int', 'EXTRA': 'auto_increment',
+                             'COLUMN_KEY': 'PRI', 'IS_NULLABLE': 'NO', 'COLUMN_COMMENT': 'a|b'},)),
+            ResultSet(rows=({'TABLE_NAME': 't1', 'INDEX_NAME': 'PRIMARY', 'COLUMN_NAME': 'id', 'SEQ_IN_INDEX': 1,
+                             'NON_UNIQUE': 0, 'INDEX_TYPE': 'BTREE'},))]
+        data = {
+            'instance_name': self.ins.instance_name,
+            'db_name': self.db_name,
+            'format': 'markdown'
+        }
+        r = self.client.get(path='/data_dictionary/export/', data=data)
+        self.assertEqual(_get_engine.return_value.query.call_count, 3)
+        content = b''.join(r.streaming_content).decode('utf-8')
+        self.assertIn('| id | int |  | NO | 是 | PRI | a\\|b |', content)
+        self.assertIn('| PRIMARY | id | 1 | 是 | BTREE |  |  |', content)
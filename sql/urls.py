@@ -8,7 +8,7 @@ import sql.query_privileges
 import sql.sql_optimize
 from common import auth, config, workflow, dashboard, check, oidcrp
 from sql import views, sql_workflow, sql_analyze, query, slowlog, instance, instance_account, db_diagnostic, \
-    resource_group, binlog, data_dictionary, sqlcron, host
+    resource_group, binlog, data_dictionary, sqlcron, host, query_export
 from sql.utils import tasks
 from common.utils import ding_api
 
@@ -98,17 +98,23 @@ urlpatterns = [
     path('instance/schemasync/', instance.schemasync),
     path('instance/instance_resource/', instance.instance_resource),
     path('instance/describetable/', instance.describe),
+    path('instance/replica_lag/', instance.replica_lag),
 
     path('data_dictionary/', views.data_dictionary),
     path('data_dictionary/table_list/', data_dictionary.table_list),
     path('data_dictionary/table_info/', data_dictionary.table_info),
     path('data_dictionary/export/', data_dictionary.export),
+    path('data_dictionary/export/status/', data_dictionary.export_status),
 
     path('param/list/', instance.param_list),
     path('param/history/', instance.param_history),
     path('param/edit/', instance.param_edit),
 
     path('query/', query.query),
+    path('query/stream/', query.query_stream),
+    path('query/export/', query_export.export),
+    path('query/export/status/', query_export.export_status),
+    path('query/export/download/', query_export.export_download),
     path('query/querylog/', query.querylog),
     path('query/favorite/', query.favorite),
     path('query/explain/', sql.sql_optimize.explain),
@@ -1,86 +1,194 @@
 # -*- coding:utf-8 -*-
 import logging
+import multiprocessing
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from itertools import chain
 
+import django
 import sqlparse
 from sqlparse.tokens import Keyword
 
 from common.config import SysConfig
+from common.utils.versioned_cache import VersionedCache
 from sql.engines.inception import InceptionEngine
 from sql.models import DataMaskingRules, DataMaskingColumns
+from sql.utils.parse_cache import parse_cache
 import re
 
 logger = logging.getLogger('default')
 
 
-# TODO 待优化，没想好
+class MaskingRule:
+    """预编译的脱敏规则，正则匹配必须分组，隐藏的组会使用****代替"""
+
+    def __init__(self, rule):
+        self.rule_type = rule.rule_type
+        self.hide_group = int(rule.hide_group)
+        self.pattern = re.compile(rule.rule_regex, re.I)
+        # brute_mask使用的替换模板
+        self.replace_pattern = ''.join(
+            '****' if i == self.hide_group else f'\\{i}' for i in range(1, self.pattern.groups + 1))
+
+    def mask(self, value):
+        """按分组拼接匹配结果，未匹配时返回原值"""
+        m = self.pattern.search(str(value))
+        if not m or not m.lastindex:
+            return value
+        return ''.join('****' if i == self.hide_group else (m.group(i) or '') for i in range(1, m.lastindex + 1))
+
+    def sub(self, value):
+        """替换值中所有匹配的内容"""
+        return self.pattern.sub(self.replace_pattern, str(value))
+
+
+# 脱敏规则缓存，规则变更时由sql.signals递增版本号
+masking_rules_cache = VersionedCache('data_masking_rules')
+
+
+def get_masking_rules():
+    """获取预编译的脱敏规则 {rule_type: MaskingRule}"""
+    return masking_rules_cache.get(
+        'rules', lambda: {rule.rule_type: MaskingRule(rule) for rule in DataMaskingRules.objects.all()})
+
+
+# 脱敏字段索引缓存，进程内和Redis两级缓存，字段配置变更时由sql.signals递增版本号
+masking_columns_cache = VersionedCache('data_masking_columns', shared_timeout=24 * 60 * 60)
+
+
+def _load_masking_columns(instance_id):
+    """
+    加载实例的脱敏字段索引
+    tables: 激活的脱敏字段 {(库名, 表名): {字段名: (字段名原值, 规则类型)}}，key统一小写，与数据库默认排序规则一致不区分大小写
+    rule_types: 实例配置的全部规则类型，包含未激活字段，供brute_mask使用
+    """
+    tables = {}
+    rule_types = set()
+    for column in DataMaskingColumns.objects.filter(instance_id=instance_id).order_by('column_id'):
+        rule_types.add(column.rule_type)
+        if column.active:
+            table = tables.setdefault((column.table_schema.lower(), column.table_name.lower()), {})
+            table[column.column_name.lower()] = (column.column_name, column.rule_type)
+    return {'tables': tables, 'rule_types': rule_types}
+
+
+def get_masking_columns(instance):
+    """获取实例的脱敏字段索引"""
+    return masking_columns_cache.get(instance.id, lambda: _load_masking_columns(instance.id))
+
+
+def _table_columns(masking_columns, table_schema, table_name):
+    """获取表的脱敏字段 {字段名: (字段名原值, 规则类型)}"""
+    return masking_columns['tables'].get((str(table_schema).lower(), str(table_name).lower()), {})
+
 
 def data_masking(instance, db_name, sql, sql_result):
     """脱敏数据"""
     try:
-        if SysConfig().get('query_check'):
-            # 解析查询语句，禁用部分Inception无法解析关键词
-            p = sqlparse.parse(sql)[0]
-            for token in p.tokens:
-                if token.ttype is Keyword and token.value.upper() in ['UNION', 'UNION ALL']:
-                    logger.warning(f'数据脱敏异常，错误信息：不支持该查询语句脱敏！请联系管理员')
-                    sql_result.error = '不支持该查询语句脱敏！请联系管理员'
-                    sql_result.status = 1
-                    return sql_result
-        # 通过inception获取语法树,并进行解析
-        inception_engine = InceptionEngine()
-        query_tree = inception_engine.query_print(instance=instance, db_name=db_name, sql=sql)
-        # 分析语法树获取命中脱敏规则的列数据
-        table_hit_columns, hit_columns = analyze_query_tree(query_tree, instance)
-        sql_result.mask_rule_hit = True if table_hit_columns or hit_columns else False
+        # 分析语句获取命中脱敏规则的列数据
+        sql_result.mask_rule_hit, hit_columns = masking_hit_columns(instance, db_name, sql, sql_result.column_list)
     except Exception as msg:
         logger.warning(f'数据脱敏异常，错误信息：{traceback.format_exc()}')
         sql_result.error = str(msg)
         sql_result.status = 1
     else:
-        # 存在select * 的查询,遍历column_list,获取命中列的index,添加到hit_columns
-        if table_hit_columns and sql_result.rows:
-            column_list = sql_result.column_list
-            table_hit_column = dict()
-            for column_info in table_hit_columns:
-                table_hit_column[column_info['column_name']] = column_info['rule_type']
-            for index, item in enumerate(column_list):
-                if item in table_hit_column.keys():
-                    hit_columns.append({
-                        "column_name": item,
-                        "index": index,
-                        "rule_type": table_hit_column.get(item)
-                    })
-
         # 对命中规则列hit_columns的数据进行脱敏
-        # 获取全部脱敏规则信息，减少循环查询，提升效率
-        masking_rules = DataMaskingRules.objects.all()
         if hit_columns and sql_result.rows:
-            rows = list(sql_result.rows)
-            for column in hit_columns:
-                index = column['index']
-                for idx, item in enumerate(rows):
-                    rows[idx] = list(item)
-                    rows[idx][index] = regex(masking_rules, column['rule_type'], rows[idx][index])
-                sql_result.rows = rows
+            sql_result.rows = mask_rows(sql_result.rows, hit_columns, get_masking_rules())
             # 脱敏结果
             sql_result.is_masked = True
     return sql_result
 
 
+def data_masking_stream(instance, db_name, sql, sql_results):
+    """
+    流式脱敏数据，sql_results为分批返回的结果集生成器
+    命中规则的列仅在第一批结果集分析一次，后续批次直接复用
+    分析异常时每一批结果集都会写入error并保持原数据，由调用方决定是否放行
+    """
+    hit_columns = None
+    error = None
+    masking_rules = get_masking_rules()
+    for sql_result in sql_results:
+        if hit_columns is None and error is None:
+            try:
+                mask_rule_hit, hit_columns = masking_hit_columns(instance, db_name, sql, sql_result.column_list)
+            except Exception as msg:
+                logger.warning(f'数据脱敏异常，错误信息：{traceback.format_exc()}')
+                error = str(msg)
+        if error:
+            sql_result.error = error
+            sql_result.status = 1
+        else:
+            sql_result.mask_rule_hit = mask_rule_hit
+            if hit_columns and sql_result.rows:
+                sql_result.rows = mask_rows(sql_result.rows, hit_columns, masking_rules)
+                sql_result.is_masked = True
+        yield sql_result
+
+
+def masking_hit_columns(instance, db_name, sql, column_list):
+    """分析查询语句，返回 (是否命中脱敏规则, 结果集中命中脱敏规则的列信息)"""
+    if SysConfig().get('query_check'):
+        # 解析查询语句，禁用部分Inception无法解析关键词
+        p = sqlparse.parse(sql)[0]
+        for token in p.tokens:
+            if token.ttype is Keyword and token.value.upper() in ['UNION', 'UNION ALL']:
+                raise Exception('不支持该查询语句脱敏！请联系管理员')
+    # 通过inception获取语法树,并进行解析，仅常量不同的语句复用缓存的解析结果
+    query_tree = parse_cache.get('query_tree', instance, db_name, sql, lambda: _query_tree(instance, db_name, sql))
+    # 分析语法树获取命中脱敏规则的列数据
+    table_hit_columns, hit_columns = analyze_query_tree(query_tree, instance)
+    # 存在select * 的查询,遍历column_list,获取命中列的index,添加到hit_columns
+    if table_hit_columns:
+        table_hit_column = dict()
+        for column_info in table_hit_columns:
+            table_hit_column[column_info['column_name']] = column_info['rule_type']
+        for index, item in enumerate(column_list or []):
+            if item in table_hit_column.keys():
+                hit_columns.append({
+                    "column_name": item,
+                    "index": index,
+                    "rule_type": table_hit_column.get(item)
+                })
+    return bool(table_hit_columns or hit_columns), hit_columns
+
+
+def mask_rows(rows, hit_columns, masking_rules):
+    """
+    对命中规则列hit_columns的数据进行脱敏，返回脱敏后的行列表
+    一次遍历结果集，每行依次处理全部命中列
+    :param masking_rules: 预编译的脱敏规则 {rule_type: MaskingRule}
+    """
+    maskers = [(column['index'], masking_rules[column['rule_type']])
+               for column in hit_columns if column['rule_type'] in masking_rules]
+    masked_rows = []
+    for row in rows:
+        row = list(row)
+        for index, rule in maskers:
+            row[index] = rule.mask(row[index])
+        masked_rows.append(row)
+    return masked_rows
+
+
+def _query_tree(instance, db_name, sql):
+    """通过inception获取语法树，仅保留脱敏分析需要的select_list和table_ref"""
+    query_tree = InceptionEngine().query_print(instance=instance, db_name=db_name, sql=sql)
+    return {'select_list': query_tree.get('select_list', []), 'table_ref': query_tree.get('table_ref', [])}
+
+
 def analyze_query_tree(query_tree, instance):
     """解析query_tree,获取语句信息,并返回命中脱敏规则的列信息"""
     old_select_list = query_tree.get('select_list', [])
     table_ref = query_tree.get('table_ref', [])
 
-    # 获取全部激活的脱敏字段信息，减少循环查询，提升效率
-    masking_columns = DataMaskingColumns.objects.filter(active=True)
+    # 获取实例的脱敏字段索引，后续仅做字典查找
+    masking_columns = get_masking_columns(instance)
 
     # 判断语句涉及的表是否存在脱敏字段配置
-    hit = False
-    for table in table_ref:
-        if masking_columns.filter(instance=instance, table_schema=table['db'], table_name=table['table']).exists():
-            hit = True
+    hit = any(_table_columns(masking_columns, table['db'], table['table']) for table in table_ref)
     # 不存在脱敏字段则直接跳过规则解析
     if not hit:
         table_hit_columns = []
@@ -194,8 +302,7 @@ def analyze_query_tree(query_tree, instance):
 
 def hit_column(masking_columns, instance, table_schema, table_name, column_name):
     """判断字段是否命中脱敏规则,如果命中则返回脱敏的规则id和规则类型"""
-    column_info = masking_columns.filter(instance=instance, table_schema=table_schema,
-                                         table_name=table_name, column_name=column_name)
+    column_info = _table_columns(masking_columns, table_schema, table_name).get(str(column_name).lower())
 
     hit_column_info = {
         "instance_name": instance.instance_name,
@@ -208,7 +315,7 @@ def hit_column(masking_columns, instance, table_schema, table_name, column_name)
 
     # 命中规则
     if column_info:
-        hit_column_info['rule_type'] = column_info[0].rule_type
+        hit_column_info['rule_type'] = column_info[1]
         hit_column_info['is_hit'] = True
 
     return hit_column_info
@@ -216,45 +323,99 @@ def hit_column(masking_columns, instance, table_schema, table_name, column_name)
 
 def hit_table(masking_columns, instance, table_schema, table_name):
     """获取表中所有命中脱敏规则的字段信息，用于select *的查询"""
-    columns_info = masking_columns.filter(instance=instance, table_schema=table_schema, table_name=table_name)
+    columns_info = _table_columns(masking_columns, table_schema, table_name)
 
     # 命中规则列
     hit_columns_info = []
-    for column in columns_info:
+    for column_name, rule_type in columns_info.values():
         hit_columns_info.append({
             "instance_name": instance.instance_name,
             "table_schema": table_schema,
             "table_name": table_name,
             "is_hit": True,
-            "column_name": column.column_name,
-            "rule_type": column.rule_type
+            "column_name": column_name,
+            "rule_type": rule_type
         })
     return hit_columns_info
 
 
-def regex(masking_rules, rule_type, value):
-    """利用正则表达式脱敏数据"""
-    rules_info = masking_rules.get(rule_type=rule_type)
-    if rules_info:
-        rule_regex = rules_info.rule_regex
-        hide_group = rules_info.hide_group
-        # 正则匹配必须分组，隐藏的组会使用****代替
-        try:
-            p = re.compile(rule_regex, re.I)
-            m = p.search(str(value))
-            masking_str = ''
-            for i in range(m.lastindex):
-                if i == hide_group - 1:
-                    group = '****'
-                else:
-                    group = m.group(i + 1)
-                masking_str = masking_str + group
-            return masking_str
-        except AttributeError:
-            return value
-    else:
+# 结果集单元格数超过该值时使用进程池分批脱敏
+BRUTE_MASK_PARALLEL_CELLS = 200000
+# 进程池每批处理的行数
+BRUTE_MASK_CHUNK_ROWS = 5000
+# 不需要脱敏的字段类型，兼容cx_Oracle、pyodbc的cursor.description类型名
+NON_TEXT_TYPES = {
+    'NUMBER', 'NATIVE_FLOAT', 'NATIVE_INT', 'DATETIME', 'TIMESTAMP', 'INTERVAL', 'BINARY', 'LONG_BINARY', 'BLOB',
+    'BFILE', 'BOOLEAN', 'int', 'float', 'Decimal', 'datetime', 'date', 'time', 'bool', 'bytes', 'bytearray', 'UUID',
+}
+_brute_mask_executor = None
+_brute_mask_workers = 0
+
+
+def column_type_name(type_code):
+    """cursor.description中的字段类型名"""
+    return getattr(type_code, 'name', None) or getattr(type_code, '__name__', None) or str(type_code)
+
+
+class BruteMasker:
+    """
+    按顺序应用预编译的脱敏规则，每条规则作用于前一条规则的结果
+    规则之间可能重叠(如手机号与身份证号)，不能合并为一个正则，否则最先匹配的规则生效，结果与逐条替换不同
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def sub(self, value):
+        value = str(value)
+        for rule in self.rules:
+            value = rule.sub(value)
         return value
 
+    def mask_rows(self, rows, columns=None):
+        """
+        脱敏行数据，返回tuple列表
+        :param columns: 需要脱敏的列index，None表示全部列
+        """
+        masked_rows = []
+        for row in rows:
+            row = list(row)
+            for index in (range(len(row)) if columns is None else columns):
+                if row[index] is not None:
+                    row[index] = self.sub(row[index])
+            masked_rows.append(tuple(row))
+        return masked_rows
+
+
+def _text_columns(sql_result):
+    """根据字段类型获取需要脱敏的列index，字段类型未知时返回None即全部列"""
+    column_type = getattr(sql_result, 'column_type', None)
+    if not column_type:
+        return None
+    return [index for index, type_name in enumerate(column_type) if type_name not in NON_TEXT_TYPES]
+
+
+def _executor(workers):
+    """
+    获取脱敏进程池，进程数修改后重建
+    web和worker进程中已有其他线程，fork出的子进程可能继承被持有的锁，使用spawn启动并初始化django
+    """
+    global _brute_mask_executor, _brute_mask_workers
+    if _brute_mask_executor is not None and _brute_mask_workers != workers:
+        _shutdown_executor()
+    if _brute_mask_executor is None:
+        _brute_mask_executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=django.setup)
+        _brute_mask_workers = workers
+    return _brute_mask_executor
+
+
+def _shutdown_executor():
+    global _brute_mask_executor
+    if _brute_mask_executor is not None:
+        _brute_mask_executor.shutdown(wait=False)
+        _brute_mask_executor = None
+
 
 def brute_mask(instance, sql_result):
     """输入的是一个resultset 
@@ -264,22 +425,28 @@ def brute_mask(instance, sql_result):
     返回同样结构的sql_result , error 中写入脱敏时产生的错误.
     """
     # 读取所有关联实例的脱敏规则，去重后应用到结果集，不会按照具体配置的字段匹配
-    rule_types = DataMaskingColumns.objects.filter(instance=instance).values_list('rule_type', flat=True).distinct()
-    masking_rules = DataMaskingRules.objects.filter(rule_type__in=rule_types)
-    for reg in masking_rules:
-        compiled_r = re.compile(reg.rule_regex, re.I)
-        replace_pattern = r""
-        rows = list(sql_result.rows)
-        for i in range(1, compiled_r.groups + 1):
-            if i == int(reg.hide_group):
-                replace_pattern += r"****"
-            else:
-                replace_pattern += r"\{}".format(i)
-        for i in range(len(sql_result.rows)):
-            temp_value_list = []
-            for j in range(len(sql_result.rows[i])):
-                # 进行正则替换
-                temp_value_list += [compiled_r.sub(replace_pattern, str(sql_result.rows[i][j]))]
-            rows[i] = tuple(temp_value_list)
-        sql_result.rows = rows
+    rule_types = get_masking_columns(instance)['rule_types']
+    masking_rules = get_masking_rules()
+    rules = [masking_rules[rule_type] for rule_type in sorted(rule_types) if rule_type in masking_rules]
+    if not rules or not sql_result.rows:
+        return sql_result
+    masker = BruteMasker(rules)
+    # 数值、时间、二进制类型的列不脱敏
+    columns = _text_columns(sql_result)
+    if columns == []:
+        return sql_result
+    rows = sql_result.rows
+    cells = len(rows) * (len(rows[0]) if columns is None else len(columns))
+    workers = int(SysConfig().get('brute_mask_workers', 0) or 0)
+    if workers > 0 and cells >= BRUTE_MASK_PARALLEL_CELLS:
+        # 大结果集按行分批交给进程池处理
+        chunks = [rows[i:i + BRUTE_MASK_CHUNK_ROWS] for i in range(0, len(rows), BRUTE_MASK_CHUNK_ROWS)]
+        try:
+            sql_result.rows = list(chain.from_iterable(
+                _executor(workers).map(partial(masker.mask_rows, columns=columns), chunks)))
+            return sql_result
+        except BrokenProcessPool:
+            logger.warning(f'脱敏进程池异常，改为单进程处理，错误信息：{traceback.format_exc()}')
+            _shutdown_executor()
+    sql_result.rows = masker.mask_rows(rows, columns)
     return sql_result
@@ -1,11 +1,13 @@
 # -*- coding: UTF-8 -*-
 
 from django.db import close_old_connections, connection
-from django_redis import get_redis_connection
+from django_q.tasks import async_task
 from common.utils.const import WorkflowDict
 from sql.engines.models import ReviewResult, ReviewSet
 from sql.models import SqlWorkflow
 from sql.notify import notify_for_execute
+from sql.utils.metadata_cache import invalidate_metadata, warm_up_metadata
+from sql.utils.query_cache import invalidate_instance
 from sql.utils.workflow_audit import Audit
 from sql.engines import get_engine
 
@@ -74,11 +76,12 @@ def execute_callback(task):
                   operator_display='系统'
                   )
 
-    # DDL工单结束后清空实例资源缓存
+    # DDL工单结束后清空实例元数据缓存以及查询结果缓存，并重新预热工单所在库的元数据
     if workflow.syntax_type == 1:
-        r = get_redis_connection("default")
-        for key in r.scan_iter(match='*insRes*', count=2000):
-            r.delete(key)
+        invalidate_metadata(workflow.instance)
+        invalidate_instance(workflow.instance)
+        async_task(warm_up_metadata, workflow.instance.id, [workflow.db_name],
+                   task_name=f'metadata-warm-up-{workflow.instance.id}')
 
     # 发送消息
     notify_for_execute(workflow)
@@ -0,0 +1,165 @@
+# -*- coding: UTF-8 -*-
+"""
+实例元数据缓存，缓存资源浏览使用的库、schema、表、字段列表和表结构，以及数据字典的表信息，存放在django-redis缓存中
+* 缓存key包含实例的元数据版本号，DDL工单执行结束后递增版本号，旧缓存自然过期，失效无需扫描key
+* 实例信息变更后update_time变化，缓存随之失效
+* 预热任务按库一次批量查询全部表和字段，写入与资源浏览相同的缓存key
+"""
+import hashlib
+import logging
+import traceback
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.engines.models import ResultSet
+from sql.models import Instance
+
+logger = logging.getLogger('default')
+
+# 资源浏览按schema区分表的数据库类型
+SCHEMA_DB_TYPES = ('pgsql',)
+# 表列表中排除的表，与engine的get_all_tables保持一致
+EXCLUDED_TABLES = ('test',)
+
+
+def _generation_key(instance_id):
+    return f'metadata_gen:{instance_id}'
+
+
+def get_generation(instance):
+    """实例当前的元数据版本号，读取失败返回None"""
+    try:
+        return cache.get(_generation_key(instance.id), 0)
+    except Exception as e:
+        logger.error(f'读取元数据缓存版本号失败:{e}')
+        return None
+
+
+def invalidate_metadata(instance):
+    """递增实例元数据版本号，实例已有的元数据缓存全部失效"""
+    key = _generation_key(instance.id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+    except Exception as e:
+        logger.error(f'元数据缓存失效失败:{e}{traceback.format_exc()}')
+
+
+class MetadataCache:
+    """单个实例的元数据缓存，未命中时调用engine的同名方法获取，报错的结果不缓存"""
+
+    def __init__(self, instance, engine=None):
+        self.instance = instance
+        self.engine = engine or get_engine(instance=instance)
+        self.timeout = int(SysConfig().get('metadata_cache_ttl', 3600))
+
+    def _key(self, generation, method, kwargs):
+        # 参数统一按名称排序，None值不参与，保证不同调用方式得到相同的key
+        args = '\n'.join(f'{k}={v}' for k, v in sorted(kwargs.items()) if v is not None)
+        digest = hashlib.md5(args.encode('utf-8')).hexdigest()
+        update_time = self.instance.update_time.timestamp() if self.instance.update_time else 0
+        return f'metadata:{self.instance.id}:{update_time}:{generation}:{method}:{digest}'
+
+    def get(self, method, **kwargs):
+        """
+        获取元数据，返回engine方法的返回值，通常为ResultSet
+        :param method: engine方法名，如get_all_tables、describe_table
+        :param kwargs: engine方法参数
+        """
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        generation = get_generation(self.instance)
+        # 版本号不可用时不使用缓存，保证数据正确
+        if self.timeout <= 0 or generation is None:
+            return getattr(self.engine, method)(**kwargs)
+        key = self._key(generation, method, kwargs)
+        try:
+            result = cache.get(key)
+        except Exception as e:
+            logger.error(f'读取元数据缓存失败:{e}')
+            result = None
+        if result is None:
+            result = getattr(self.engine, method)(**kwargs)
+            if not getattr(result, 'error', None):
+                try:
+                    cache.set(key, result, timeout=self.timeout)
+                except Exception as e:
+                    logger.error(f'写入元数据缓存失败:{e}')
+        return result
+
+    def get_all_databases(self):
+        return self.get('get_all_databases')
+
+    def get_all_schemas(self, db_name):
+        return self.get('get_all_schemas', db_name=db_name)
+
+    def get_all_tables(self, db_name, schema_name=None):
+        return self.get('get_all_tables', db_name=db_name, schema_name=schema_name)
+
+    def get_all_columns_by_tb(self, db_name, tb_name, schema_name=None):
+        return self.get('get_all_columns_by_tb', db_name=db_name, tb_name=tb_name, schema_name=schema_name)
+
+    def describe_table(self, db_name, tb_name, schema_name=None):
+        return self.get('describe_table', db_name=db_name, tb_name=tb_name, schema_name=schema_name)
+
+    def get_table_info(self, db_name, tb_name):
+        return self.get('get_table_info', db_name=db_name, tb_name=tb_name)
+
+    def prefetch(self, db_name):
+        """
+        一次查询获取库内全部表和字段，写入表列表和字段列表缓存
+        :return: 缓存的表数量，engine不支持批量获取时返回0
+        """
+        generation = get_generation(self.instance)
+        if self.timeout <= 0 or generation is None:
+            return 0
+        columns = self.engine.get_all_columns(db_name)
+        if columns.error:
+            raise RuntimeError(columns.error)
+        # {schema: {table: [column, ...]}}，保持查询返回的顺序
+        schemas = OrderedDict()
+        for schema_name, tb_name, column_name in columns.rows:
+            schemas.setdefault(schema_name, OrderedDict()).setdefault(tb_name, []).append(column_name)
+        with_schema = self.instance.db_type in SCHEMA_DB_TYPES
+        entries = {}
+        for schema_name, tables in schemas.items():
+            schema_name = schema_name if with_schema else None
+            entries[self._key(generation, 'get_all_tables', {'db_name': db_name, 'schema_name': schema_name})] = \
+                self._result_set([tb for tb in tables if tb not in EXCLUDED_TABLES])
+            for tb_name, column_list in tables.items():
+                key = self._key(generation, 'get_all_columns_by_tb',
+                                {'db_name': db_name, 'tb_name': tb_name, 'schema_name': schema_name})
+                entries[key] = self._result_set(column_list)
+        cache.set_many(entries, timeout=self.timeout)
+        return sum(len(tables) for tables in schemas.values())
+
+    @staticmethod
+    def _result_set(rows):
+        return ResultSet(rows=rows, affected_rows=len(rows))
+
+
+def warm_up_metadata(instance_id, db_names=None):
+    """
+    预热实例元数据缓存，供django_q异步调用
+    :param instance_id: 实例id
+    :param db_names: 需要预热的库，为空时预热全部库
+    :return: {库名: 表数量}
+    """
+    instance = Instance.objects.get(pk=instance_id)
+    metadata = MetadataCache(instance)
+    if not db_names:
+        databases = metadata.get_all_databases()
+        if databases.error:
+            raise RuntimeError(databases.error)
+        db_names = databases.rows
+    result = {}
+    for db_name in db_names:
+        try:
+            result[db_name] = metadata.prefetch(db_name)
+        except Exception as e:
+            logger.error(f'元数据缓存预热失败，实例：{instance.instance_name}，库：{db_name}，错误信息：{e}')
+            result[db_name] = -1
+    return result
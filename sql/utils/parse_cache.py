@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+"""
+语法解析结果缓存，缓存Inception/goInception解析得到的语句信息(涉及的表、select列表)，避免重复请求解析服务
+key由实例、数据库和参数化后的语句指纹组成，仅常量不同的语句共享同一个解析结果
+进程内LRU，可选Redis共享缓存
+"""
+import copy
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+logger = logging.getLogger('default')
+
+# 反引号标识符和双引号内容原样保留，单引号字符串、十六进制和数字常量替换为?，连续空白合并
+_literal_re = re.compile(r"""(`[^`]*`|"(?:[^"\\]|\\.)*")|'(?:[^'\\]|\\.|'')*'|\b0x[0-9a-f]+\b|\b\d+(?:\.\d+)?(?:e[+-]?\d+)?\b|(\s+)""",
+                         re.I)
+# in (?, ?, ?) 合并为 in (?)
+_in_list_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def _normalize(m):
+    if m.group(1):
+        return m.group(1)
+    if m.group(2):
+        return ' '
+    return '?'
+
+
+def parameterize_sql(sql):
+    """参数化语句，常量替换为?并合并空白，仅常量不同的语句结果相同"""
+    sql = _literal_re.sub(_normalize, sql)
+    sql = _in_list_re.sub('(?)', sql)
+    return sql.strip().rstrip(';').strip()
+
+
+class ParseCache:
+    """解析结果缓存，返回值为深拷贝，调用方可以直接修改"""
+
+    def __init__(self, max_size=2048, shared_timeout=None):
+        """
+        :param max_size: 进程内缓存的最大条目数
+        :param shared_timeout: Redis共享缓存的过期时间，单位秒，None表示不使用共享缓存
+        """
+        self.max_size = max_size
+        self.shared_timeout = shared_timeout
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(namespace, instance, db_name, sql):
+        digest = hashlib.md5(parameterize_sql(sql).encode('utf-8')).hexdigest()
+        update_time = instance.update_time.timestamp() if instance.update_time else 0
+        return f'parse_cache:{namespace}:{instance.id}:{update_time}:{db_name}:{digest}'
+
+    def get(self, namespace, instance, db_name, sql, loader):
+        """
+        读取解析结果，未命中时调用loader解析并缓存，解析异常不缓存
+        :param namespace: 解析结果类型，如query_tree、table_ref
+        :param loader: 解析函数，无参数
+        """
+        key = self._key(namespace, instance, db_name, sql)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return copy.deepcopy(self._cache[key])
+        value = self._shared_get(key)
+        if value is None:
+            value = loader()
+            self._shared_set(key, value)
+        self._add(key, value)
+        return copy.deepcopy(value)
+
+    def _add(self, key, value):
+        with self._lock:
+            self._cache[key] = copy.deepcopy(value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _shared_get(self, key):
+        if self.shared_timeout is None:
+            return None
+        try:
+            return cache.get(key)
+        except Exception as e:
+            logger.error(f'读取语法解析缓存失败:{e}')
+            return None
+
+    def _shared_set(self, key, value):
+        if self.shared_timeout is None:
+            return
+        try:
+            cache.set(key, value, timeout=self.shared_timeout)
+        except Exception as e:
+            logger.error(f'写入语法解析缓存失败:{e}')
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+parse_cache = ParseCache(shared_timeout=24 * 60 * 60)
@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+"""
+在线查询结果缓存，压缩后存放在django-redis缓存中，默认关闭
+缓存key包含实例、数据库、语句指纹、limit_num和脱敏配置，实例执行DDL工单后通过递增实例版本号使缓存失效
+"""
+import hashlib
+import logging
+import re
+import time
+import traceback
+import zlib
+
+import simplejson as json
+from django.core.cache import cache
+
+from common.config import SysConfig
+from common.utils.extend_json_encoder import ExtendJSONEncoderFTime
+from sql.utils.data_masking import masking_rules_cache, masking_columns_cache
+
+logger = logging.getLogger('default')
+
+# 保留引号内的内容，仅合并引号外的连续空白
+_fingerprint_re = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+
+def normalize_sql(sql):
+    """规范化语句，合并引号外的空白并去除结尾分号，常量不变，保证结果一致"""
+    sql = _fingerprint_re.sub(lambda m: m.group(1) or ' ', sql)
+    return sql.strip().rstrip(';').strip()
+
+
+def _generation_key(instance_id):
+    return f'query_cache_gen:{instance_id}'
+
+
+def invalidate_instance(instance):
+    """递增实例缓存版本号，实例已有的查询结果缓存全部失效"""
+    key = _generation_key(instance.id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+    except Exception as e:
+        logger.error(f'查询结果缓存失效失败:{e}{traceback.format_exc()}')
+
+
+def instance_ttl(instance, config=None):
+    """
+    获取实例的缓存时间，单位秒
+    query_cache_instance_ttl 格式为 实例名:秒数,实例名:秒数，未配置的实例使用 query_cache_ttl
+    """
+    config = config or SysConfig()
+    ttl = int(config.get('query_cache_ttl', 60))
+    for item in config.get('query_cache_instance_ttl', '').split(','):
+        name, _, value = item.strip().rpartition(':')
+        if name == instance.instance_name and value.strip().isdigit():
+            ttl = int(value)
+    return ttl
+
+
+def masking_profile(instance, config=None):
+    """当前生效的脱敏配置摘要，脱敏配置变化后缓存key随之变化"""
+    config = config or SysConfig()
+    if not config.get('data_masking'):
+        return 'off'
+    return f"{masking_columns_cache.version()}:{masking_rules_cache.version()}"
+
+
+class QueryResultCache:
+    """单条查询语句的结果缓存"""
+
+    def __init__(self, instance, db_name, sql, limit_num, schema_name=None):
+        config = SysConfig()
+        self.ttl = instance_ttl(instance, config) if config.get('query_cache') else 0
+        self.max_size = int(config.get('query_cache_max_size', 1024 * 1024))
+        self.key = None
+        # 仅缓存select语句
+        if self.ttl <= 0 or not re.match(r"^select", sql.strip(), re.I):
+            return
+        try:
+            generation = cache.get(_generation_key(instance.id), 0)
+            digest = hashlib.md5('\n'.join([
+                str(db_name), str(schema_name), normalize_sql(sql), str(limit_num),
+                masking_profile(instance, config)]).encode('utf-8')).hexdigest()
+            self.key = f'query_cache:{instance.id}:{generation}:{digest}'
+        except Exception as e:
+            logger.error(f'生成查询结果缓存key失败:{e}{traceback.format_exc()}')
+
+    @property
+    def enabled(self):
+        return self.key is not None
+
+    def get(self):
+        """返回缓存的查询结果，增加cache_hit和cache_age字段，未命中返回None"""
+        if not self.enabled:
+            return None
+        try:
+            value = cache.get(self.key)
+        except Exception as e:
+            logger.error(f'读取查询结果缓存失败:{e}{traceback.format_exc()}')
+            return None
+        if not value:
+            return None
+        cache_time, payload = value
+        data = json.loads(zlib.decompress(payload), use_decimal=True)
+        data['cache_hit'] = True
+        data['cache_age'] = round(time.time() - cache_time, 3)
+        return data
+
+    def set(self, data):
+        """缓存查询结果，压缩后超过query_cache_max_size的结果不缓存"""
+        if not self.enabled:
+            return False
+        try:
+            payload = zlib.compress(
+                json.dumps(data, cls=ExtendJSONEncoderFTime, bigint_as_string=True).encode('utf-8'))
+            if len(payload) > self.max_size:
+                return False
+            cache.set(self.key, (time.time(), payload), timeout=self.ttl)
+            return True
+        except Exception as e:
+            logger.error(f'写入查询结果缓存失败:{e}{traceback.format_exc()}')
+            return False
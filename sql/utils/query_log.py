@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+"""
+查询日志异步批量写入
+* 查询成功后日志先写入Redis列表，不阻塞查询请求，进程重启时未写入的日志仍保留在Redis中
+* 每个进程一个后台线程，每FLUSH_INTERVAL秒或缓冲达到BATCH_SIZE条时批量写入数据库
+* 写入时持有Redis锁，多进程不会重复写入；写入数据库成功后才从列表中移除，异常时最多重复写入一批
+* Redis不可用时直接写入数据库
+查询历史检索
+* 存在全文索引idx_query_log_fulltext时使用MATCH AGAINST检索，否则使用like
+* 总数超过COUNT_LIMIT时返回执行计划估算的行数，避免每次翻页全表count
+"""
+import atexit
+import logging
+import threading
+import time
+import traceback
+
+import simplejson as json
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django_redis import get_redis_connection
+
+from sql.models import QueryLog
+
+logger = logging.getLogger('default')
+
+QUEUE_KEY = 'query_log_buffer'
+LOCK_KEY = 'query_log_flush_lock'
+# 每批写入条数
+BATCH_SIZE = 100
+# 写入间隔，单位秒
+FLUSH_INTERVAL = 2
+# 全文索引名称，见src/init_sql/v1.7.3_v1.7.4.sql
+FULLTEXT_INDEX = 'idx_query_log_fulltext'
+# 全文索引状态检查间隔，单位秒
+FULLTEXT_CHECK_INTERVAL = 600
+# 精确计数的上限，超过时返回估算值
+COUNT_LIMIT = 10000
+
+_fulltext = {'checked_at': 0, 'token_size': 0}
+
+
+def _save(records):
+    # 防止连接超时
+    if connection.connection and not connection.is_usable():
+        close_old_connections()
+    QueryLog.objects.bulk_create([QueryLog(**record) for record in records])
+
+
+def log_query(**record):
+    """记录一条查询日志，参数为QueryLog的字段"""
+    try:
+        length = get_redis_connection('default').rpush(QUEUE_KEY, json.dumps(record))
+    except Exception as e:
+        logger.error(f'查询日志写入缓冲失败，直接写入数据库:{e}')
+        _save([record])
+        return
+    query_log_flusher.notify(length)
+
+
+def has_pending_logs(username=None):
+    """
+    缓冲中是否有未写入数据库的日志
+    :param username: 不为空时仅检查最近BATCH_SIZE条中是否有该用户的日志
+    """
+    r = get_redis_connection('default')
+    if username is None:
+        return r.llen(QUEUE_KEY) > 0
+    records = r.lrange(QUEUE_KEY, -BATCH_SIZE, -1)
+    return any(json.loads(record).get('username') == username for record in records)
+
+
+def flush_query_logs(wait=False):
+    """
+    将缓冲的查询日志批量写入数据库，返回写入条数
+    :param wait: 其他进程正在写入时是否等待其完成，False时直接返回
+    """
+    r = get_redis_connection('default')
+    lock = r.lock(LOCK_KEY, timeout=60)
+    if not lock.acquire(blocking=wait, blocking_timeout=10):
+        return 0
+    total = 0
+    try:
+        while True:
+            records = r.lrange(QUEUE_KEY, 0, BATCH_SIZE - 1)
+            if not records:
+                break
+            _save([json.loads(record) for record in records])
+            r.ltrim(QUEUE_KEY, len(records), -1)
+            total += len(records)
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            logger.warning(f'释放查询日志写入锁失败:{e}')
+    return total
+
+
+def _load_fulltext_token_size():
+    """全文索引不存在返回0，否则返回ngram分词长度"""
+    with connection.cursor() as cursor:
+        cursor.execute("""select count(*) from information_schema.statistics
+        where table_schema=database() and table_name=%s and index_name=%s;""",
+                       (QueryLog._meta.db_table, FULLTEXT_INDEX))
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute("show variables like 'ngram_token_size';")
+        row = cursor.fetchone()
+        return int(row[1]) if row else 2
+
+
+def fulltext_token_size():
+    """查询日志全文索引的ngram分词长度，未创建全文索引时返回0"""
+    now = time.time()
+    if now - _fulltext['checked_at'] >= FULLTEXT_CHECK_INTERVAL:
+        try:
+            token_size = _load_fulltext_token_size()
+        except Exception as e:
+            logger.error(f'检查查询日志全文索引失败:{e}')
+            token_size = 0
+        _fulltext.update(checked_at=now, token_size=token_size)
+    return _fulltext['token_size']
+
+
+def search_query_logs(queryset, search):
+    """
+    按语句、操作人、语句标识检索查询日志
+    检索词不短于ngram分词长度时使用全文索引的短语检索，否则使用like
+    """
+    search = search.strip()
+    if not search:
+        return queryset
+    token_size = fulltext_token_size()
+    if token_size and len(search) >= token_size:
+        # 短语检索，双引号无法转义，替换为空格
+        phrase = '"{}"'.format(search.replace('"', ' '))
+        return queryset.extra(
+            where=['MATCH (sqllog, user_display, alias) AGAINST (%s IN BOOLEAN MODE)'],
+            params=[phrase])
+    return queryset.filter(Q(sqllog__icontains=search) |
+                           Q(user_display__icontains=search) |
+                           Q(alias__icontains=search))
+
+
+def _estimate_rows(queryset):
+    """执行计划中的预估扫描行数"""
+    sql, params = queryset.values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'explain {sql}', params)
+        fields = [field[0].lower() for field in cursor.description]
+        return max(int(row[fields.index('rows')] or 0) for row in cursor.fetchall())
+
+
+def count_query_logs(queryset):
+    """查询日志总数，不超过COUNT_LIMIT时为精确值，否则为估算值"""
+    count = queryset.values('id')[:COUNT_LIMIT + 1].count()
+    if count <= COUNT_LIMIT:
+        return count
+    try:
+        return max(_estimate_rows(queryset), count)
+    except Exception as e:
+        logger.warning(f'估算查询日志总数失败:{e}')
+        return count
+
+
+class QueryLogFlusher:
+    """后台定时写入线程，首次记录日志时启动"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def notify(self, length):
+        """新增日志后调用，缓冲达到BATCH_SIZE时立即写入"""
+        self._ensure_thread()
+        if length >= BATCH_SIZE:
+            self._event.set()
+
+    def _ensure_thread(self):
+        # fork出的子进程不会继承线程，需要重新启动
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None:
+                # 进程正常退出时写入剩余日志
+                atexit.register(self.flush)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='query-log-flusher', daemon=True)
+                self._thread.start()
+
+    @staticmethod
+    def flush():
+        try:
+            flush_query_logs()
+        except Exception as e:
+            logger.error(f'查询日志写入数据库失败:{e}{traceback.format_exc()}')
+        finally:
+            close_old_connections()
+
+    def _run(self):
+        while True:
+            self._event.wait(FLUSH_INTERVAL)
+            self._event.clear()
+            self.flush()
+
+
+query_log_flusher = QueryLogFlusher()
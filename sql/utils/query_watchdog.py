@@ -0,0 +1,114 @@
+# -*- coding: UTF-8 -*-
+"""
+在线查询超时监控，用于不支持原生语句超时的engine
+每个进程一个后台线程，按到期时间维护最小堆，到期后终止查询连接，不再依赖django_q的Schedule
+终止期间查询不能取消，取消时返回连接是否已被终止，被终止的连接不再归还连接池
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+from django.db import close_old_connections
+
+logger = logging.getLogger('default')
+
+
+class QueryWatchdog:
+
+    def __init__(self):
+        self._heap = []
+        self._active = {}
+        # 正在终止和已终止、未取消的token
+        self._killing = set()
+        self._killed = set()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._seq = itertools.count()
+
+    def watch(self, instance_id, thread_id, timeout):
+        """
+        登记一个查询，超过timeout秒未取消则终止连接
+        :return: 用于取消的token
+        """
+        token = next(self._seq)
+        with self._cond:
+            self._active[token] = (instance_id, thread_id)
+            heapq.heappush(self._heap, (time.monotonic() + timeout, token))
+            self._ensure_thread()
+            self._cond.notify()
+        return token
+
+    def cancel(self, token):
+        """
+        查询结束后取消，堆中的记录在到期时丢弃
+        正在终止时等待终止完成，避免连接归还后被复用时再被终止
+        :return: 连接是否已被终止
+        """
+        with self._cond:
+            while token in self._killing:
+                self._cond.wait()
+            self._active.pop(token, None)
+            killed = token in self._killed
+            self._killed.discard(token)
+            return killed
+
+    def pending(self):
+        """等待中的查询数"""
+        with self._cond:
+            return len(self._active)
+
+    def _ensure_thread(self):
+        # fork出的子进程不会继承线程，需要重新启动
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='query-watchdog', daemon=True)
+            self._thread.start()
+
+    def _next_expired(self):
+        """阻塞直到有查询到期，标记为正在终止，返回 (token, 实例id, 连接id)"""
+        with self._cond:
+            while True:
+                # 丢弃已取消的记录
+                while self._heap and self._heap[0][1] not in self._active:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, token = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                self._killing.add(token)
+                return (token, *self._active[token])
+
+    def _run(self):
+        while True:
+            token, instance_id, thread_id = self._next_expired()
+            try:
+                self._kill(instance_id, thread_id)
+            except Exception as e:
+                logger.error(f'终止超时查询失败，实例id：{instance_id}，连接id：{thread_id}，错误信息：{e}'
+                             f'{traceback.format_exc()}')
+            finally:
+                close_old_connections()
+                # 终止失败时连接状态未知，同样按已终止处理
+                with self._cond:
+                    self._killing.discard(token)
+                    self._active.pop(token, None)
+                    self._killed.add(token)
+                    self._cond.notify_all()
+
+    @staticmethod
+    def _kill(instance_id, thread_id):
+        from sql.engines import get_engine
+        from sql.models import Instance
+        query_engine = get_engine(Instance.objects.get(pk=instance_id))
+        query_engine.kill_connection(thread_id)
+        logger.info(f'查询超时，已终止连接，实例id：{instance_id}，连接id：{thread_id}')
+
+
+query_watchdog = QueryWatchdog()
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+"""
+主从延迟采集, 由django_q定时任务定期采集所有从库的延迟并写入Redis, 查询时直接读取缓存
+"""
+import logging
+import time
+
+import simplejson as json
+from django_redis import get_redis_connection
+
+from common.config import SysConfig
+from sql.engines import get_engine
+from sql.models import Instance
+
+logger = logging.getLogger('default')
+
+# 每个实例保留的历史采样点数
+HISTORY_SIZE = 1440
+
+
+def _lag_key(instance_id):
+    return f'replica_lag:{instance_id}'
+
+
+def _history_key(instance_id):
+    return f'replica_lag_history:{instance_id}'
+
+
+def sample_interval():
+    """采集间隔，单位分钟，为0时未开启采集"""
+    try:
+        return int(SysConfig().get('replica_lag_interval', 0))
+    except ValueError:
+        return 0
+
+
+def sample_replica_lag():
+    """采集所有从库的主从延迟，定时任务调用"""
+    r = get_redis_connection('default')
+    for instance in Instance.objects.filter(type='slave'):
+        query_engine = None
+        try:
+            query_engine = get_engine(instance=instance)
+            seconds_behind_master = query_engine.seconds_behind_master
+        except Exception as e:
+            logger.warning(f'采集实例{instance.instance_name}主从延迟失败，错误信息：{e}')
+            seconds_behind_master = None
+        finally:
+            if query_engine:
+                query_engine.close()
+        sample = json.dumps({'seconds_behind_master': seconds_behind_master, 'sample_time': int(time.time())})
+        # 写入失败不影响其他实例的采集
+        try:
+            pipe = r.pipeline()
+            pipe.set(_lag_key(instance.id), sample)
+            pipe.lpush(_history_key(instance.id), sample)
+            pipe.ltrim(_history_key(instance.id), 0, HISTORY_SIZE - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f'写入实例{instance.instance_name}主从延迟缓存失败，错误信息：{e}')
+
+
+def get_replica_lag(instance):
+    """
+    读取缓存的主从延迟，超过3个采集周期未更新视为无效，返回None
+    """
+    interval = sample_interval()
+    try:
+        sample = get_redis_connection('default').get(_lag_key(instance.id))
+    except Exception as e:
+        logger.warning(f'读取主从延迟缓存失败，错误信息：{e}')
+        return None
+    if not sample:
+        return None
+    sample = json.loads(sample)
+    if time.time() - sample['sample_time'] > interval * 60 * 3:
+        return None
+    return sample['seconds_behind_master']
+
+
+def get_replica_lag_history(instance, count=60):
+    """读取最近count次采集的主从延迟，按采集时间正序返回"""
+    samples = get_redis_connection('default').lrange(_history_key(instance.id), 0, count - 1)
+    return [json.loads(sample) for sample in reversed(samples)]
@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 
-from sql.models import Users, Instance, ResourceGroup, ResourceGroup2Instance
+from common.utils.versioned_cache import VersionedCache
+from sql.models import Users, Instance, ResourceGroup, InstanceTagRelations
 
 
 def user_groups(user):
@@ -16,6 +17,43 @@ def user_groups(user):
     return group_list
 
 
+# 用户实例映射缓存，资源组、实例、标签变更时由sql.signals递增版本号
+user_instances_cache = VersionedCache('user_instances')
+
+
+def _load_instance_map(user_id, all_instances):
+    """
+    加载用户可访问的实例映射 {实例id: (type, db_type, 激活的标签code集合)}
+    :param user_id: 用户id
+    :param all_instances: 是否拥有所有实例权限
+    """
+    if all_instances:
+        instances = Instance.objects.all()
+    else:
+        instances = Instance.objects.filter(resourcegroup__users__id=user_id, resourcegroup__is_deleted=0)
+    instance_map = {instance_id: (instance_type, db_type, set()) for instance_id, instance_type, db_type in
+                    instances.values_list('id', 'type', 'db_type').distinct()}
+    tags = InstanceTagRelations.objects.filter(instance_id__in=list(instance_map), active=True,
+                                               instance_tag__active=True)
+    for instance_id, tag_code in tags.values_list('instance_id', 'instance_tag__tag_code'):
+        instance_map[instance_id][2].add(tag_code)
+    return instance_map
+
+
+def user_instance_ids(user, type=None, db_type=None, tag_codes=None):
+    """
+    获取用户可访问的实例id集合，参数同user_instances，在内存中过滤
+    """
+    all_instances = user.has_perm('sql.query_all_instances')
+    instance_map = user_instances_cache.get(
+        (user.id, all_instances), lambda: _load_instance_map(user.id, all_instances))
+    tag_codes = set(tag_codes or [])
+    return {instance_id for instance_id, (instance_type, instance_db_type, tags) in instance_map.items()
+            if (not type or instance_type == type)
+            and (not db_type or instance_db_type in db_type)
+            and tag_codes <= tags}
+
+
 def user_instances(user, type=None, db_type=None, tag_codes=None):
     """
     获取用户实例列表（通过资源组间接关联）
@@ -25,32 +63,7 @@ def user_instances(user, type=None, db_type=None, tag_codes=None):
     :param tag_codes: 标签code列表, ['can_write', 'can_read']
     :return:
     """
-    # 拥有所有实例权限的用户
-    if user.has_perm('sql.query_all_instances'):
-        instances = Instance.objects.all()
-    else:
-        # 先获取用户关联的资源组
-        resource_groups = ResourceGroup.objects.filter(users=user, is_deleted=0)
-        # 再获取资源组和实例的关联关系
-        resource_group2instance = ResourceGroup2Instance.objects.filter(resource_group__in=resource_groups)
-        # 再获取实例
-        instances = Instance.objects.filter(resourcegroup2instance__in=resource_group2instance)
-    # 过滤type
-    if type:
-        instances = instances.filter(type=type)
-
-    # 过滤db_type
-    if db_type:
-        instances = instances.filter(db_type__in=db_type)
-
-    # 过滤tag
-    if tag_codes:
-        for tag_code in tag_codes:
-            instances = instances.filter(instancetag__tag_code=tag_code,
-                                         instancetag__active=True,
-                                         instancetagrelations__active=True)
-
-    return instances.distinct()
+    return Instance.objects.filter(pk__in=user_instance_ids(user, type, db_type, tag_codes))
 
 
 def auth_group_users(auth_group_names, group_id):
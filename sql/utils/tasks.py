@@ -30,6 +30,14 @@ def add_sync_ding_user_schedule():
              name='同步钉钉用户ID', schedule_type='D', repeats=-1, timeout=-1)
 
 
+def add_replica_lag_schedule(interval):
+    """添加/修改主从延迟采集定时任务，interval单位为分钟，为0时删除任务"""
+    del_schedule(name='采集主从延迟')
+    if interval > 0:
+        schedule('sql.utils.replica_lag.sample_replica_lag',
+                 name='采集主从延迟', schedule_type='I', minutes=interval, repeats=-1, timeout=-1)
+
+
 def del_schedule(name):
     """删除task"""
     try:
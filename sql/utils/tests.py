@@ -7,6 +7,9 @@
 """
 import datetime
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, MagicMock
 
 from django.conf import settings
@@ -14,20 +17,28 @@ from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission, Group
 from django.test import TestCase, Client
 from django_q.models import Schedule
+from django_redis import get_redis_connection
 
 from common.config import SysConfig
 from common.utils.const import WorkflowDict
-from sql.engines.models import ReviewResult, ReviewSet
+from sql.engines.models import ReviewResult, ReviewSet, ResultSet
 from sql.models import SqlWorkflow, SqlWorkflowContent, Instance, ResourceGroup, ResourceGroup2User, \
     ResourceGroup2Instance, WorkflowLog, WorkflowAudit, WorkflowAuditDetail, WorkflowAuditSetting, \
-    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, InstanceTagRelations
-from sql.utils.resource_group import user_groups, user_instances, auth_group_users
+    QueryPrivilegesApply, DataMaskingRules, DataMaskingColumns, InstanceTag, InstanceTagRelations, QueryLog
+from sql.utils.resource_group import user_groups, user_instances, user_instance_ids, auth_group_users
 from sql.utils.sql_review import is_auto_review, can_execute, can_timingtask, can_cancel, on_correct_time_period
 from sql.utils.sql_utils import *
 from sql.utils.execute_sql import execute, execute_callback
-from sql.utils.tasks import add_sql_schedule, del_schedule, task_info
+from sql.utils.tasks import add_sql_schedule, add_replica_lag_schedule, del_schedule, task_info
+from sql.utils.replica_lag import sample_replica_lag, get_replica_lag
+from sql.utils.metadata_cache import MetadataCache, invalidate_metadata, warm_up_metadata
+from sql.utils.query_cache import QueryResultCache, normalize_sql, instance_ttl, invalidate_instance
+from sql.utils.query_watchdog import QueryWatchdog
+from sql.utils import query_log
+from sql.utils.parse_cache import ParseCache, parse_cache, parameterize_sql
 from sql.utils.workflow_audit import Audit
-from sql.utils.data_masking import data_masking, brute_mask
+from sql.utils.data_masking import data_masking, data_masking_stream, brute_mask, get_masking_rules, \
+    get_masking_columns, hit_column, hit_table, BruteMasker, MaskingRule
 
 User = get_user_model()
 __author__ = 'hhyo'
@@ -607,6 +618,15 @@ class TestTasks(TestCase):
         add_sql_schedule('test', datetime.datetime.now(), 1)
         _schedule.assert_called_once()
 
+    @patch('sql.utils.tasks.schedule')
+    def test_add_replica_lag_schedule(self, _schedule):
+        add_replica_lag_schedule(1)
+        _schedule.assert_called_once_with('sql.utils.replica_lag.sample_replica_lag', name='采集主从延迟',
+                                          schedule_type='I', minutes=1, repeats=-1, timeout=-1)
+        _schedule.reset_mock()
+        add_replica_lag_schedule(0)
+        _schedule.assert_not_called()
+
     def test_del_schedule(self):
         del_schedule('some_name')
         with self.assertRaises(Schedule.DoesNotExist):
@@ -1084,6 +1104,8 @@ class TestDataMasking(TestCase):
         SqlWorkflowContent.objects.all().delete()
         DataMaskingColumns.objects.all().delete()
         DataMaskingRules.objects.all().delete()
+        parse_cache.clear()
+        self.sys_config.purge()
 
     @patch('sql.utils.data_masking.InceptionEngine')
     def test_data_masking_not_hit_rules(self, _inception):
@@ -1130,6 +1152,37 @@ class TestDataMasking(TestCase):
         mask_result_rows = [['188****8888', ], ['188****8889', ], ['188****8810', ]]
         self.assertEqual(r.rows, mask_result_rows)
 
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_data_masking_stream(self, _inception):
+        """流式脱敏，语法树仅解析一次"""
+        _inception.return_value.query_print.return_value = {
+            'command': 'select',
+            'select_list': [{'type': 'FIELD_ITEM', 'field': '*'}],
+            'table_ref': [{'db': 'archer_test', 'table': 'users'}],
+            'limit': {'limit': [{'type': 'INT_ITEM', 'value': '100'}]}}
+        sql = """select * from users;"""
+        chunks = [ReviewSet(column_list=['phone'], rows=(('18888888888',), ('18888888889',)), full_sql=sql),
+                  ReviewSet(column_list=['phone'], rows=(('18888888810',),), full_sql=sql)]
+        r = list(data_masking_stream(self.ins, 'archery', sql, iter(chunks)))
+        self.assertEqual(r[0].rows, [['188****8888', ], ['188****8889', ]])
+        self.assertEqual(r[1].rows, [['188****8810', ]])
+        self.assertTrue(r[1].is_masked)
+        _inception.return_value.query_print.assert_called_once()
+
+    @patch('sql.utils.data_masking.InceptionEngine')
+    def test_data_masking_stream_error(self, _inception):
+        """流式脱敏，解析异常时每一批都返回异常并保留原数据"""
+        _inception.return_value.query_print.side_effect = RuntimeError('some error')
+        sql = """select phone from users;"""
+        rows = (('18888888888',),)
+        chunks = [ReviewSet(column_list=['phone'], rows=rows, full_sql=sql),
+                  ReviewSet(column_list=['phone'], rows=rows, full_sql=sql)]
+        r = list(data_masking_stream(self.ins, 'archery', sql, iter(chunks)))
+        for chunk in r:
+            self.assertEqual(chunk.error, 'some error')
+            self.assertEqual(chunk.rows, rows)
+        _inception.return_value.query_print.assert_called_once()
+
     @patch('sql.utils.data_masking.InceptionEngine')
     def test_data_masking_hit_rules_star_and_column(self, _inception):
         """[*,column_a]"""
@@ -1255,6 +1308,34 @@ class TestDataMasking(TestCase):
             self.assertEqual(r.status, 1)
             self.assertEqual(r.error, '不支持该查询语句脱敏！请联系管理员')
 
+    def test_masking_rules_registry(self):
+        """脱敏规则预编译缓存，规则修改后失效"""
+        rules = get_masking_rules()
+        self.assertEqual(rules[1].mask('18888888888'), '188****8888')
+        self.assertIs(get_masking_rules(), rules)
+        DataMaskingRules.objects.filter(rule_type=1).first().delete()
+        DataMaskingRules.objects.create(rule_type=1, rule_regex='(.{3})(.*)', hide_group=2)
+        self.assertEqual(get_masking_rules()[1].mask('18888888888'), '188****')
+
+    def test_masking_columns_index(self):
+        """脱敏字段索引，不区分大小写，字段配置修改后失效"""
+        masking_columns = get_masking_columns(self.ins)
+        self.assertEqual(masking_columns['tables'], {('archer_test', 'users'): {'phone': ('phone', 1)}})
+        self.assertEqual(masking_columns['rule_types'], {1})
+        self.assertIs(get_masking_columns(self.ins), masking_columns)
+        hit_info = hit_column(masking_columns, self.ins, 'Archer_Test', 'USERS', 'Phone')
+        self.assertTrue(hit_info['is_hit'])
+        self.assertEqual(hit_info['rule_type'], 1)
+        self.assertEqual(hit_table(masking_columns, self.ins, 'archer_test', 'users')[0]['column_name'], 'phone')
+        DataMaskingColumns.objects.create(rule_type=1, active=True, instance=self.ins,
+                                          table_schema='archer_test', table_name='users', column_name='email')
+        masking_columns = get_masking_columns(self.ins)
+        self.assertEqual([c['column_name'] for c in hit_table(masking_columns, self.ins, 'archer_test', 'users')],
+                         ['phone', 'email'])
+        DataMaskingColumns.objects.filter(column_name='phone').delete()
+        masking_columns = get_masking_columns(self.ins)
+        self.assertFalse(hit_column(masking_columns, self.ins, 'archer_test', 'users', 'phone')['is_hit'])
+
     def test_brute_mask(self):
         sql = """select * from users;"""
         rows = (('18888888888',), ('18888888889',), ('18888888810',))
@@ -1263,6 +1344,33 @@ class TestDataMasking(TestCase):
         mask_result_rows = [('188****8888',), ('188****8889',), ('188****8810',)]
         self.assertEqual(r.rows, mask_result_rows)
 
+    def test_brute_mask_column_type(self):
+        """数值类型的列不脱敏，多条规则依次替换"""
+        DataMaskingRules.objects.create(rule_type=3, rule_regex=r'(.{1})(.*)(@.*)', hide_group=2)
+        DataMaskingColumns.objects.create(rule_type=3, active=False, instance=self.ins, table_schema='archer_test',
+                                          table_name='users', column_name='email')
+        rows = (('18888888888', 18888888888, 'a@b', None),)
+        query_result = ResultSet(column_list=['phone', 'id', 'email', 'remark'], rows=rows,
+                                 column_type=['STRING', 'NUMBER', 'STRING', 'STRING'])
+        r = brute_mask(self.ins, query_result)
+        self.assertEqual(r.rows, [('188****8888', 18888888888, 'a****@b', None)])
+
+    def test_brute_mask_overlapping_rules(self):
+        """规则按顺序作用于前一条规则的结果，后一条规则匹配位置更靠前时仍先应用前一条"""
+        rules = [MaskingRule(DataMaskingRules(rule_type=2, rule_regex=r'(\d{3})(\d{4})(\d{4})', hide_group=2)),
+                 MaskingRule(DataMaskingRules(rule_type=3, rule_regex=r'(x)(\d)(.*)', hide_group=2))]
+        self.assertEqual(BruteMasker(rules).sub('x13812345678'), 'x****38****5678')
+
+    @patch('sql.utils.data_masking._executor', ThreadPoolExecutor)
+    @patch('sql.utils.data_masking.BRUTE_MASK_CHUNK_ROWS', 2)
+    @patch('sql.utils.data_masking.BRUTE_MASK_PARALLEL_CELLS', 1)
+    def test_brute_mask_parallel(self):
+        """大结果集分批并行脱敏，保持行顺序"""
+        self.sys_config.set('brute_mask_workers', '2')
+        rows = [(f'1888888888{i}',) for i in range(5)]
+        r = brute_mask(self.ins, ResultSet(column_list=['phone'], rows=rows))
+        self.assertEqual(r.rows, [(f'188****888{i}',) for i in range(5)])
+
 
 class TestResourceGroup(TestCase):
     def setUp(self):
@@ -1322,6 +1430,20 @@ class TestResourceGroup(TestCase):
         ins = user_instances(self.user)
         self.assertEqual(ins.__len__(), 0)
 
+    def test_user_instance_ids(self):
+        """用户实例映射，内存中按标签过滤，资源组和标签变更后失效"""
+        ResourceGroup2User.objects.create(resource_group=self.rgp1, user=self.user)
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins1)
+        self.assertEqual(user_instance_ids(self.user), {self.ins1.id})
+        self.assertEqual(user_instance_ids(self.user, tag_codes=['can_read']), set())
+        tag = InstanceTag.objects.create(tag_code='can_read', tag_name='支持查询')
+        InstanceTagRelations.objects.create(instance_tag=tag, instance=self.ins1)
+        self.assertEqual(user_instance_ids(self.user, tag_codes=['can_read'], db_type=['mysql']), {self.ins1.id})
+        with self.assertNumQueries(0):
+            self.assertEqual(user_instance_ids(self.user, db_type=['mssql']), set())
+        ResourceGroup2Instance.objects.create(resource_group=self.rgp1, instance=self.ins2)
+        self.assertEqual(user_instance_ids(self.user), {self.ins1.id, self.ins2.id})
+
     def test_auth_group_users(self):
         """获取资源组内关联指定权限组的用户"""
         # 用户关联权限组
@@ -1331,3 +1453,320 @@ class TestResourceGroup(TestCase):
         # 获取资源组内关联指定权限组的用户
         users = auth_group_users(auth_group_names=[self.agp.name], group_id=self.rgp1.group_id)
         self.assertIn(self.user, users)
+
+
+class TestReplicaLag(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.slave = Instance.objects.create(instance_name='some_slave', type='slave', db_type='mysql',
+                                             host='some_host', port=3306, user='ins_user', password='some_str')
+        self.master = Instance.objects.create(instance_name='some_master', type='master', db_type='mysql',
+                                              host='some_host', port=3306, user='ins_user', password='some_str')
+
+    def tearDown(self):
+        self.sys_config.purge()
+        Instance.objects.all().delete()
+
+    @patch('sql.utils.replica_lag.get_redis_connection')
+    @patch('sql.utils.replica_lag.get_engine')
+    def test_sample_replica_lag(self, _get_engine, _redis):
+        """仅采集从库的主从延迟"""
+        _get_engine.return_value.seconds_behind_master = 10
+        sample_replica_lag()
+        _get_engine.assert_called_once_with(instance=self.slave)
+        _get_engine.return_value.close.assert_called_once()
+        pipe = _redis.return_value.pipeline.return_value
+        key, sample = pipe.set.call_args[0]
+        self.assertEqual(key, f'replica_lag:{self.slave.id}')
+        self.assertEqual(json.loads(sample)['seconds_behind_master'], 10)
+        pipe.ltrim.assert_called_once()
+
+    @patch('sql.utils.replica_lag.get_redis_connection')
+    @patch('sql.utils.replica_lag.get_engine')
+    def test_sample_replica_lag_redis_error(self, _get_engine, _redis):
+        """单个实例写入缓存失败不影响其他实例"""
+        Instance.objects.create(instance_name='other_slave', type='slave', db_type='mysql',
+                                host='some_host', port=3306, user='ins_user', password='some_str')
+        _get_engine.return_value.seconds_behind_master = 10
+        pipe = _redis.return_value.pipeline.return_value
+        pipe.execute.side_effect = [Exception('some error'), None]
+        sample_replica_lag()
+        self.assertEqual(pipe.execute.call_count, 2)
+        self.assertEqual(_get_engine.return_value.close.call_count, 2)
+
+    @patch('sql.utils.replica_lag.get_redis_connection')
+    def test_get_replica_lag(self, _redis):
+        """读取缓存的主从延迟，过期返回None"""
+        self.sys_config.set('replica_lag_interval', '1')
+        _redis.return_value.get.return_value = json.dumps(
+            {'seconds_behind_master': 10, 'sample_time': int(datetime.datetime.now().timestamp())})
+        self.assertEqual(get_replica_lag(self.slave), 10)
+        _redis.return_value.get.return_value = json.dumps({'seconds_behind_master': 10, 'sample_time': 0})
+        self.assertIsNone(get_replica_lag(self.slave))
+        _redis.return_value.get.return_value = None
+        self.assertIsNone(get_replica_lag(self.slave))
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.sys_config.set('query_cache', 'true')
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+
+    def tearDown(self):
+        self.sys_config.purge()
+        Instance.objects.all().delete()
+
+    def test_normalize_sql(self):
+        """合并引号外空白，保留引号内内容"""
+        self.assertEqual(normalize_sql("select  a,\n b from t where c='x  y' ;"),
+                         "select a, b from t where c='x  y'")
+
+    def test_instance_ttl(self):
+        self.sys_config.set('query_cache_ttl', '30')
+        self.assertEqual(instance_ttl(self.ins), 30)
+        self.sys_config.set('query_cache_instance_ttl', 'other_ins:10, some_ins:0')
+        self.assertEqual(instance_ttl(self.ins), 0)
+
+    def test_cache_set_get(self):
+        sql = 'select a from t limit 10;'
+        QueryResultCache(self.ins, 'some_db', sql, 10).set({'rows': [[1]], 'column_list': ['a']})
+        data = QueryResultCache(self.ins, 'some_db', 'select  a from t limit 10', 10).get()
+        self.assertTrue(data['cache_hit'])
+        self.assertEqual(data['rows'], [[1]])
+        # limit不同不命中
+        self.assertIsNone(QueryResultCache(self.ins, 'some_db', sql, 100).get())
+        # 实例执行DDL后失效
+        invalidate_instance(self.ins)
+        self.assertIsNone(QueryResultCache(self.ins, 'some_db', sql, 10).get())
+
+    def test_cache_disabled(self):
+        self.sys_config.set('query_cache', 'false')
+        result_cache = QueryResultCache(self.ins, 'some_db', 'select 1', 10)
+        self.assertFalse(result_cache.enabled)
+        self.assertFalse(result_cache.set({'rows': []}))
+        # 非select语句不缓存
+        self.sys_config.set('query_cache', 'true')
+        self.assertFalse(QueryResultCache(self.ins, 'some_db', 'show tables', 10).enabled)
+
+
+class TestMetadataCache(TestCase):
+    def setUp(self):
+        self.sys_config = SysConfig()
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.engine = MagicMock()
+        self.engine.get_all_tables.return_value = ResultSet(rows=['t1', 't2'])
+        self.engine.get_all_columns.return_value = ResultSet(rows=[('some_db', 't1', 'id'), ('some_db', 't1', 'name'),
+                                                                   ('some_db', 'test', 'id')])
+
+    def tearDown(self):
+        self.sys_config.purge()
+        Instance.objects.all().delete()
+        invalidate_metadata(self.ins)
+
+    def test_get_cached(self):
+        MetadataCache(self.ins, self.engine).get_all_tables(db_name='some_db')
+        result = MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        self.assertEqual(result.rows, ['t1', 't2'])
+        # None参数不传给engine
+        self.engine.get_all_tables.assert_called_once_with(db_name='some_db')
+
+    def test_invalidate(self):
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        invalidate_metadata(self.ins)
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        self.assertEqual(self.engine.get_all_tables.call_count, 2)
+
+    def test_error_not_cached(self):
+        error = ResultSet()
+        error.error = 'some error'
+        self.engine.get_all_tables.return_value = error
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        self.assertEqual(self.engine.get_all_tables.call_count, 2)
+
+    def test_disabled(self):
+        self.sys_config.set('metadata_cache_ttl', '0')
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        MetadataCache(self.ins, self.engine).get_all_tables('some_db')
+        self.assertEqual(self.engine.get_all_tables.call_count, 2)
+
+    def test_prefetch(self):
+        self.assertEqual(MetadataCache(self.ins, self.engine).prefetch('some_db'), 2)
+        metadata = MetadataCache(self.ins, self.engine)
+        self.assertEqual(metadata.get_all_tables('some_db').rows, ['t1'])
+        self.assertEqual(metadata.get_all_columns_by_tb('some_db', 't1').rows, ['id', 'name'])
+        self.engine.get_all_tables.assert_not_called()
+        self.engine.get_all_columns_by_tb.assert_not_called()
+
+    @patch('sql.utils.metadata_cache.get_engine')
+    def test_warm_up_metadata(self, _get_engine):
+        _get_engine.return_value = self.engine
+        self.assertDictEqual(warm_up_metadata(self.ins.id, ['some_db']), {'some_db': 2})
+        self.engine.get_all_columns.side_effect = RuntimeError('some error')
+        self.assertDictEqual(warm_up_metadata(self.ins.id, ['some_db']), {'some_db': -1})
+
+    def test_cache_max_size(self):
+        self.sys_config.set('query_cache_max_size', '10')
+        result_cache = QueryResultCache(self.ins, 'some_db', 'select 1', 10)
+        self.assertFalse(result_cache.set({'rows': [['a' * 100]]}))
+
+
+class TestQueryLogBuffer(TestCase):
+    def tearDown(self):
+        QueryLog.objects.all().delete()
+        get_redis_connection('default').delete(query_log.QUEUE_KEY)
+
+    @patch('sql.utils.query_log.query_log_flusher')
+    def test_log_and_flush(self, _flusher):
+        """日志先写入缓冲，批量写入数据库后从缓冲中移除"""
+        for i in range(3):
+            query_log.log_query(username='some_user', db_name='some_db', instance_name='some_ins',
+                                sqllog=f'select {i}', effect_row=1, cost_time=0.01)
+        self.assertEqual(_flusher.notify.call_count, 3)
+        self.assertEqual(QueryLog.objects.count(), 0)
+        with patch.object(query_log, 'BATCH_SIZE', 2):
+            self.assertEqual(query_log.flush_query_logs(), 3)
+        self.assertEqual(QueryLog.objects.count(), 3)
+        self.assertEqual(get_redis_connection('default').llen(query_log.QUEUE_KEY), 0)
+
+    @patch('sql.utils.query_log.query_log_flusher')
+    def test_has_pending_logs(self, _flusher):
+        """按用户检查缓冲中未写入的日志"""
+        self.assertFalse(query_log.has_pending_logs())
+        query_log.log_query(username='some_user', db_name='some_db', instance_name='some_ins',
+                            sqllog='select 1', effect_row=1, cost_time=0.01)
+        self.assertTrue(query_log.has_pending_logs())
+        self.assertTrue(query_log.has_pending_logs('some_user'))
+        self.assertFalse(query_log.has_pending_logs('other_user'))
+
+    @patch('sql.utils.query_log.get_redis_connection')
+    def test_log_without_redis(self, _redis):
+        """Redis不可用时直接写入数据库"""
+        _redis.return_value.rpush.side_effect = RuntimeError('connection refused')
+        query_log.log_query(username='some_user', db_name='some_db', instance_name='some_ins',
+                            sqllog='select 1', effect_row=1, cost_time=0.01)
+        self.assertEqual(QueryLog.objects.count(), 1)
+
+    @patch('sql.utils.query_log.fulltext_token_size', return_value=0)
+    def test_search_without_fulltext(self, _token_size):
+        """未创建全文索引时使用like检索"""
+        QueryLog.objects.create(username='some_user', db_name='some_db', instance_name='some_ins',
+                                sqllog='select * from some_table', effect_row=1, cost_time=0.01)
+        QueryLog.objects.create(username='some_user', db_name='some_db', instance_name='some_ins',
+                                sqllog='select 1', effect_row=1, cost_time=0.01, alias='some_table_alias')
+        queryset = query_log.search_query_logs(QueryLog.objects.all(), ' some_table ')
+        self.assertEqual(queryset.count(), 2)
+        self.assertEqual(query_log.search_query_logs(QueryLog.objects.all(), '').count(), 2)
+
+    @patch('sql.utils.query_log.fulltext_token_size', return_value=2)
+    def test_search_with_fulltext(self, _token_size):
+        """存在全文索引时使用短语检索，短于分词长度的检索词使用like"""
+        queryset = query_log.search_query_logs(QueryLog.objects.all(), 'some "table"')
+        self.assertIn('MATCH (sqllog, user_display, alias) AGAINST', str(queryset.query))
+        self.assertEqual(queryset.query.where.children[-1].params, ['"some  table "'])
+        queryset = query_log.search_query_logs(QueryLog.objects.all(), 's')
+        self.assertNotIn('MATCH', str(queryset.query))
+
+    def test_count(self):
+        """超过计数上限时返回估算值"""
+        for i in range(3):
+            QueryLog.objects.create(username='some_user', db_name='some_db', instance_name='some_ins',
+                                    sqllog=f'select {i}', effect_row=1, cost_time=0.01)
+        self.assertEqual(query_log.count_query_logs(QueryLog.objects.all()), 3)
+        with patch.object(query_log, 'COUNT_LIMIT', 1), \
+                patch.object(query_log, '_estimate_rows', return_value=100):
+            self.assertEqual(query_log.count_query_logs(QueryLog.objects.all()), 100)
+
+
+class TestQueryWatchdog(TestCase):
+    @patch.object(QueryWatchdog, '_kill')
+    def test_kill_expired(self, _kill):
+        """到期未取消的查询被终止，已取消的查询不处理"""
+        watchdog = QueryWatchdog()
+        cancelled = watchdog.watch(1, 100, 0.05)
+        watchdog.watch(1, 101, 0.1)
+        watchdog.cancel(cancelled)
+        for _ in range(50):
+            # 终止完成后才移除记录
+            if _kill.called and not watchdog.pending():
+                break
+            time.sleep(0.05)
+        _kill.assert_called_once_with(1, 101)
+        self.assertEqual(watchdog.pending(), 0)
+
+    def test_cancel_while_killing(self):
+        """终止期间取消需等待终止完成，并返回连接已被终止"""
+        watchdog = QueryWatchdog()
+        killing = threading.Event()
+        release = threading.Event()
+
+        def _kill(instance_id, thread_id):
+            killing.set()
+            release.wait(5)
+
+        with patch.object(QueryWatchdog, '_kill', side_effect=_kill):
+            token = watchdog.watch(1, 100, 0)
+            self.assertTrue(killing.wait(5))
+            cancelled = []
+            canceller = threading.Thread(target=lambda: cancelled.append(watchdog.cancel(token)))
+            canceller.start()
+            canceller.join(0.1)
+            # 终止未完成前取消被阻塞
+            self.assertTrue(canceller.is_alive())
+            release.set()
+            canceller.join(5)
+        self.assertEqual(cancelled, [True])
+        self.assertFalse(watchdog.cancel(watchdog.watch(1, 101, 60)))
+
+
+class TestParseCache(TestCase):
+    def setUp(self):
+        self.ins = Instance.objects.create(instance_name='some_ins', type='slave', db_type='mysql',
+                                           host='some_host', port=3306, user='ins_user', password='some_str')
+        self.parse_cache = ParseCache(max_size=2)
+
+    def tearDown(self):
+        Instance.objects.all().delete()
+
+    def test_parameterize_sql(self):
+        """常量参数化，保留标识符"""
+        self.assertEqual(
+            parameterize_sql("select `t1`.a1 from t1 where id in (1, 2) and c='x''y' limit 10;"),
+            "select `t1`.a1 from t1 where id in (?) and c=? limit ?")
+
+    def test_get(self):
+        """常量不同的语句复用解析结果，返回值修改不影响缓存"""
+        loader = MagicMock(return_value={'table_ref': [{'db': 'db', 'table': 't'}]})
+        r = self.parse_cache.get('query_tree', self.ins, 'db', "select a from t where id=1", loader)
+        r['table_ref'].append('changed')
+        r = self.parse_cache.get('query_tree', self.ins, 'db', "select a from t where id = 2", loader)
+        self.assertEqual(r, {'table_ref': [{'db': 'db', 'table': 't'}]})
+        loader.assert_called_once()
+        # 库不同不命中
+        self.parse_cache.get('query_tree', self.ins, 'other_db', "select a from t where id=1", loader)
+        self.assertEqual(loader.call_count, 2)
+
+    def test_lru(self):
+        loader = MagicMock(return_value={})
+        for sql in ['select a from t', 'select b from t', 'select a from t', 'select c from t', 'select a from t']:
+            self.parse_cache.get('query_tree', self.ins, 'db', sql, loader)
+        self.assertEqual(loader.call_count, 3)
+
+    def test_loader_exception(self):
+        """解析异常不缓存"""
+        loader = MagicMock(side_effect=[RuntimeError('语法错误'), {}])
+        with self.assertRaises(RuntimeError):
+            self.parse_cache.get('query_tree', self.ins, 'db', 'select a from', loader)
+        self.assertEqual(self.parse_cache.get('query_tree', self.ins, 'db', 'select a from', loader), {})
+
+    def test_shared(self):
+        """Redis共享缓存"""
+        loader = MagicMock(return_value={'a': 1})
+        ParseCache(shared_timeout=60).get('table_ref', self.ins, 'db', 'select a from t', loader)
+        self.assertEqual(ParseCache(shared_timeout=60).get('table_ref', self.ins, 'db', 'select a from t', loader),
+                         {'a': 1})
+        loader.assert_called_once()
+
@@ -17,6 +17,7 @@ from django.utils import timezone
 from common.utils.aes_decryptor import Prpcrypt
 from common.utils.permission import superuser_required
 import archery
+from sql.engines.pool import pool_stats
 from sql.models import Instance
 from mirage.tools import Migrator
 
@@ -194,6 +195,7 @@ def debug(request):
             'python_version': platform.python_version(),
             'mysql_info': mysql_info,
             'redis_info': full_redis_info if full else redis_info,
+            'engine_pool_stats': pool_stats(),
             'sys_argv': sys.argv,
             'platform': platform.uname()
         },
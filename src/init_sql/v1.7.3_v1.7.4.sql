@@ -0,0 +1,9 @@
+-- 查询历史按用户倒序分页
+ALTER TABLE query_log ADD INDEX idx_username_id (username, id);
+
+-- 查询历史全文检索，需要MySQL 5.7.6及以上版本，检索词短于ngram_token_size(默认2)时仍使用like
+ALTER TABLE query_log ADD FULLTEXT INDEX idx_query_log_fulltext (sqllog, user_display, alias) WITH PARSER ngram;
+
+-- 增加查询结果导出权限
+set @content_type_id=(select id from django_content_type where app_label='sql' and model='permission');
+INSERT IGNORE INTO auth_permission (name, content_type_id, codename) VALUES ('后台导出查询结果', @content_type_id, 'query_export');